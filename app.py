@@ -1,18 +1,41 @@
-from mongoengine import connect
+from mongoengine import connect, NotUniqueError
 from flask import Flask, jsonify, request, g
 import jwt
 from datetime import datetime, timedelta, timezone
 from models.teacher import Teacher
-from middlewares.authentication import token_required_teacher, token_required_student
+from middlewares.authentication import token_required_teacher, token_required_student, get_bearer_token
 from dotenv import load_dotenv
 load_dotenv()
 from flask_cors import CORS
 from services.google_login import GoogleLogin 
 import os
+import hashlib
+import hmac
+import csv
+import io
+import copy
+import json
+import math
+import time
 from models.assistant import Assistant, Content, DigestedContent
 from models.student import Student
 from models.conversation import Conversation, UserMessage, AssistantMessage, References, Message
 from utils import Utils
+from services.task_queue import TaskQueue
+from services.idempotency import IdempotencyStore
+from services.channel_router import ChannelRouter
+from services.identity import IdentityResolver
+from services.membership import Membership
+from services.student_import import StudentImporter
+from services.outbound import OutboundScheduler
+from services.metrics import Metrics
+from services.profiling import Profiler, PROFILE_ID_HEADER
+from services.prompt_builder import PromptBuilder, MAX_CONTEXT_ITEMS, HISTORY_MESSAGES
+from services.answer_cache import AnswerCache
+from services.keyword_index import KeywordIndex
+from services.http_client import HttpClient
+from services.llm_gateway import LLMGateway
+from services.admission import Admission, REJECTION_REASONS
 from models.channel import Channel
 from models.teacher import Channels
 
@@ -27,6 +50,94 @@ CORS(app)
 
 connect(host=os.getenv('MONGO_URI'))
 
+# Conversation history pagination
+DEFAULT_MESSAGES_PAGE_SIZE = 20
+MAX_MESSAGES_PAGE_SIZE = 100
+MAX_RESOLVED_REFERENCES = int(os.getenv('MAX_RESOLVED_REFERENCES', 5))
+REFERENCE_SNIPPET_LENGTH = 300
+# Reply when a message yields no usable question
+FALLBACK_REPLY = "Hello! I'm your AI assistant for your teacher. How can I help you today?"
+# Similarity above which a match on a generated digest question answers from that digest alone
+FAQ_MATCH_THRESHOLD = float(os.getenv('FAQ_MATCH_THRESHOLD', 0.85))
+# Channel replies to messages shed by admission control
+RATE_LIMITED_REPLY = "You're sending messages a little too fast. Please wait a moment and ask again."
+BUSY_REPLY = "I'm answering a lot of questions right now. Please try again in a minute."
+
+# Inbound channel messages are processed off the request thread
+webhook_queue = TaskQueue('webhooks', workers=int(os.getenv('WEBHOOK_WORKERS', 8)), max_size=int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000)))
+
+# Warm the webhook routing table, it is reloaded lazily if this fails
+try:
+    ChannelRouter.load()
+except Exception as e:
+    print(f"Error loading channel routes: {e}")
+
+# Every request is timed and labelled with its route, spans inside it inherit the labels
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    Metrics.reset_labels(route=request.url_rule.rule if request.url_rule else 'unmatched')
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' in g:
+        labels = {'route': '', 'assistant': '', **Metrics.current_labels()}
+        Metrics.observe('request_duration_seconds', time.perf_counter() - g.request_started, method=request.method, status=str(response.status_code), **labels)
+    if 'profile_id' in g:
+        response.headers[PROFILE_ID_HEADER] = g.profile_id
+    return response
+
+# Export the counters kept by the services alongside the span histograms
+def collect_service_metrics():
+    for host, stats in HttpClient.metrics().items():
+        yield 'http_client_requests_total', 'counter', 'Outbound HTTP requests', {'host': host}, stats['count']
+        yield 'http_client_errors_total', 'counter', 'Outbound HTTP requests that failed', {'host': host}, stats['errors']
+        yield 'http_client_seconds_total', 'counter', 'Time spent in outbound HTTP requests', {'host': host}, stats['total_seconds']
+    llm = LLMGateway.metrics()
+    for name in ('requests', 'coalesced', 'retries', 'throttled_seconds'):
+        yield f'llm_{name}_total', 'counter', f'LLM gateway {name.replace("_", " ")}', {}, llm[name]
+    yield 'llm_waiting_chat', 'gauge', 'Chat requests waiting for LLM rate limit budget', {}, llm['waiting_chat']
+    for result, count in IdempotencyStore.metrics().items():
+        yield 'webhook_messages_total', 'counter', 'Inbound webhook messages by deduplication result', {'result': result}, count
+    yield 'webhook_queue_depth', 'gauge', 'Webhook messages waiting for a worker', {}, webhook_queue.depth()
+    outbound = OutboundScheduler.metrics()
+    for result in ('sent', 'failed'):
+        yield 'outbound_messages_total', 'counter', 'Outbound channel messages by result', {'result': result}, outbound[result]
+    yield 'outbound_retries_total', 'counter', 'Rate-limited outbound sends that were retried', {}, outbound['retries']
+    yield 'outbound_queue_depth', 'gauge', 'Outbound messages waiting to be sent', {}, outbound['queue_depth']
+    yield 'outbound_active_chats', 'gauge', 'Chats with pending outbound messages', {}, outbound['active_chats']
+    answers = AnswerCache.metrics()
+    for result, name in (('hit', 'hits'), ('miss', 'misses')):
+        yield 'answer_cache_lookups_total', 'counter', 'Semantic answer cache lookups by result', {'result': result}, answers[name]
+    yield 'answer_cache_hit_rate', 'gauge', 'Share of answer cache lookups that were hits', {}, answers['hit_rate']
+    yield 'answer_cache_entries', 'gauge', 'Answers held in the semantic cache', {}, answers['entries']
+    admission = Admission.metrics()
+    yield 'admission_admitted_total', 'counter', 'Chats admitted for answering', {}, admission['admitted']
+    for reason in REJECTION_REASONS:
+        yield 'admission_rejected_total', 'counter', 'Chats shed by admission control by exhausted budget', {'reason': reason}, admission[reason]
+    yield 'admission_in_flight', 'gauge', 'Chats being answered by this worker', {}, admission['in_flight']
+    yield 'admission_busiest_assistant_in_flight', 'gauge', 'Chats in flight for the busiest assistant', {}, admission['busiest_assistant']
+
+Metrics.register_collector(collect_service_metrics)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Scrapes must present METRICS_TOKEN as a bearer token; without one configured the endpoint is off
+    token = os.getenv('METRICS_TOKEN')
+    if not token:
+        return jsonify({'error': 'Metrics are disabled, set METRICS_TOKEN to enable them'}), 404
+    if not hmac.compare_digest(get_bearer_token() or '', token):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return Metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# Response to a chat shed by admission control
+def too_many_requests(retry_after):
+    return jsonify({'error': 'Too many requests, please try again later'}), 429, {'Retry-After': str(math.ceil(retry_after))}
+
+# Content fields served by the assistant detail endpoints
+CONTENT_SUMMARY_FIELDS = ['id', 'file_type', 'fileUrl', 'title', 'topics', 'keywords', 'short_summary']
+CONTENT_FIELDS = CONTENT_SUMMARY_FIELDS + ['long_summary', 'content', 'digests']
+
 # Sample route for testing
 @app.route('/')
 def home():
@@ -101,7 +212,7 @@ def create_channel():
     else:
         return jsonify({'error': 'Invalid channel name'}), 400
     
-    teacher = g.current_user
+    teacher = g.current_user.document
     profile['is_connected'] = True
     
     channel = Channel(
@@ -123,6 +234,7 @@ def create_channel():
         teacher.channels.instagram.append(channel)
 
     teacher.save()
+    ChannelRouter.refresh()
 
     return jsonify({'message': 'Channel created successfully', 'channel_id': channel.id})
         
@@ -153,7 +265,7 @@ def edit_channel():
     else:
         return jsonify({'error': 'Invalid channel name'}), 400
 
-    teacher = g.current_user
+    teacher = g.current_user.ref
     channel = Channel.objects(name=name, id=id, teacher=teacher).first()
     profile['is_connected'] = True
 
@@ -163,6 +275,9 @@ def edit_channel():
     channel.profile = profile
     channel.updated_at = datetime.now(UTC)
     channel.save()
+    Assistant.objects(connected_channels=channel.id).update(set__updated_at=channel.updated_at)
+
+    ChannelRouter.refresh()
 
     if name == "telegram":
         Utils.connect_tg_webhook(profile.get('username'), profile.get('access_key'), channel.id)
@@ -182,7 +297,7 @@ def create_assistant():
         return jsonify({'error': 'Subject and class name are required'}), 400
 
     assistant = Assistant(
-        teacher=g.current_user,
+        teacher=g.current_user.ref,
         subject=subject,
         class_name=class_name
     )
@@ -199,6 +314,8 @@ def create_assistant():
                 channel.save()
     assistant.created_at = datetime.now(UTC)
     assistant.save()
+    if assistant.connected_channels:
+        ChannelRouter.refresh()
 
     return jsonify({'message': 'Assistant created successfully', 'assistant_id': assistant.id})
 
@@ -212,18 +329,17 @@ def add_student_to_assistant():
     if not student_id or not assistant_id:
         return jsonify({'error': 'Student ID and assistant ID are required'}), 400
 
-    student = Student.objects(id=student_id).first()
-    assistant = Assistant.objects(id=assistant_id).first()
+    student = Student.objects(id=student_id).only('id').first()
+    assistant = Assistant.objects(id=assistant_id).only('id').first()
     
     if not student or not assistant:
         return jsonify({'error': 'Student or assistant not found'}), 404
 
-    if student in assistant.allowed_students:
+    # Decide from the database, the roster cache of another process may be stale
+    if not Assistant.objects(id=assistant.id, allowed_students__ne=student).update_one(add_to_set__allowed_students=student, set__updated_at=datetime.now(UTC)):
         return jsonify({'error': 'Student already in assistant'}), 400
-    assistant.allowed_students.append(student)
-    assistant.save()
-    student.allowed_assistants.append(assistant)
-    student.save()
+    Student.objects(id=student.id).update_one(add_to_set__allowed_assistants=assistant)
+    Membership.invalidate(assistant.id)
 
     return jsonify({'message': 'Student added to assistant successfully'})
 
@@ -237,26 +353,46 @@ def remove_student_from_assistant():
     if not student_id or not assistant_id:
         return jsonify({'error': 'Student ID and assistant ID are required'}), 400
 
-    student = Student.objects(id=student_id).first()
-    assistant = Assistant.objects(id=assistant_id).first()
+    student = Student.objects(id=student_id).only('id').first()
+    assistant = Assistant.objects(id=assistant_id).only('id').first()
     
     if not student or not assistant:
         return jsonify({'error': 'Student or assistant not found'}), 404
 
-    if student in assistant.allowed_students:
-        assistant.allowed_students.remove(student)
-        assistant.save()
-    if assistant in student.allowed_assistants:
-        student.allowed_assistants.remove(assistant)
-        student.save()
+    Assistant.objects(id=assistant.id, allowed_students=student).update_one(pull__allowed_students=student, set__updated_at=datetime.now(UTC))
+    Student.objects(id=student.id).update_one(pull__allowed_assistants=assistant)
+    Membership.invalidate(assistant.id)
 
     return jsonify({'message': 'Student removed from assistant successfully'})
 
+# Bulk upsert students and enroll them into assistants, from CSV, NDJSON or a JSON array
+@app.route('/bulk_import_students', methods=['POST'])
+@token_required_teacher
+def bulk_import_students():
+    if 'file' in request.files:
+        rows = csv.DictReader(io.TextIOWrapper(request.files['file'].stream, encoding='utf-8-sig'))
+    elif request.mimetype == 'text/csv':
+        rows = csv.DictReader(io.TextIOWrapper(request.stream, encoding='utf-8-sig'))
+    elif request.mimetype == 'application/x-ndjson':
+        rows = (json.loads(line) for line in request.stream if line.strip())
+    else:
+        data = request.get_json(silent=True)
+        rows = data.get('students') if isinstance(data, dict) else data
+        if not isinstance(rows, list):
+            return jsonify({'error': 'Expected a CSV file, NDJSON or a JSON list of students'}), 400
+
+    try:
+        report = StudentImporter.run(rows, g.current_user.id)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'error': f'Invalid import data: {e}'}), 400
+
+    return jsonify(report)
+
 # Route to get all assistants for a teacher
 @app.route('/get_assistants', methods=['GET'])
 @token_required_teacher
 def get_assistants():
-    assistants = Assistant.objects(teacher=g.current_user)
+    assistants = Assistant.objects(teacher=g.current_user.ref)
     assistants_list = [
         {
             'id': assistant.id,
@@ -275,6 +411,7 @@ def get_assistants():
 # Endpoint to digest content
 @app.route('/digest', methods=['POST'])
 @token_required_teacher
+@Profiler.profile('digest')
 def digest():
     data = request.json
     fileUrl = data.get('fileUrl')
@@ -286,14 +423,17 @@ def digest():
     file_type = Utils.get_file_type(fileUrl)
 
     try:
+        with Metrics.span('mongo.load_assistant'):
+            assistant = Assistant.objects(id=assistant_id).first()
+        if not assistant:
+            return jsonify({'error': 'Invalid assistant_id'}), 400
+            Metrics.set_labels(assistant=assistant.id)
+
         text_content = Utils.extract_text(fileUrl, file_type)
-        assistant = Assistant.objects(id=assistant_id).first()
 
         short_summary = Utils.get_summary(text_content, 100)
         long_summary = Utils.get_summary(text_content, 500)
-        print("##### SUMMARIES DONE #####")
         metadata = Utils.get_metadata(long_summary)
-        print("##### METADATA DONE #####")
 
         content = Content(
             file_type=file_type,
@@ -307,7 +447,6 @@ def digest():
         )
         
         chunks = Utils.create_chunks(text_content)
-        print("##### CHUNKS DONE #####")
         for chunk in chunks:
             chunk_metadata = Utils.get_metadata(chunk)
             digested_content = DigestedContent(
@@ -322,20 +461,26 @@ def digest():
             content.digests.append(digested_content)
 
         content_type = data.get('content_type')
-        if content_type == 'own':
-            assistant.own_content.append(content)
-            o_or_s_label = 'own'
-        else:
-            assistant.supporting_content.append(content)
-            o_or_s_label = 'supported'
-
-        assistant.save()
+        o_or_s_label = 'own' if content_type == 'own' else 'supported'
 
-        # Process and upload embeddings
+        # Process and upload embeddings before the save bumps content_version, so answers cached
+        # under the new version are built with the new content searchable
         content_id = content.id
         for digest in content.digests:
             digest_id = digest.id
             Utils.process_and_upload_embeddings(assistant_id, content_id, digest_id, digest, o_or_s_label)
+        Utils.upload_question_embeddings(assistant_id, content_id, content.digests, o_or_s_label)
+
+        if content_type == 'own':
+            assistant.own_content.append(content)
+        else:
+            assistant.supporting_content.append(content)
+
+        previous_version = assistant.content_version
+        assistant.touch_content()
+        with Metrics.span('mongo.save_assistant'):
+            assistant.save()
+        KeywordIndex.add_content(assistant.id, o_or_s_label, content, previous_version, assistant.content_version)
 
         return jsonify({
             'message': f'Processed {file_type} file',
@@ -344,14 +489,69 @@ def digest():
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
+# Parse `view`/`fields` query args into the Content fields to return (None means everything)
+def parse_content_fields():
+    fields = request.args.get('fields')
+    if fields:
+        selected = [field.strip() for field in fields.split(',') if field.strip()]
+        invalid = [field for field in selected if field not in CONTENT_FIELDS]
+        if invalid:
+            raise ValueError(f"Unknown content fields: {', '.join(invalid)}")
+        return ['id'] + [field for field in selected if field != 'id']
+    if request.args.get('view') == 'summary':
+        return CONTENT_SUMMARY_FIELDS
+    return None
+
+# Exclude unselected Content fields at the database so large bodies are never loaded
+def project_contents(queryset, fields):
+    if fields is None:
+        return queryset
+    excluded = [field for field in CONTENT_FIELDS if field not in fields]
+    return queryset.exclude(*[f'{prefix}.{field}' for prefix in ('own_content', 'supporting_content') for field in excluded])
+
+def serialize_content(content, fields):
+    data = content.to_mongo().to_dict()
+    if fields is None:
+        return data
+    keys = {'_id' if field == 'id' else field for field in fields}
+    return {key: value for key, value in data.items() if key in keys}
+
+# ETag of an assistant detail response, changes whenever the assistant is saved
+def assistant_etag(assistant_id, updated_at, fields):
+    stamp = updated_at.isoformat() if updated_at else ''
+    view = ','.join(fields) if fields is not None else 'full'
+    return hashlib.md5(f'{assistant_id}:{stamp}:{view}'.encode()).hexdigest()
+
+def not_modified(etag):
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
 # Route to get an assistant by ID
 @app.route('/get_assistant/<assistant_id>', methods=['GET'])
 @token_required_teacher
 def get_assistant(assistant_id):
-    assistant = Assistant.objects(id=assistant_id, teacher=g.current_user).first()
+    try:
+        fields = parse_content_fields()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    assistants = Assistant.objects(id=assistant_id, teacher=g.current_user.ref)
+    stamp = assistants.only('updated_at').as_pymongo().first()
+    if not stamp:
+        return jsonify({'error': 'Assistant not found'}), 404
+
+    etag = assistant_etag(assistant_id, stamp.get('updated_at'), fields)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    assistant = project_contents(assistants.no_dereference(), fields).first()
     if not assistant:
         return jsonify({'error': 'Assistant not found'}), 404
 
+    channel_ids = [channel.id for channel in assistant.connected_channels]
+    channels = Channel.objects(id__in=channel_ids).only('id', 'name', 'profile') if channel_ids else []
+
     assistant_data = {
         'id': assistant.id,
         'subject': assistant.subject,
@@ -360,24 +560,39 @@ def get_assistant(assistant_id):
         'about': assistant.about,
         'created_at': assistant.created_at,
         'updated_at': assistant.updated_at,
-        'own_content': [content.to_mongo().to_dict() for content in assistant.own_content],
-        'supporting_content': [content.to_mongo().to_dict() for content in assistant.supporting_content],
-        'connected_channels': [{'id': channel.id, 'name': channel.name, 'profile': channel.profile} for channel in assistant.connected_channels],
+        'own_content': [serialize_content(content, fields) for content in assistant.own_content],
+        'supporting_content': [serialize_content(content, fields) for content in assistant.supporting_content],
+        'connected_channels': [{'id': channel.id, 'name': channel.name, 'profile': channel.profile} for channel in channels],
         'allowed_students': [str(student.id) for student in assistant.allowed_students]
     }
 
-    return jsonify({'assistant': assistant_data})
+    response = jsonify({'assistant': assistant_data})
+    response.set_etag(etag)
+    return response
 
 @app.route('/get_student_assistant/<assistant_id>', methods=['GET'])
 @token_required_student
 def get_student_assistant(assistant_id):
-    assistant = Assistant.objects(id=assistant_id).first()
-    student = Student.objects(id=g.current_user.id).first()
-    
+    try:
+        fields = parse_content_fields()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    assistants = Assistant.objects(id=assistant_id, allowed_students=g.current_user.id)
+    stamp = assistants.only('updated_at').as_pymongo().first()
+    if not stamp:
+        if not Assistant.objects(id=assistant_id).only('id').first():
+            return jsonify({'error': 'Assistant not found'}), 404
+        return jsonify({'error': 'You are not allowed to access this assistant'}), 403
+
+    etag = assistant_etag(assistant_id, stamp.get('updated_at'), fields)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    assistant = project_contents(assistants.no_dereference().exclude('allowed_students'), fields).first()
     if not assistant:
         return jsonify({'error': 'Assistant not found'}), 404
-    if student not in assistant.allowed_students:
-        return jsonify({'error': 'You are not allowed to access this assistant'}), 403
+    teacher = Teacher.objects(id=assistant.teacher.id).only('name').first()
 
     assistant_data = {
         'id': assistant.id,
@@ -387,11 +602,13 @@ def get_student_assistant(assistant_id):
         'about': assistant.about,
         'created_at': assistant.created_at,
         'updated_at': assistant.updated_at,
-        'teacher': assistant.teacher.name,
-        'own_content': [content.to_mongo().to_dict() for content in assistant.own_content],
-        'supporting_content': [content.to_mongo().to_dict() for content in assistant.supporting_content],
+        'teacher': teacher.name if teacher else None,
+        'own_content': [serialize_content(content, fields) for content in assistant.own_content],
+        'supporting_content': [serialize_content(content, fields) for content in assistant.supporting_content],
     }
-    return jsonify(assistant_data)
+    response = jsonify(assistant_data)
+    response.set_etag(etag)
+    return response
 
 # Route for student verification
 @app.route('/verify-student', methods=['POST'])
@@ -433,8 +650,6 @@ def verify_student():
 # Fetch original content from MongoDB
 def fetch_content(match, content_type, assistant):
     content_id, digest_id = match['content_id_digest_id'].split('__')
-    print(content_id, digest_id)
-    # print(assistant.own_content, assistant.supporting_content)
     if content_type == 'own':
         content = next((c for c in assistant.own_content if c.id == content_id), None)
     else:
@@ -444,10 +659,59 @@ def fetch_content(match, content_type, assistant):
         digest = next((d for d in content.digests if str(d.id) == digest_id), None)
     else:
         digest = None
-    
-    print("##### FETCHED CONTENT #####")
+
     return content, digest
 
+# Load only the requested Content entries of an assistant instead of the whole document
+def load_contents(assistant_id, content_type, content_ids):
+    field = 'own_content' if content_type == 'own' else 'supporting_content'
+    pipeline = [{
+        '$project': {
+            'items': {
+                '$filter': {
+                    'input': {'$ifNull': [f'${field}', []]},
+                    'as': 'item',
+                    'cond': {'$in': ['$$item._id', list(content_ids)]}
+                }
+            }
+        }
+    }]
+    result = next(iter(Assistant.objects(id=assistant_id).aggregate(pipeline)), None)
+    if not result:
+        return {}
+    contents = [Content._from_son(item) for item in result.get('items') or []]
+    return {content.id: content for content in contents}
+
+# Resolve up to `limit` stored references to (content, digest, reference) tuples with a single query
+def resolve_references(assistant_id, content_type, references, limit):
+    references = references[:limit]
+    if not references:
+        return []
+    keys = [ref['content_id_digest_id'].split('__') for ref in references]
+    contents = load_contents(assistant_id, content_type, {content_id for content_id, _ in keys})
+
+    resolved = []
+    for (content_id, digest_id), ref in zip(keys, references):
+        content = contents.get(content_id)
+        if not content:
+            continue
+        digest = next((d for d in content.digests if str(d.id) == digest_id), None)
+        if digest:
+            resolved.append((content, digest, ref))
+    return resolved
+
+# Compact reference record returned to clients; bodies are fetched through /get_reference
+def serialize_reference(content, digest, match):
+    return {
+        'content_id': content.id,
+        'digest_id': str(digest.id),
+        'title': digest.title or content.title,
+        'content_title': content.title,
+        'score': match.get('weighted_score'),
+        'fileUrl': content.fileUrl,
+        'snippet': digest.short_summary or (digest.content or '')[:REFERENCE_SNIPPET_LENGTH]
+    }
+
 # Protected route for students
 @app.route('/chat', methods=['POST'])
 @token_required_student
@@ -460,23 +724,34 @@ def chat():
     if not assistant_id or not user_message:
         return jsonify({'error': 'assistant_id and message are required'}), 400
 
+    retry_after = Admission.admit(f'student:{g.current_user.id}', assistant_id)
+    if retry_after:
+        return too_many_requests(retry_after)
+    try:
+        return answer_chat(assistant_id, conversation_id, user_message)
+    finally:
+        Admission.leave(assistant_id)
+
+def answer_chat(assistant_id, conversation_id, user_message):
+    with Metrics.span('mongo.load_assistant'):
+        assistant = Assistant.objects(id=assistant_id).first()
+    if not assistant:
+        return jsonify({'error': 'Invalid assistant_id'}), 400
+    # Only ids of stored assistants become label values, metric series are never evicted
+    Metrics.set_labels(assistant=assistant.id)
+
     # Create a new conversation if conversation_id is not provided
     if not conversation_id:
-        conversation = Conversation(
-            student=g.current_user,
-            assistant=Assistant.objects(id=assistant_id).first()
-        )
-        conversation.save()
+        with Metrics.span('mongo.save_conversation'):
+            conversation = Conversation(student=g.current_user.ref, assistant=assistant)
+            conversation.save()
         conversation_id = conversation.id
     else:
-        conversation = Conversation.objects(id=conversation_id).first()
+        with Metrics.span('mongo.load_conversation'):
+            conversation = Conversation.objects(id=conversation_id).first()
         if not conversation:
             return jsonify({'error': 'Invalid conversation_id'}), 400
 
-    assistant = Assistant.objects(id=assistant_id).first()
-    if not assistant:
-        return jsonify({'error': 'Invalid assistant_id'}), 400
-    
     response, ranked_own_content, ranked_supported_content = process_chat(user_message, assistant, conversation)
     return jsonify({
         'message': response,
@@ -487,6 +762,7 @@ def chat():
         'conversation_id': conversation_id
     })
 
+@Profiler.profile('chat')
 def process_chat(user_message, assistant, conversation):
     # Extract metadata from the current message using Utils
     metadata = Utils.extract_chat_metadata(user_message)
@@ -506,175 +782,265 @@ def process_chat(user_message, assistant, conversation):
 
     # Add user message to conversation
     conversation.messages.append(Message(sender='user', content=user_msg))
+    if not conversation.title and title:
+        conversation.title = title
     # conversation.save()
 
-    print("##### METADATA DONE #####")
-    print(refined_question, topics, title, keywords)
     if not refined_question or not topics or not title or not keywords:
-        conversation.conversation_summary = "Hello! I'm your AI assistant for your teacher. How can I help you today?"
-        conversation.save()
-        return "Hello! I'm your AI assistant for your teacher. How can I help you today?", [], []
+        conversation.conversation_summary = FALLBACK_REPLY
+        with Metrics.span('mongo.save_conversation'):
+            conversation.save()
+        return FALLBACK_REPLY, [], []
     # Get embeddings for the metadata
     refined_question_embedding = Utils.get_embeddings(refined_question)
-    topics_embedding = Utils.get_embeddings(", ".join(topics))
-    title_embedding = Utils.get_embeddings(title)
-    keywords_embedding = Utils.get_embeddings(", ".join(keywords))
-    print("##### EMBEDDINGS DONE #####")
+
+    # A near-duplicate of an earlier question about unchanged content reuses its answer
+    cacheable = history_independent(conversation)
+    cached = cacheable and AnswerCache.lookup(assistant.id, assistant.content_version, refined_question_embedding)
+    if cached:
+        response, ranked_own_matches, ranked_supported_matches, ranked_own_content, ranked_supported_content = copy.deepcopy(cached)
+    else:
+        answer = answer_question(user_message, metadata, refined_question_embedding, assistant, conversation)
+        if cacheable:
+            AnswerCache.store(assistant.id, assistant.content_version, refined_question_embedding, copy.deepcopy(answer))
+        response, ranked_own_matches, ranked_supported_matches, ranked_own_content, ranked_supported_content = answer
+
+    # Add assistant message to conversation
+    assistant_msg = AssistantMessage(message=response, references=References(
+        own=ranked_own_matches,
+        supporting=ranked_supported_matches
+    ))
+    conversation.messages.append(Message(sender='assistant', content=assistant_msg))
+
+    # Update conversation summary
+    new_summary = Utils.update_conversation_summary(conversation.conversation_summary or "", user_message, response)
+    conversation.conversation_summary = new_summary
+    with Metrics.span('mongo.save_conversation'):
+        conversation.save()
+
+    return response, ranked_own_content, ranked_supported_content
+
+# Only the opening question of a conversation is answered without history or summary in the prompt,
+# so only its answer can be shared with other conversations
+def history_independent(conversation):
+    return len(conversation.messages) <= 1 and not conversation.conversation_summary
+
+# Matches on generated digest questions close enough to answer from alone, None when there are none.
+# Hits on digests the assistant no longer has (vectors left behind by a deletion) are ignored.
+def faq_hits(faq_matches, assistant):
+    def live(matches, content_type):
+        return [
+            match for match in matches
+            if match['weighted_score'] >= FAQ_MATCH_THRESHOLD and all(fetch_content(match, content_type, assistant))
+        ]
+
+    faq_own = live(faq_matches['own'], 'own')
+    faq_supported = live(faq_matches['supported'], 'supported')
+    return (faq_own, faq_supported) if faq_own or faq_supported else None
+
+# Topics and keywords are matched against the in-process BM25 index instead of embedded
+def keyword_matches(metadata, assistant):
+    keyword_query = ' '.join([metadata['RefinedQuestion'], metadata['Title'], ' '.join(metadata['Topics']), ' '.join(metadata['Keywords'])])
+    with Metrics.span('keyword_search'):
+        return KeywordIndex.search(assistant, 'own', keyword_query), KeywordIndex.search(assistant, 'supported', keyword_query)
+
+# Ranked (own, supported) matches for a question
+def retrieve_matches(metadata, refined_question_embedding, assistant):
+    # A close match on a generated digest question answers from those digests with a single query
+    faq = faq_hits(Utils.query_faq(assistant.id, refined_question_embedding), assistant)
+    if faq:
+        return faq
+
+    title_embedding = Utils.get_embeddings(metadata['Title'])
+    own_keyword_matches, supported_keyword_matches = keyword_matches(metadata, assistant)
 
     # Query Pinecone for matches
     own_matches = {
         'title': Utils.query_pinecone(assistant.id, title_embedding, 'own', 'title'),
-        'topics': Utils.query_pinecone(assistant.id, topics_embedding, 'own', 'topics'),
-        'keywords': Utils.query_pinecone(assistant.id, keywords_embedding, 'own', 'keywords'),
-        'content': Utils.query_pinecone(assistant.id, refined_question_embedding, 'own', 'text')
+        'content': Utils.query_pinecone(assistant.id, refined_question_embedding, 'own', 'text', include_values=True),
+        'bm25': own_keyword_matches
     }
     supported_matches = {
         'title': Utils.query_pinecone(assistant.id, title_embedding, 'supported', 'title'),
-        'topics': Utils.query_pinecone(assistant.id, topics_embedding, 'supported', 'topics'),
-        'keywords': Utils.query_pinecone(assistant.id, keywords_embedding, 'supported', 'keywords'),
-        'content': Utils.query_pinecone(assistant.id, refined_question_embedding, 'supported', 'text')
+        'content': Utils.query_pinecone(assistant.id, refined_question_embedding, 'supported', 'text', include_values=True),
+        'bm25': supported_keyword_matches
     }
-    print("##### PINECONE DONE #####")
-
-    # Rank matches
-    ranked_own_matches = Utils.rank_pinecone_matches(own_matches)
-    ranked_supported_matches = Utils.rank_pinecone_matches(supported_matches)
 
-    
+    # Rank matches with the assistant's ranking settings
+    return Utils.rank_pinecone_matches(own_matches, assistant.ranking), Utils.rank_pinecone_matches(supported_matches, assistant.ranking)
 
-    own_context = []
-    for i, match in enumerate(ranked_own_matches):
+# Resolve the top matches and render them and the recent history within the token budgets
+def prompt_inputs(ranked_own_matches, ranked_supported_matches, assistant, conversation):
+    own_candidates = []
+    for match in ranked_own_matches[:MAX_CONTEXT_ITEMS]:
         content, digest = fetch_content(match, 'own', assistant)
-        if i < 2:
-            own_context.append({
-                'digest_text': digest.content or "",
-                'parent_long_summary': content.long_summary or ""
-            })
-        elif i < 5:
-            own_context.append({
-                'digest_long_summary': digest.long_summary or "",
-                'parent_short_summary': content.short_summary or ""
-            })
-
-    supported_context = []
-    for i, match in enumerate(ranked_supported_matches):
-        content, digest = fetch_content(match, 'supported', assistant)
-        if i < 2:
-            supported_context.append({
-                'digest_long_summary': digest.long_summary,
-                'parent_short_summary': content.short_summary
-            })
-        elif i < 4:
-            supported_context.append({
-                'digest_short_summary': digest.short_summary,
-                'parent_title': content.title,
-                'parent_topics': content.topics
-            })
+        if content and digest:
+            own_candidates.append((content, digest))
 
-    # Generate a response using OpenAI with context
-    last_two_messages = conversation.messages[-2:] if len(conversation.messages) > 1 else []
-    # print(last_two_messages, own_context, supported_context)
-    response = Utils.generate_chat_response(user_message, conversation.conversation_summary, last_two_messages, own_context, supported_context)
-    print("##### RESPONSE DONE #####")
-    print(response)
-    # Add assistant message to conversation
-    assistant_msg = AssistantMessage(message=response, references=References(
-        own=ranked_own_matches,
-        supporting=ranked_supported_matches
-    ))
-    conversation.messages.append(Message(sender='assistant', content=assistant_msg))
-    # conversation.save()
+    supported_candidates = []
+    for match in ranked_supported_matches[:MAX_CONTEXT_ITEMS]:
+        content, digest = fetch_content(match, 'supported', assistant)
+        if content and digest:
+            supported_candidates.append((content, digest))
 
-    # Update conversation summary
-    new_summary = Utils.update_conversation_summary(conversation.conversation_summary or "", user_message, response)
-    conversation.conversation_summary = new_summary
-    conversation.save()
+    history = PromptBuilder.render_history(conversation.messages[:-1][-HISTORY_MESSAGES:])
+    return history, PromptBuilder.build_context(own_candidates, supported_candidates)
 
+def serialize_ranked_references(ranked_own_matches, ranked_supported_matches, assistant):
     ranked_own_content = [
-        {
-            'content': content.to_mongo().to_dict(),
-            'digest': digest.to_mongo().to_dict()
-        }
-        for content, digest in (fetch_content(match, 'own', assistant) for match in ranked_own_matches) if content
+        serialize_reference(content, digest, match)
+        for match, (content, digest) in ((match, fetch_content(match, 'own', assistant)) for match in ranked_own_matches)
+        if content and digest
     ]
     ranked_supported_content = [
-        {
-            'content': content.to_mongo().to_dict(),
-            'digest': digest.to_mongo().to_dict()
-        }
-        for content, digest in (fetch_content(match, 'supported', assistant) for match in ranked_supported_matches) if content
+        serialize_reference(content, digest, match)
+        for match, (content, digest) in ((match, fetch_content(match, 'supported', assistant)) for match in ranked_supported_matches)
+        if content and digest
     ]
-    return response, ranked_own_content, ranked_supported_content
+    return ranked_own_content, ranked_supported_content
+
+# Retrieve and rank context for a question and generate the answer with its references
+def answer_question(user_message, metadata, refined_question_embedding, assistant, conversation):
+    ranked_own_matches, ranked_supported_matches = retrieve_matches(metadata, refined_question_embedding, assistant)
+
+    # Generate a response using OpenAI with context
+    history, context = prompt_inputs(ranked_own_matches, ranked_supported_matches, assistant, conversation)
+    response = Utils.generate_chat_response(user_message, conversation.conversation_summary, history, context)
+
+    ranked_own_content, ranked_supported_content = serialize_ranked_references(ranked_own_matches, ranked_supported_matches, assistant)
+    return response, ranked_own_matches, ranked_supported_matches, ranked_own_content, ranked_supported_content
 
 @app.route('/get_student_assistants', methods=['GET'])
 @token_required_student
 def get_student_assistants():
-    assistants = g.current_user.allowed_assistants
-    assistants_list = [{'id': assistant.id, 'subject': assistant.subject, 'class_name': assistant.class_name, 'teacher': assistant.teacher.name, 'profile_picture': assistant.profile_picture, 'about': assistant.about} for assistant in assistants]
+    assistants = list(
+        Assistant.objects(allowed_students=g.current_user.id)
+        .only('id', 'subject', 'class_name', 'teacher', 'profile_picture', 'about')
+        .no_dereference()
+    )
+    # Resolve all teacher names with a single $in query
+    teacher_ids = list({assistant.teacher.id for assistant in assistants})
+    teachers = {teacher.id: teacher.name for teacher in Teacher.objects(id__in=teacher_ids).only('name')} if teacher_ids else {}
+    assistants_list = [{'id': assistant.id, 'subject': assistant.subject, 'class_name': assistant.class_name, 'teacher': teachers.get(assistant.teacher.id), 'profile_picture': assistant.profile_picture, 'about': assistant.about} for assistant in assistants]
     return jsonify({'assistants': assistants_list})
 
 @app.route('/get_conversations/<assistant_id>', methods=['GET'])
 @token_required_student
 def get_conversations(assistant_id):
-    conversations = Conversation.objects(student=g.current_user, assistant=assistant_id)
+    conversations = list(Conversation.objects(student=g.current_user.ref, assistant=assistant_id).only('id', 'title'))
+
+    # Conversations created before titles were stored get theirs from the first message, once
+    untitled = [conversation.id for conversation in conversations if not conversation.title]
+    titles = {}
+    if untitled:
+        for conversation in Conversation.objects(id__in=untitled).no_dereference().fields(slice__messages=[0, 1]):
+            title = conversation.messages[0].content.title if conversation.messages else None
+            if title:
+                titles[conversation.id] = title
+                Conversation.objects(id=conversation.id).update_one(set__title=title)
+
     conversation_list = [
         {
             'id': conversation.id,
-            'title': conversation.title or conversation.messages[0].content.title or "Untitled Conversation"
+            'title': conversation.title or titles.get(conversation.id) or "Untitled Conversation"
         }
         for conversation in conversations
     ]
     return jsonify({'conversations': conversation_list})
 
+def serialize_message(message, index):
+    references = None
+    if message.sender == 'assistant' and message.content.references:
+        references = message.content.references.to_mongo().to_dict()
+    return {
+        'index': index,
+        'sender': message.sender,
+        'content': message.content.message,
+        'references': references
+    }
+
 @app.route('/get_conversation/<conversation_id>', methods=['GET'])
 @token_required_student
 def get_conversation(conversation_id):
-    conversation = Conversation.objects(id=conversation_id, student=g.current_user).first()
-    if not conversation:
+    try:
+        limit = min(max(int(request.args.get('limit', DEFAULT_MESSAGES_PAGE_SIZE)), 1), MAX_MESSAGES_PAGE_SIZE)
+        before = request.args.get('before')
+        before = int(before) if before is not None else None
+    except ValueError:
+        return jsonify({'error': 'before and limit must be integers'}), 400
+
+    conversations = Conversation.objects(id=conversation_id, student=g.current_user.ref)
+    stats = next(iter(conversations.aggregate([
+        {'$project': {'message_count': {'$size': {'$ifNull': ['$messages', []]}}}}
+    ])), None)
+    if not stats:
         return jsonify({'error': 'Conversation not found'}), 404
 
-    messages = [
-        {
-            'sender': message.sender,
-            'content': message.content.message if message.sender == 'user' else message.content.message,
-            'references':  [ref for ref in message.content.references] if message.sender == 'assistant' else None
-        }
-        for message in conversation.messages
-    ]
-
-    # Find the last assistant message
-    last_assistant_message = (next((msg for msg in reversed(conversation.messages) if msg.sender == 'assistant'), None)).to_mongo().to_dict()
-
-    # Fetch the content for the references
-    ranked_own_content = [
-        {
-            'content': content.to_mongo().to_dict(),
-            'digest': digest.to_mongo().to_dict()
-        }
-        for content, digest in (fetch_content(match, 'own', conversation.assistant) for match in last_assistant_message['content']['references']['own'])
-    ] if last_assistant_message else []
+    # `before` is the index of the oldest message already shown; only that window is loaded
+    message_count = stats['message_count']
+    end = message_count if before is None else min(max(before, 0), message_count)
+    start = max(end - limit, 0)
+    conversation = conversations.no_dereference().fields(slice__messages=[start, end - start]).first() if end > start else None
+    page = conversation.messages if conversation else []
+
+    messages = [serialize_message(message, start + i) for i, message in enumerate(page)]
+
+    # Resolve references of the last assistant message on this page only
+    last_assistant_message = next((msg for msg in reversed(page) if msg.sender == 'assistant'), None)
+    ranked_own_content, ranked_supported_content = [], []
+    if last_assistant_message and last_assistant_message.content.references:
+        references = last_assistant_message.content.references.to_mongo().to_dict()
+        assistant_id = conversation.assistant.id
+        ranked_own_content = [
+            serialize_reference(content, digest, match)
+            for content, digest, match in resolve_references(assistant_id, 'own', references.get('own', []), MAX_RESOLVED_REFERENCES)
+        ]
+        ranked_supported_content = [
+            serialize_reference(content, digest, match)
+            for content, digest, match in resolve_references(assistant_id, 'supported', references.get('supporting', []), MAX_RESOLVED_REFERENCES)
+        ]
 
-    ranked_supported_content = [
-        {
-            'content': content.to_mongo().to_dict(),
-            'digest': digest.to_mongo().to_dict()
-        }
-        for content, digest in (fetch_content(match, 'supported', conversation.assistant) for match in last_assistant_message['content']['references']['supporting'])
-    ] if last_assistant_message else []
-    
     return jsonify({
         'messages': messages,
         'references': {
             'own': ranked_own_content,
             'supported': ranked_supported_content
-        }
+        },
+        'message_count': message_count,
+        'next_cursor': start if start > 0 else None
+    })
+
+# Lazily fetch the body of a single reference of a conversation
+@app.route('/get_reference/<conversation_id>', methods=['GET'])
+@token_required_student
+def get_reference(conversation_id):
+    ref = request.args.get('ref')
+    content_type = request.args.get('type', 'own')
+    if not ref or len(ref.split('__')) != 2:
+        return jsonify({'error': 'ref must be <content_id>__<digest_id>'}), 400
+
+    conversation = Conversation.objects(id=conversation_id, student=g.current_user.ref).no_dereference().only('assistant').first()
+    if not conversation:
+        return jsonify({'error': 'Conversation not found'}), 404
+
+    resolved = resolve_references(conversation.assistant.id, content_type, [{'content_id_digest_id': ref}], 1)
+    if not resolved:
+        return jsonify({'error': 'Reference not found'}), 404
+
+    # The parent body is sent without its digests so each digest is only ever sent once
+    content, digest, _ = resolved[0]
+    content_data = content.to_mongo().to_dict()
+    content_data.pop('digests', None)
+    return jsonify({
+        'content': content_data,
+        'digest': digest.to_mongo().to_dict()
     })
 
 # Route to get teacher info
 @app.route('/get_teacher_info', methods=['GET'])
 @token_required_teacher
 def get_teacher_info():
-    teacher = g.current_user
+    teacher = g.current_user.document
     teacher_info = {
         'name': teacher.name,
         'profile_picture': teacher.profile_picture,
@@ -702,7 +1068,7 @@ def get_teacher_info():
 @app.route('/get_student_info', methods=['GET'])
 @token_required_student
 def get_student_info():
-    student = g.current_user
+    student = g.current_user.document
     student_info = {
         'id': student.id,
         'name': student.name,
@@ -724,8 +1090,14 @@ def edit_assistant(assistant_id):
     about = data.get('about')
     profile_picture = data.get('profile_picture')
     connected_channels = data.get('connected_channels')
+    ranking = data.get('ranking')
 
-    assistant = Assistant.objects(id=assistant_id, teacher=g.current_user).first()
+    if ranking is not None:
+        error = Utils.validate_ranking(ranking)
+        if error:
+            return jsonify({'error': error}), 400
+
+    assistant = Assistant.objects(id=assistant_id, teacher=g.current_user.ref).first()
     if not assistant:
         return jsonify({'error': 'Assistant not found'}), 404
 
@@ -737,6 +1109,9 @@ def edit_assistant(assistant_id):
         assistant.about = about
     if profile_picture:
         assistant.profile_picture = profile_picture
+    if ranking is not None:
+        assistant.ranking = ranking
+        assistant.touch_content()
     assistant.connected_channels = []
     if connected_channels:
         print(connected_channels)
@@ -750,6 +1125,7 @@ def edit_assistant(assistant_id):
             
 
     assistant.save()
+    ChannelRouter.refresh()
     return jsonify({'message': 'Assistant updated successfully'})
 
 @app.route('/delete_file', methods=['POST'])
@@ -777,10 +1153,51 @@ def delete_file():
         return jsonify({'error': 'Content not found'}), 404
 
     content_list.remove(content_to_delete)
+    assistant.touch_content()
     assistant.save()
 
+    # Remove its vectors so retrieval and FAQ matching stop returning the deleted digests
+    try:
+        Utils.delete_content_vectors(assistant.id, content_to_delete, 'own' if content_type == 'own' else 'supported')
+    except Exception as e:
+        print(f"Error deleting vectors of content {content_id}: {e}")
+
     return jsonify({'message': 'Content deleted successfully'})
 
+# Build the channel reply for an answer and its references
+def format_channel_reply(res_message, ranked_own_content, ranked_supported_content):
+    if not ranked_own_content and not ranked_supported_content:
+        return res_message or "Sorry, I'm not able to answer that."
+    reply = '*Answer :* ' + res_message + '\n\n*Teacher References :* \n'
+    for content in ranked_own_content[:4]:
+        reply += f'{content.get("fileUrl")}\n'
+    reply += '\n\n*Supporting References :* \n'
+    for content in ranked_supported_content[:4]:
+        reply += f'{content.get("fileUrl")}\n'
+    return reply
+
+# Flatten a (possibly batched) WhatsApp webhook payload into its inbound text messages
+def extract_wa_messages(data):
+    inbound = []
+    for entry in data.get('entry') or []:
+        for change in entry.get('changes') or []:
+            value = change.get('value') or {}
+            metadata = value.get('metadata') or {}
+            names = {contact.get('wa_id'): (contact.get('profile') or {}).get('name') for contact in value.get('contacts') or []}
+            for message in value.get('messages') or []:
+                text = (message.get('text') or {}).get('body')
+                if not text or not message.get('from') or not metadata.get('phone_number_id'):
+                    continue
+                inbound.append({
+                    'message_id': message.get('id'),
+                    'display_phone_number': metadata.get('display_phone_number'),
+                    'phone_number_id': metadata.get('phone_number_id'),
+                    'phone_number': message.get('from'),
+                    'user_name': names.get(message.get('from')),
+                    'message': text
+                })
+    return inbound
+
 @app.route('/wa-webhook/<wa_id>', methods=['GET', 'POST'])
 def wa_webhook(wa_id):
     try:
@@ -798,137 +1215,169 @@ def wa_webhook(wa_id):
             #     return challenge, 200
             # else:
             #     return 'Invalid token', 403
-            
-            data = request.json
-            # print(data)
-
-            if not data or not data.get('entry') or not data.get('entry')[0].get('changes') or not data.get('entry')[0].get('changes')[0].get('value') or not data.get('entry')[0].get('changes')[0].get('value').get('contacts') or not data.get('entry')[0].get('changes')[0].get('value').get('contacts')[0].get('profile') or not data.get('entry')[0].get('changes')[0].get('value').get('contacts')[0].get('profile').get('name') or not data.get('entry')[0].get('changes')[0].get('value').get('metadata') or not data.get('entry')[0].get('changes')[0].get('value').get('metadata').get('phone_number_id') or not data.get('entry')[0].get('changes')[0].get('value').get('messages') or not data.get('entry')[0].get('changes')[0].get('value').get('messages')[0].get('text'):
-                return 'ok', 200
-            
-            display_phone_number = data.get('entry')[0].get('changes')[0].get('value').get('metadata').get('display_phone_number')
-            print(display_phone_number)
-
-            channel = Channel.objects(name="whatsapp", profile__phone_number=display_phone_number).first()
-            assistant = channel.assistants[0] if channel and channel.assistants else None
-            if not assistant:
-                return 'ok', 200
-            
-
-            phone_number = data.get('entry')[0].get('changes')[0].get('value').get('contacts')[0].get('wa_id') or None
-            message = data.get('entry')[0].get('changes')[0].get('value').get('messages')[0].get('text').get('body') or None
-            print(phone_number, message)
-            student = Student.objects(wa_number=phone_number).first()
-            if not student:
-                print("Student not found")
-                return 'ok', 200
-            if not student in assistant.allowed_students or not assistant in student.allowed_assistants:
-                print("Student not allowed")
-                return 'ok', 200
-            
-            conversation = Conversation.objects(student=student, assistant=assistant).first()
-            if not conversation:
-                conversation = Conversation(student=student, assistant=assistant)
-                conversation.save()
 
-            # get user name
-            user_name = data.get('entry')[0].get('changes')[0].get('value').get('contacts')[0].get('profile').get('name') or None
-            print(user_name)
-
-            print("Here...")
-            
-            # Send a message to the user
-            sender_id = data.get('entry')[0].get('changes')[0].get('value').get('metadata').get('phone_number_id') or None
-            sender_access_token = channel.profile.get('access_token') if channel.profile.get('access_token') else None
-            if not sender_id or not sender_access_token:
-                print("Sender ID or Sender Access Token not found")
-                return 'ok', 200
-
-
-            print(sender_id, sender_access_token, phone_number, message)
-            res_message, ranked_own_content, ranked_supported_content = process_chat(message, assistant, conversation)
-            if ranked_own_content or ranked_supported_content:
-                reply = '*Answer :* ' + res_message + '\n\n*Teacher References :* \n'
-                for i, content in enumerate(ranked_own_content[:4]):
-                    reply += f'{content.get("content").get("fileUrl")}\n'
-                reply += '\n\n*Supporting References :* \n'
-                for i, content in enumerate(ranked_supported_content[:4]):
-                    reply += f'{content.get("content").get("fileUrl")}\n'
-            else:
-                reply = res_message or "Sorry, I'm not able to answer that."
-
-            if sender_id and sender_access_token and phone_number and message:
-                Utils.send_wa_message(sender_id, phone_number, reply, sender_access_token)
-                print("Message sent")
+            # Acknowledge immediately, the answer is sent from a worker once it is ready
+            data = request.get_json(silent=True) or {}
+            for inbound in extract_wa_messages(data):
+                route = ChannelRouter.whatsapp(inbound['phone_number_id'], inbound['display_phone_number'])
+                if not route:
+                    continue
+                inbound['route'] = route
+                dedup_channel = f"whatsapp:{inbound['phone_number_id']}"
+                if inbound['message_id'] and not IdempotencyStore.claim(dedup_channel, inbound['message_id']):
+                    continue
+                # Messages of one sender are answered in order, never concurrently on the same conversation
+                if not webhook_queue.submit_keyed(f"whatsapp:{inbound['phone_number_id']}:{inbound['phone_number']}", handle_wa_message, inbound):
+                    print("Webhook queue full")
+                    if inbound['message_id']:
+                        IdempotencyStore.release(dedup_channel, inbound['message_id'])
+                    return 'busy', 503
             return 'ok', 200
     except Exception as e:
         print(e)
         return 'ok', 200
-    
+
+# Admit a question from a resolved, enrolled student (call Admission.leave when answered).
+# A shed question gets a channel reply, once per streak when the student is over their rate.
+def admit_channel_message(student_id, assistant_id, reply):
+    key = f'student:{student_id}'
+    if Admission.throttle(key):
+        if Admission.should_notify(key):
+            reply(RATE_LIMITED_REPLY)
+        return False
+    if Admission.enter(assistant_id):
+        Admission.refund(key)
+        reply(BUSY_REPLY)
+        return False
+    return True
+
+def load_channel_chat(assistant_id, student_id):
+    """The assistant and the student's conversation with it (created if missing); (None, None) if the assistant is gone"""
+
+    with Metrics.span('mongo.load_assistant'):
+        assistant = Assistant.objects(id=assistant_id).first()
+    if not assistant:
+        return None, None
+    student = Student(id=student_id)
+    with Metrics.span('mongo.load_conversation'):
+        conversation = Conversation.objects(student=student, assistant=assistant).first()
+        if not conversation:
+            conversation = Conversation(student=student, assistant=assistant)
+            conversation.save()
+    return assistant, conversation
+
+@Profiler.profile('whatsapp')
+def handle_wa_message(inbound):
+    route = inbound['route']
+    Metrics.set_labels(assistant=route.assistant_id)
+    phone_number = inbound['phone_number']
+    message = inbound['message']
+
+    print(phone_number, message)
+    student_id = IdentityResolver.resolve('whatsapp', phone_number)
+    if not student_id:
+        print("Student not found")
+        return
+    if not Membership.is_allowed(route.assistant_id, student_id):
+        print("Student not allowed")
+        return
+
+    # Send a message to the user
+    sender_id = inbound['phone_number_id']
+    sender_access_token = route.access_token
+    if not sender_id or not sender_access_token:
+        print("Sender ID or Sender Access Token not found")
+        return
+    reply = lambda text: OutboundScheduler.whatsapp(sender_id, phone_number, text, sender_access_token)
+
+    # Shed before any document is loaded, so a flooding sender costs no Mongo round trips
+    if not admit_channel_message(student_id, route.assistant_id, reply):
+        return
+    try:
+        assistant, conversation = load_channel_chat(route.assistant_id, student_id)
+        if not assistant:
+            return
+        res_message, ranked_own_content, ranked_supported_content = process_chat(message, assistant, conversation)
+    finally:
+        Admission.leave(route.assistant_id)
+    reply(format_channel_reply(res_message, ranked_own_content, ranked_supported_content))
+
 @app.route('/telegram-webhook/<channel_id>', methods=['GET', 'POST'])
 def telegram_webhook(channel_id):
-    data = request.json
-    channel = Channel.objects(id=channel_id).first()
-    if not channel:
-        print("Channel not found")
+    data = request.get_json(silent=True) or {}
+    message = data.get('message') or {}
+    if not message.get('text') or not (message.get('from') or {}).get('username') or not (message.get('chat') or {}).get('id'):
         return 'ok', 200
-    assistant = channel.assistants[0] if channel.assistants else None
-    if not assistant:
-        print("Assistant not found")
+
+    route = ChannelRouter.telegram(channel_id)
+    if not route:
+        print("Channel or assistant not found")
         return 'ok', 200
-    student = Student.objects(tg_handle=data.get('message').get('from').get('username')).first()
-    if not student:
-        print("Student not found")
+
+    update_id = data.get('update_id')
+    dedup_channel = f'telegram:{channel_id}'
+    if update_id is not None and not IdempotencyStore.claim(dedup_channel, update_id):
         return 'ok', 200
-    if not student in assistant.allowed_students or not assistant in student.allowed_assistants:
+
+    # Acknowledge immediately, the answer is sent from a worker once it is ready
+    # Messages of one chat are answered in order, never concurrently on the same conversation
+    if not webhook_queue.submit_keyed(f"telegram:{channel_id}:{message['chat']['id']}", handle_tg_message, route, message):
+        print("Webhook queue full")
+        if update_id is not None:
+            IdempotencyStore.release(dedup_channel, update_id)
+        return 'busy', 503
+    return 'ok', 200
+
+@Profiler.profile('telegram')
+def handle_tg_message(route, data):
+    Metrics.set_labels(assistant=route.assistant_id)
+    student_id = IdentityResolver.resolve('telegram', data.get('from').get('username'))
+    if not student_id:
+        print("Student not found")
+        return
+    if not Membership.is_allowed(route.assistant_id, student_id):
         print("Student not allowed")
-        return 'ok', 200
-    
-    conversation = Conversation.objects(student=student, assistant=assistant).first()
-    if not conversation:
-        conversation = Conversation(student=student, assistant=assistant)
-        conversation.save()
-    
-    message = data.get('message').get('text')
-    chat_id = data.get('message').get('chat').get('id')
+        return
+
+    message = data.get('text')
+    chat_id = data.get('chat').get('id')
+    reply = lambda text: OutboundScheduler.telegram(route.access_token, chat_id, text)
     print(message)
     if message.startswith('/'):
-        command = message.split(' ')[0][1:]
-        if command == 'help':
-            reply = "Here are the commands you can use:\n\n/help - Show this message\n/start - Start a new conversation\n/stop - Stop the current conversation"
-            Utils.send_tg_message(channel.profile.get('access_key'), chat_id, reply)
-            return 'ok', 200
-        elif command == 'start':
-            conversation = Conversation(student=student, assistant=assistant)
-            conversation.save()
-            reply = "Welcome to " + assistant.teacher.name + "'s chat! How can I help you today?"
-            Utils.send_tg_message(channel.profile.get('access_key'), chat_id, reply)
-            return 'ok', 200
-        elif command == 'stop':
-            conversation.delete()
-            reply = "Conversation stopped. How can I help you today?"
-            Utils.send_tg_message(channel.profile.get('access_key'), chat_id, reply)
-            return 'ok', 200
-        else:
-            reply = "Sorry, I'm not able to answer that."
-            Utils.send_tg_message(channel.profile.get('access_key'), chat_id, reply)
-            return 'ok', 200
-    res_message, ranked_own_content, ranked_supported_content = process_chat(message, assistant, conversation)
-    print(res_message, ranked_own_content, ranked_supported_content)
-    
-    if ranked_own_content or ranked_supported_content:
-        reply = '*Answer :* ' + res_message + '\n\n*Teacher References :* \n'
-        for i, content in enumerate(ranked_own_content[:4]):
-            reply += f'{content.get("content").get("fileUrl")}\n'
-        reply += '\n\n*Supporting References :* \n'
-        for i, content in enumerate(ranked_supported_content[:4]):
-            reply += f'{content.get("content").get("fileUrl")}\n'
-    else:
-        reply = res_message or "Sorry, I'm not able to answer that."
+        handle_tg_command(route, student_id, message, reply)
+        return
 
-    if message:
-        Utils.send_tg_message(channel.profile.get('access_key'), chat_id, reply)
-        print("Message sent")
-    return 'ok', 200
+    # Commands are cheap, only questions count against the student's rate; they are shed
+    # before any document is loaded, so a flooding sender costs no Mongo round trips
+    if not admit_channel_message(student_id, route.assistant_id, reply):
+        return
+    try:
+        assistant, conversation = load_channel_chat(route.assistant_id, student_id)
+        if not assistant:
+            print("Assistant not found")
+            return
+        res_message, ranked_own_content, ranked_supported_content = process_chat(message, assistant, conversation)
+    finally:
+        Admission.leave(route.assistant_id)
+    reply(format_channel_reply(res_message, ranked_own_content, ranked_supported_content))
+
+def handle_tg_command(route, student_id, message, reply):
+    assistant, conversation = load_channel_chat(route.assistant_id, student_id)
+    if not assistant:
+        print("Assistant not found")
+        return
+    command = message.split(' ')[0][1:]
+    if command == 'help':
+        text = "Here are the commands you can use:\n\n/help - Show this message\n/start - Start a new conversation\n/stop - Stop the current conversation"
+    elif command == 'start':
+        Conversation(student=Student(id=student_id), assistant=assistant).save()
+        text = "Welcome to " + assistant.teacher.name + "'s chat! How can I help you today?"
+    elif command == 'stop':
+        conversation.delete()
+        text = "Conversation stopped. How can I help you today?"
+    else:
+        text = "Sorry, I'm not able to answer that."
+    reply(text)
 
 @app.route('/update_student_wa', methods=['POST'])
 @token_required_student
@@ -940,17 +1389,17 @@ def update_student_wa():
     fb_handle = data.get('fb_handle')
 
     
-    student = g.current_user
-    if wa_number:
-        student.wa_number = wa_number
-    if tg_handle:
-        student.tg_handle = tg_handle
+    student = g.current_user.document
+    IdentityResolver.set_identities(student, wa_number=wa_number, tg_handle=tg_handle)
     if ig_handle:
         student.ig_handle = ig_handle
     if fb_handle:
         student.fb_handle = fb_handle
-    
-    student.save()
+
+    try:
+        student.save()
+    except NotUniqueError:
+        return jsonify({'error': 'This WhatsApp number or Telegram handle is already linked to another student'}), 409
 
     return jsonify({'message': 'Student updated successfully'})
 
@@ -0,0 +1,256 @@
+"""ASGI entry point: an async /chat pipeline in front of the Flask app.
+
+POST /chat is served by an async implementation that awaits OpenAI, Pinecone
+(on a thread pool) and MongoDB (through motor) without holding a worker, so
+one process can keep hundreds of chats in flight. Every other route, and the
+WSGI deployment through wsgi.py, keeps using the Flask app unchanged.
+
+    uvicorn asgi:application --workers 4
+"""
+
+import asyncio
+import copy
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import jwt
+from asgiref.wsgi import WsgiToAsgi
+from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.applications import Starlette
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from app import (
+    app as flask_app,
+    FALLBACK_REPLY,
+    faq_hits,
+    history_independent,
+    keyword_matches,
+    prompt_inputs,
+    serialize_ranked_references,
+)
+from middlewares.authentication import resolve_principal
+from models.assistant import Assistant
+from models.conversation import Conversation, UserMessage, AssistantMessage, References, Message
+from models.student import Student
+from services.admission import Admission
+from services.answer_cache import AnswerCache
+from services.metrics import Metrics
+from services.profiling import Profiler, PROFILE_HEADER, PROFILE_ID_HEADER
+from services.prompt_builder import HISTORY_MESSAGES
+from utils import Utils
+
+# Threads for the blocking calls made from the event loop (Pinecone queries, cache misses)
+ASYNC_IO_THREADS = int(os.getenv('ASYNC_IO_THREADS', 64))
+
+mongo = AsyncIOMotorClient(os.getenv('MONGO_URI')).get_default_database('test')
+assistants = mongo[Assistant._get_collection_name()]
+conversations = mongo[Conversation._get_collection_name()]
+
+
+def error(message, status):
+    return JSONResponse({'error': message}, status_code=status)
+
+
+def too_many_requests(retry_after):
+    return JSONResponse({'error': 'Too many requests, please try again later'}, status_code=429, headers={'Retry-After': str(math.ceil(retry_after))})
+
+
+async def load_assistant(assistant_id):
+    with Metrics.span('mongo.load_assistant'):
+        doc = await assistants.find_one({'_id': assistant_id})
+    return Assistant._from_son(doc) if doc else None
+
+
+async def load_conversation(conversation_id, history_messages):
+    """Conversation with only its last `history_messages` messages"""
+
+    with Metrics.span('mongo.load_conversation'):
+        doc = await conversations.find_one(
+            {'_id': conversation_id},
+            {'messages': {'$slice': -history_messages}}
+        )
+    return Conversation._from_son(doc) if doc else None
+
+
+async def create_conversation(student, assistant):
+    conversation = Conversation(student=student, assistant=assistant)
+    with Metrics.span('mongo.save_conversation'):
+        await conversations.insert_one(conversation.to_mongo())
+    return conversation
+
+
+async def save_conversation(conversation, new_messages, title=None):
+    """Append the new messages with $push; the loaded conversation only holds a slice of its history"""
+
+    update = {'$set': {'conversation_summary': conversation.conversation_summary}}
+    if title:
+        update['$set']['title'] = title
+    if new_messages:
+        update['$push'] = {'messages': {'$each': [message.to_mongo() for message in new_messages]}}
+    with Metrics.span('mongo.save_conversation'):
+        await conversations.update_one({'_id': conversation.id}, update)
+
+
+async def retrieve_matches_async(metadata, refined_question_embedding, title_embedding, assistant):
+    faq = faq_hits(await Utils.query_faq_async(assistant.id, refined_question_embedding), assistant)
+    if faq:
+        return faq
+
+    # The four vector queries and the keyword search are independent
+    (own_keyword_matches, supported_keyword_matches), own_title, own_text, supported_title, supported_text = await asyncio.gather(
+        asyncio.to_thread(keyword_matches, metadata, assistant),
+        Utils.query_pinecone_async(assistant.id, title_embedding, 'own', 'title'),
+        Utils.query_pinecone_async(assistant.id, refined_question_embedding, 'own', 'text', include_values=True),
+        Utils.query_pinecone_async(assistant.id, title_embedding, 'supported', 'title'),
+        Utils.query_pinecone_async(assistant.id, refined_question_embedding, 'supported', 'text', include_values=True)
+    )
+    own_matches = {'title': own_title, 'content': own_text, 'bm25': own_keyword_matches}
+    supported_matches = {'title': supported_title, 'content': supported_text, 'bm25': supported_keyword_matches}
+    return Utils.rank_pinecone_matches(own_matches, assistant.ranking), Utils.rank_pinecone_matches(supported_matches, assistant.ranking)
+
+
+async def answer_question_async(user_message, metadata, refined_question_embedding, title_embedding, assistant, conversation):
+    ranked_own_matches, ranked_supported_matches = await retrieve_matches_async(metadata, refined_question_embedding, title_embedding, assistant)
+    history, context = prompt_inputs(ranked_own_matches, ranked_supported_matches, assistant, conversation)
+    response = await Utils.generate_chat_response_async(user_message, conversation.conversation_summary, history, context)
+    ranked_own_content, ranked_supported_content = serialize_ranked_references(ranked_own_matches, ranked_supported_matches, assistant)
+    return response, ranked_own_matches, ranked_supported_matches, ranked_own_content, ranked_supported_content
+
+
+@Profiler.profile('chat')
+async def process_chat_async(user_message, assistant, conversation):
+    """Async counterpart of app.process_chat"""
+
+    metadata = await Utils.extract_chat_metadata_async(user_message)
+    refined_question = metadata['RefinedQuestion']
+    title = metadata['Title']
+
+    new_messages = [Message(sender='user', content=UserMessage(
+        message=user_message,
+        refined_question=refined_question,
+        topics=metadata['Topics'],
+        title=title,
+        keywords=metadata['Keywords']
+    ))]
+    conversation.messages.extend(new_messages)
+    new_title = title if not conversation.title and title else None
+
+    if not refined_question or not metadata['Topics'] or not title or not metadata['Keywords']:
+        conversation.conversation_summary = FALLBACK_REPLY
+        await save_conversation(conversation, new_messages, new_title)
+        return FALLBACK_REPLY, [], []
+
+    # Both embeddings in one request; the title one is unused when the FAQ or answer cache hits
+    refined_question_embedding, title_embedding = await Utils.get_embeddings_async([refined_question, title])
+
+    cacheable = history_independent(conversation)
+    cached = cacheable and AnswerCache.lookup(assistant.id, assistant.content_version, refined_question_embedding)
+    if cached:
+        response, ranked_own_matches, ranked_supported_matches, ranked_own_content, ranked_supported_content = copy.deepcopy(cached)
+    else:
+        answer = await answer_question_async(user_message, metadata, refined_question_embedding, title_embedding, assistant, conversation)
+        if cacheable:
+            AnswerCache.store(assistant.id, assistant.content_version, refined_question_embedding, copy.deepcopy(answer))
+        response, ranked_own_matches, ranked_supported_matches, ranked_own_content, ranked_supported_content = answer
+
+    new_messages.append(Message(sender='assistant', content=AssistantMessage(message=response, references=References(
+        own=ranked_own_matches,
+        supporting=ranked_supported_matches
+    ))))
+    conversation.conversation_summary = await Utils.update_conversation_summary_async(conversation.conversation_summary or "", user_message, response)
+    await save_conversation(conversation, new_messages, new_title)
+    return response, ranked_own_content, ranked_supported_content
+
+
+async def chat(request):
+    started = time.perf_counter()
+    Metrics.reset_labels(route='/chat')
+    Profiler.use_header(request.headers.get(PROFILE_HEADER))
+    response = await handle_chat(request)
+    if Profiler.profile_id():
+        response.headers[PROFILE_ID_HEADER] = Profiler.profile_id()
+    Metrics.observe('request_duration_seconds', time.perf_counter() - started, method='POST', status=str(response.status_code), **{'route': '', 'assistant': '', **Metrics.current_labels()})
+    return response
+
+
+async def handle_chat(request):
+    token = request.headers.get('Authorization', '')
+    token = token[7:] if token.startswith('Bearer ') else token
+    if not token:
+        return error('Token is missing!', 401)
+    try:
+        # Principals are usually cached; a miss loads the student with the sync driver
+        student = await asyncio.to_thread(resolve_principal, token, Student)
+    except jwt.ExpiredSignatureError:
+        return error('Token has expired!', 401)
+    except jwt.InvalidTokenError:
+        return error('Invalid token!', 401)
+    if not student:
+        return error('User not found!', 401)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return error('assistant_id and message are required', 400)
+    assistant_id = data.get('assistant_id')
+    conversation_id = data.get('conversation_id')
+    user_message = data.get('message')
+    if not assistant_id or not user_message:
+        return error('assistant_id and message are required', 400)
+
+    retry_after = Admission.admit(f'student:{student.id}', assistant_id)
+    if retry_after:
+        return too_many_requests(retry_after)
+    try:
+        return await answer_chat(student, assistant_id, conversation_id, user_message)
+    finally:
+        Admission.leave(assistant_id)
+
+
+async def answer_chat(student, assistant_id, conversation_id, user_message):
+    assistant = await load_assistant(assistant_id)
+    if not assistant:
+        return error('Invalid assistant_id', 400)
+    Metrics.set_labels(assistant=assistant.id)
+
+    if conversation_id:
+        conversation = await load_conversation(conversation_id, HISTORY_MESSAGES)
+        if not conversation:
+            return error('Invalid conversation_id', 400)
+    else:
+        conversation = await create_conversation(student.ref, assistant)
+
+    response, ranked_own_content, ranked_supported_content = await process_chat_async(user_message, assistant, conversation)
+    return JSONResponse({
+        'message': response,
+        'references': {
+            'own': ranked_own_content,
+            'supported': ranked_supported_content
+        },
+        'conversation_id': conversation.id
+    })
+
+
+def use_io_threads():
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=ASYNC_IO_THREADS, thread_name_prefix='async-io'))
+
+
+chat_app = CORSMiddleware(
+    Starlette(routes=[Route('/chat', chat, methods=['POST'])], on_startup=[use_io_threads]),
+    allow_origins=['*'], allow_methods=['*'], allow_headers=['*']
+)
+flask_asgi = WsgiToAsgi(flask_app)
+
+
+async def application(scope, receive, send):
+    # Lifespan events go to Starlette, Flask has none
+    if scope['type'] == 'lifespan' or scope.get('path') == '/chat':
+        await chat_app(scope, receive, send)
+    else:
+        await flask_asgi(scope, receive, send)
@@ -0,0 +1,134 @@
+"""Local stand-in for the OpenAI HTTP API (and the source file host) used by the benchmarks"""
+
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EMBEDDING_DIMENSIONS = 1536
+STOPWORDS = {
+    'the', 'and', 'for', 'that', 'this', 'with', 'from', 'are', 'was', 'can', 'you', 'your', 'what',
+    'how', 'why', 'into', 'about', 'text', 'following', 'tokens', 'summarize', 'explain', 'does', 'its'
+}
+
+
+def embed(text):
+    """Deterministic hashed bag-of-words embedding, so related texts get similar vectors"""
+
+    vector = [0.0] * EMBEDDING_DIMENSIONS
+    for token in re.findall(r'\w+', (text or '').lower()):
+        digest = int(hashlib.md5(token.encode()).hexdigest(), 16)
+        vector[digest % EMBEDDING_DIMENSIONS] += 1.0 if (digest >> 64) & 1 else -1.0
+    norm = sum(value * value for value in vector) ** 0.5 or 1.0
+    return [value / norm for value in vector]
+
+
+def key_terms(text, count=8):
+    words = [word for word in re.findall(r'[a-z]{3,}', text.lower()) if word not in STOPWORDS]
+    return [word for word, _ in Counter(words).most_common(count)] or ['general']
+
+
+def prompt_text(prompt):
+    """The document or message a prompt is about (everything after its last 'Text:' label)"""
+
+    match = re.split(r'Text:', prompt)
+    return match[-1] if len(match) > 1 else prompt
+
+
+def fake_completion(messages):
+    system = messages[0]['content'] if messages else ''
+    prompt = messages[-1]['content'] if messages else ''
+    if 'extracts metadata' in system:
+        terms = key_terms(prompt_text(prompt))
+        title = ' '.join(terms[:3]).title()
+        if 'RefinedQuestion' in prompt:
+            return json.dumps({
+                'RefinedQuestion': prompt_text(prompt).strip(),
+                'Topics': terms[:3],
+                'Title': title,
+                'Keywords': terms[3:8] or terms[:1]
+            })
+        return json.dumps({
+            'Title': title,
+            'Topics': terms[:3],
+            'Keywords': terms[3:8] or terms[:1],
+            'Questions': [f'What is {term}?' for term in terms[:3]]
+        })
+    terms = key_terms(prompt_text(prompt), 12)
+    return 'This covers ' + ', '.join(terms) + '.'
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body, content_type='application/json'):
+        payload = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        name = self.path.rsplit('/', 1)[-1]
+        if self.path.startswith('/corpus/') and name in self.server.corpus:
+            self.respond(200, self.server.corpus[name].encode(), 'text/plain; charset=utf-8')
+        else:
+            self.respond(404, {'error': 'not found'})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        self.server.record(self.path)
+        if self.path.endswith('/chat/completions'):
+            time.sleep(self.server.llm_latency)
+            content = fake_completion(body.get('messages', []))
+            self.respond(200, {
+                'id': 'chatcmpl-bench',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': body.get('model', 'bench'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+            })
+        elif self.path.endswith('/embeddings'):
+            time.sleep(self.server.embedding_latency)
+            inputs = body.get('input', [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            self.respond(200, {
+                'object': 'list',
+                'model': body.get('model', 'bench'),
+                'data': [{'object': 'embedding', 'index': i, 'embedding': embed(text)} for i, text in enumerate(inputs)],
+                'usage': {'prompt_tokens': 0, 'total_tokens': 0}
+            })
+        else:
+            self.respond(404, {'error': 'not found'})
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, llm_latency_ms=0, embedding_latency_ms=0, corpus=None):
+        super().__init__(('127.0.0.1', 0), FakeOpenAIHandler)
+        self.llm_latency = llm_latency_ms / 1000
+        self.embedding_latency = embedding_latency_ms / 1000
+        self.corpus = corpus or {}
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, path):
+        with self._lock:
+            self.calls[path.rsplit('/', 1)[-1] if path.endswith('embeddings') else 'chat/completions'] += 1
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='fake-openai', daemon=True).start()
+        return self
@@ -0,0 +1,90 @@
+"""In-memory stand-in for the `pinecone` client module used by the benchmarks"""
+
+import threading
+import time
+
+import numpy as np
+
+
+class ServerlessSpec:
+    def __init__(self, cloud=None, region=None):
+        self.cloud = cloud
+        self.region = region
+
+
+class _IndexList(list):
+    def names(self):
+        return list(self)
+
+
+def _matches(metadata, filter):
+    for key, condition in (filter or {}).items():
+        value = metadata.get(key)
+        if isinstance(condition, dict):
+            if '$eq' in condition and value != condition['$eq']:
+                return False
+            if '$in' in condition and value not in condition['$in']:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class InMemoryIndex:
+    """Brute-force cosine index with Pinecone's upsert/query/delete surface"""
+
+    query_latency = 0.0
+
+    def __init__(self):
+        self._vectors = {}
+        self._lock = threading.Lock()
+
+    def upsert(self, vectors, **kwargs):
+        with self._lock:
+            for vector in vectors:
+                values = np.asarray(vector['values'], dtype=np.float32)
+                norm = float(np.linalg.norm(values)) or 1.0
+                self._vectors[vector['id']] = (values / norm, vector.get('metadata') or {})
+        return {'upserted_count': len(vectors)}
+
+    def delete(self, ids=None, filter=None, **kwargs):
+        with self._lock:
+            for vector_id in list(ids or [k for k, (_, metadata) in self._vectors.items() if _matches(metadata, filter)]):
+                self._vectors.pop(vector_id, None)
+
+    def query(self, vector, top_k=10, filter=None, include_metadata=False, include_values=False, **kwargs):
+        time.sleep(InMemoryIndex.query_latency)
+        with self._lock:
+            candidates = [(vector_id, values, metadata) for vector_id, (values, metadata) in self._vectors.items() if _matches(metadata, filter)]
+        if not candidates:
+            return {'matches': []}
+        query = np.asarray(vector, dtype=np.float32)
+        query /= float(np.linalg.norm(query)) or 1.0
+        scores = np.stack([values for _, values, _ in candidates]) @ query
+        order = np.argsort(-scores)[:top_k]
+        matches = []
+        for i in order:
+            vector_id, values, metadata = candidates[i]
+            match = {'id': vector_id, 'score': float(scores[i])}
+            if include_metadata:
+                match['metadata'] = metadata
+            if include_values:
+                match['values'] = values.tolist()
+            matches.append(match)
+        return {'matches': matches}
+
+
+class Pinecone:
+    _indexes = {}
+
+    def __init__(self, api_key=None, **kwargs):
+        self.api_key = api_key
+
+    def list_indexes(self):
+        return _IndexList(Pinecone._indexes)
+
+    def create_index(self, name, **kwargs):
+        Pinecone._indexes.setdefault(name, InMemoryIndex())
+
+    def Index(self, name):
+        return Pinecone._indexes.setdefault(name, InMemoryIndex())
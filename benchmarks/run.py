@@ -0,0 +1,321 @@
+"""Offline end-to-end benchmark of the /digest and /chat routes.
+
+Boots app.py against local stand-ins: a stub OpenAI server (which also hosts
+the corpus files), an in-memory vector index in place of Pinecone, and
+mongomock (or a local mongod via --mongo-uri). A scripted corpus is digested
+and a chat workload is replayed at the requested concurrency, then latency
+percentiles per route and per pipeline stage, throughput and memory are
+written as JSON.
+
+    python -m benchmarks.run --documents 12 --chats 200 --concurrency 8 --llm-latency-ms 300
+    python -m benchmarks.run --compare benchmarks/results/<previous>.json
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks import fake_pinecone
+from benchmarks.fake_openai import FakeOpenAIServer
+
+# Pipeline stages timed on every call, grouped by the route that triggered them
+STAGES = [
+    'extract_text', 'get_summary', 'get_metadata', 'create_chunks', 'process_and_upload_embeddings',
+    'extract_chat_metadata', 'get_embeddings', 'query_pinecone', 'rank_pinecone_matches',
+    'generate_chat_response', 'update_conversation_summary'
+]
+SUBJECTS = {
+    'photosynthesis': ['chlorophyll', 'sunlight', 'glucose', 'stomata', 'carbon', 'oxygen', 'leaf', 'light', 'energy', 'plant'],
+    'algebra': ['equation', 'variable', 'polynomial', 'factor', 'linear', 'quadratic', 'root', 'coefficient', 'expression', 'inequality'],
+    'revolution': ['monarchy', 'republic', 'assembly', 'citizens', 'taxes', 'bastille', 'constitution', 'liberty', 'nobility', 'reform'],
+    'electricity': ['current', 'voltage', 'resistance', 'circuit', 'charge', 'conductor', 'battery', 'ohm', 'series', 'parallel'],
+    'genetics': ['gene', 'allele', 'chromosome', 'dominant', 'recessive', 'mutation', 'heredity', 'protein', 'trait', 'inheritance'],
+    'geography': ['river', 'delta', 'plateau', 'climate', 'monsoon', 'erosion', 'sediment', 'basin', 'rainfall', 'valley'],
+}
+FILLER = ['students', 'learn', 'important', 'process', 'example', 'because', 'often', 'describe', 'between', 'system', 'result', 'study', 'change', 'called']
+
+
+class Recorder:
+    """Thread-safe latency samples and error counts keyed by route or stage"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, key, seconds, failed=False):
+        with self._lock:
+            self.samples[key].append(seconds)
+            if failed:
+                self.errors[key] += 1
+
+    def report(self, prefix):
+        return {
+            key[len(prefix):]: dict(summarize(samples), errors=self.errors[key])
+            for key, samples in sorted(self.samples.items()) if key.startswith(prefix)
+        }
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))] * 1000, 2)
+
+    return {
+        'count': len(ordered),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 2),
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'max_ms': round(ordered[-1] * 1000, 2)
+    }
+
+
+def make_corpus(documents, words, seed):
+    rng = random.Random(seed)
+    corpus = {}
+    for i in range(documents):
+        subject = list(SUBJECTS)[i % len(SUBJECTS)]
+        sentences, count = [], 0
+        while count < words:
+            sentence = [rng.choice(SUBJECTS[subject]) if rng.random() < 0.4 else rng.choice(FILLER) for _ in range(rng.randint(8, 16))]
+            sentences.append(' '.join(sentence).capitalize() + '.')
+            count += len(sentence)
+        corpus[f'{subject}-{i}.txt'] = '\n\n'.join(' '.join(sentences[j:j + 5]) for j in range(0, len(sentences), 5))
+    return corpus
+
+
+def make_questions(count, seed):
+    rng = random.Random(seed + 1)
+    questions = []
+    for _ in range(count):
+        subject = rng.choice(list(SUBJECTS))
+        first, second = rng.sample(SUBJECTS[subject], 2)
+        questions.append(rng.choice([
+            f'How does {first} relate to {second}?',
+            f'Can you explain {first} in {subject}?',
+            f'What is the difference between {first} and {second}?',
+            f'Why is {first} important when we study {subject}?'
+        ]))
+    return questions
+
+
+def boot_app(args, openai_url):
+    """Point the app at the local stand-ins and import it"""
+
+    os.environ.update({
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_BASE_URL': f'{openai_url}/v1',
+        'PINECONE_API_KEY': 'bench',
+        'SECRET_KEY': 'bench-secret',
+        'APP_URL': 'http://127.0.0.1'
+    })
+    sys.modules['pinecone'] = fake_pinecone
+    fake_pinecone.InMemoryIndex.query_latency = args.vector_latency_ms / 1000
+
+    if args.mongo_uri:
+        os.environ['MONGO_URI'] = args.mongo_uri
+    else:
+        import mongoengine
+        import mongomock
+        connect = mongoengine.connect
+        mongoengine.connect = lambda *a, **kw: connect('baman-bench', host='mongodb://localhost', mongo_client_class=mongomock.MongoClient)
+
+    import app as app_module
+    return app_module
+
+
+def instrument(app_module, recorder, current):
+    from utils import Utils
+
+    def timed(key, fn):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                recorder.add(f'stage {getattr(current, "route", "-")} {key}', time.perf_counter() - started, failed)
+        return wrapper
+
+    for name in STAGES:
+        if hasattr(Utils, name):
+            setattr(Utils, name, staticmethod(timed(name, getattr(Utils, name))))
+    app_module.process_chat = timed('process_chat', app_module.process_chat)
+
+
+def seed_users(app_module):
+    from models.assistant import Assistant
+    from models.student import Student
+    from models.teacher import Teacher
+
+    run = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f')
+    teacher = Teacher(name='Bench Teacher', google_id=f'bench-teacher-{run}', email=f'teacher-{run}@bench.local')
+    teacher.save()
+    assistant = Assistant(teacher=teacher, subject='Science', class_name='Bench', about='Benchmark assistant')
+    assistant.save()
+    student = Student(name='Bench Student', google_id=f'bench-student-{run}', email=f'student-{run}@bench.local', allowed_assistants=[assistant.id])
+    student.save()
+    Assistant.objects(id=assistant.id).update(add_to_set__allowed_students=student.id)
+
+    def token(user):
+        return app_module.jwt.encode({
+            'sub': user.google_id,
+            'email': user.email,
+            'exp': datetime.now(timezone.utc) + timedelta(days=1)
+        }, os.environ['SECRET_KEY'], algorithm='HS256')
+
+    return assistant.id, token(teacher), token(student)
+
+
+def run_phase(name, tasks, concurrency):
+    """Run callables on a thread pool and return wall time and peak traced memory"""
+
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f'bench-{name}') as pool:
+        for future in [pool.submit(task) for task in tasks]:
+            future.result()
+    seconds = time.perf_counter() - started
+    return seconds, tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(current, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\n{'':48} {'p50 ms':>18} {'p95 ms':>18}")
+    for section in ('routes', 'stages'):
+        for key, stats in current[section].items():
+            before = baseline.get(section, {}).get(key)
+            if not before:
+                continue
+            cells = [f"{before[p]:>8.1f} -> {stats[p]:<8.1f}" for p in ('p50_ms', 'p95_ms')]
+            print(f"{section[:-1] + ' ' + key:48} {cells[0]} {cells[1]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--documents', type=int, default=6, help='documents digested before the chat workload')
+    parser.add_argument('--document-words', type=int, default=2500)
+    parser.add_argument('--chats', type=int, default=60, help='total chat messages sent')
+    parser.add_argument('--turns', type=int, default=5, help='messages per conversation')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--llm-latency-ms', type=float, default=0)
+    parser.add_argument('--embedding-latency-ms', type=float, default=0)
+    parser.add_argument('--vector-latency-ms', type=float, default=0)
+    parser.add_argument('--mongo-uri', help='use a local mongod (a dedicated database) instead of mongomock')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--trace-memory', action='store_true', help='record peak Python allocations per phase (slower)')
+    parser.add_argument('--output', help='result file, defaults to benchmarks/results/<commit>-<time>.json')
+    parser.add_argument('--compare', help='previous result file to print deltas against')
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.documents, args.document_words, args.seed)
+    questions = make_questions(args.chats, args.seed)
+    server = FakeOpenAIServer(args.llm_latency_ms, args.embedding_latency_ms, corpus).start()
+
+    app_module = boot_app(args, server.url)
+    recorder = Recorder()
+    current = threading.local()
+    instrument(app_module, recorder, current)
+    assistant_id, teacher_token, student_token = seed_users(app_module)
+
+    def post(route, token, payload):
+        current.route = route
+        client = getattr(current, 'client', None) or app_module.app.test_client()
+        current.client = client
+        started = time.perf_counter()
+        response = client.post(route, json=payload, headers={'Authorization': f'Bearer {token}'})
+        recorder.add(f'route {route}', time.perf_counter() - started, response.status_code >= 400)
+        return response.get_json(silent=True) or {}
+
+    def digest(i, name):
+        return lambda: post('/digest', teacher_token, {
+            'assistant_id': assistant_id,
+            'fileUrl': f'{server.url}/corpus/{name}',
+            'content_type': 'own' if i % 2 == 0 else 'supported'
+        })
+
+    def conversation(messages):
+        def run():
+            conversation_id = None
+            for message in messages:
+                payload = {'assistant_id': assistant_id, 'message': message}
+                if conversation_id:
+                    payload['conversation_id'] = conversation_id
+                conversation_id = post('/chat', student_token, payload).get('conversation_id') or conversation_id
+        return run
+
+    if args.trace_memory:
+        tracemalloc.start()
+    phases = {}
+    for phase, tasks in (
+        ('digest', [digest(i, name) for i, name in enumerate(corpus)]),
+        ('chat', [conversation(questions[i:i + args.turns]) for i in range(0, len(questions), args.turns)])
+    ):
+        print(f'Running {phase} phase ({len(tasks)} tasks, concurrency {args.concurrency})...')
+        seconds, peak = run_phase(phase, tasks, args.concurrency)
+        requests = len(recorder.samples.get(f'route /{phase}', []))
+        phases[phase] = {'seconds': round(seconds, 3), 'requests': requests, 'throughput_rps': round(requests / seconds, 3) if seconds else None, 'peak_traced_bytes': peak}
+
+    from services.http_client import HttpClient
+    from services.llm_gateway import LLMGateway
+
+    result = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': sys.version.split()[0],
+            'mongo': 'mongod' if args.mongo_uri else 'mongomock',
+            'args': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'mongo_uri')}
+        },
+        'phases': phases,
+        'routes': recorder.report('route '),
+        'stages': recorder.report('stage '),
+        'memory': {'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss},
+        'upstream': {'openai_calls': dict(server.calls), 'llm_gateway': LLMGateway.metrics(), 'http_client': HttpClient.metrics()}
+    }
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f"{result['meta']['commit']}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2, default=str)
+
+    for key, stats in result['routes'].items():
+        print(f"{key:10} n={stats['count']:<5} p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms p99={stats['p99_ms']}ms errors={stats['errors']}")
+    for phase, stats in phases.items():
+        print(f"{phase:10} {stats['throughput_rps']} req/s")
+    print(f'Results written to {output}')
+
+    if args.compare:
+        compare(result, args.compare)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,63 +4,47 @@ import jwt
 import os
 from models.teacher import Teacher
 from models.student import Student
-
-def token_required_teacher(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = None
-        # Get the token from the Authorization header
-        if 'Authorization' in request.headers:
-            token = request.headers['Authorization']
-            if token.startswith('Bearer '):
-                token = token[7:]
-
-        if not token:
-            return jsonify({'error': 'Token is missing!'}), 401
-
-        try:
-            # Decode the token
-            data = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=['HS256'])
-            # Optionally, you can add more checks here, such as checking user roles or permissions
-            
-            # Retrieve the user from the database
-            user = Teacher.objects(google_id=data['sub']).first()
-            if not user:
-                return jsonify({'error': 'User not found!'}), 401
-            # Store the user in the global object
-            g.current_user = user
-        except jwt.ExpiredSignatureError:
-            return jsonify({'error': 'Token has expired!'}), 401
-        except jwt.InvalidTokenError:
-            return jsonify({'error': 'Invalid token!'}), 401
-
-        return f(*args, **kwargs)
-
-    return decorated
-
-def token_required_student(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = None
-        if 'Authorization' in request.headers:
-            token = request.headers['Authorization']
-            if token.startswith('Bearer '):
-                token = token[7:]
-
-        if not token:
-            return jsonify({'error': 'Token is missing!'}), 401
-
-        try:
-            data = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=['HS256'])
-            user = Student.objects(google_id=data['sub']).first()
-            if not user:
-                return jsonify({'error': 'User not found!'}), 401
-            g.current_user = user
-        except jwt.ExpiredSignatureError:
-            return jsonify({'error': 'Token has expired!'}), 401
-        except jwt.InvalidTokenError:
-            return jsonify({'error': 'Invalid token!'}), 401
-
-        return f(*args, **kwargs)
-
-    return decorated
\ No newline at end of file
+from services.principal_cache import PrincipalCache
+
+def get_bearer_token():
+    token = None
+    # Get the token from the Authorization header
+    if 'Authorization' in request.headers:
+        token = request.headers['Authorization']
+        if token.startswith('Bearer '):
+            token = token[7:]
+    return token
+
+def resolve_principal(token, model):
+    """Decode the JWT and resolve its subject to a cached Principal (None if the user does not exist)"""
+    data = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=['HS256'])
+    return PrincipalCache.resolve(model, data['sub'])
+
+def token_required(model):
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            token = get_bearer_token()
+            if not token:
+                return jsonify({'error': 'Token is missing!'}), 401
+
+            try:
+                # Retrieve the user from the principal cache, the full document is loaded lazily
+                user = resolve_principal(token, model)
+                if not user:
+                    return jsonify({'error': 'User not found!'}), 401
+                # Store the user in the global object
+                g.current_user = user
+            except jwt.ExpiredSignatureError:
+                return jsonify({'error': 'Token has expired!'}), 401
+            except jwt.InvalidTokenError:
+                return jsonify({'error': 'Invalid token!'}), 401
+
+            return f(*args, **kwargs)
+
+        return decorated
+
+    return decorator
+
+token_required_teacher = token_required(Teacher)
+token_required_student = token_required(Student)
@@ -11,6 +11,7 @@ from mongoengine import (
     EmbeddedDocument,
     EmbeddedDocumentListField,
     DateTimeField,
+    DictField,
 )
 
 from models.teacher import Teacher
@@ -59,11 +60,26 @@ class Assistant(Document):
     connected_channels = ListField(ReferenceField("Channel"))
     created_at = DateTimeField(default=datetime.now(timezone.utc))
     updated_at = DateTimeField(default=datetime.now(timezone.utc))
+    # Overrides of the default retrieval ranking settings (weights, top_n, mmr_lambda, max_per_content)
+    ranking = DictField()
+    # Changes only with what answers are built from (content, ranking), unlike updated_at which
+    # also changes with the roster and channels; the answer cache and keyword index key on it
+    content_version = DateTimeField()
 
-    meta = {"indexes": [{"fields": ["teacher", "subject", "class_name"]}]}
+    meta = {
+        "indexes": [
+            {"fields": ["teacher", "subject", "class_name"]},
+            {"fields": ["allowed_students"]}
+        ]
+    }
 
     def save(self, *args, **kwargs):
         """Set updated_at time as current UTC time"""
 
         self.updated_at = datetime.now(timezone.utc)
         return super(Assistant, self).save(*args, **kwargs)
+
+    def touch_content(self):
+        """Mark content or answer settings as changed, to be persisted by the next save"""
+
+        self.content_version = datetime.now(timezone.utc)
@@ -23,3 +23,11 @@ class Channel(Document):
     assistants = ListField(ReferenceField('Assistant', required=False))
     created_at = DateTimeField(default=datetime.now(timezone.utc))
     updated_at = DateTimeField(default=datetime.now(timezone.utc))
+
+    meta = {
+        'indexes': [
+            {'fields': ['name', 'profile.phone_number']},
+            {'fields': ['name', 'profile.phone_number_id']},
+            {'fields': ['assistants']}
+        ]
+    }
@@ -68,4 +68,8 @@ class Conversation(Document):
     questions = ListField(StringField())
     messages = EmbeddedDocumentListField(Message)
 
-    # meta = {'collection': 'conversations'}
+    meta = {
+        'indexes': [
+            {'fields': ['student', 'assistant']}
+        ]
+    }
@@ -0,0 +1,24 @@
+"""Database models for processed inbound channel messages"""
+
+import os
+from datetime import datetime, timezone
+
+from mongoengine import (
+    Document,
+    StringField,
+    DateTimeField
+)
+
+
+class ProcessedMessage(Document):
+    """Inbound channel message that has already been accepted, kept to drop redeliveries"""
+
+    # "<channel>:<platform message id>"
+    id = StringField(primary_key=True)
+    created_at = DateTimeField(default=lambda: datetime.now(timezone.utc))
+
+    meta = {
+        'indexes': [
+            {'fields': ['created_at'], 'expireAfterSeconds': int(os.getenv('PROCESSED_MESSAGE_TTL', 7 * 24 * 3600))}
+        ]
+    }
@@ -8,9 +8,12 @@ from mongoengine import (
     StringField,
     DateTimeField,
     ListField,
-    ReferenceField
+    ReferenceField,
+    IntField
 )
 
+from services.principal_cache import PrincipalCache
+
 
 class Student(Document):
     """Student details along with their social network IDs and contact details"""
@@ -32,8 +35,11 @@ class Student(Document):
 
     # Social profile IDs
     google_id = StringField(unique=True, sparse=True)
+    # Normalized WhatsApp number (digits only, as in wa_id)
     whatsapp_id = StringField(unique=True, sparse=True)
     telegram_id = StringField(unique=True, sparse=True)
+    # Normalized Telegram username (lowercase, without '@')
+    tg_username = StringField(unique=True, sparse=True)
     instagram_id = StringField(unique=True, sparse=True)
 
     # Social contact IDs
@@ -42,17 +48,31 @@ class Student(Document):
     ig_handle = StringField()
     fb_handle = StringField()
 
+    # Bumped on every save, used to invalidate cached principals
+    version = IntField(default=0)
+
     meta = {
         'indexes': [
             {'fields': ['google_id']},
             {'fields': ['whatsapp_id']},
             {'fields': ['telegram_id']},
+            {'fields': ['tg_username']},
             {'fields': ['instagram_id']},
             {'fields': ['email']},
-            {'fields': ['phone_number']}
+            {'fields': ['phone_number']},
+            {'fields': ['wa_number']},
+            {'fields': ['tg_handle']}
         ]
     }
 
+    def save(self, *args, **kwargs):
+        """Bump the version stamp and drop the cached principal"""
+
+        self.version = (self.version or 0) + 1
+        result = super(Student, self).save(*args, **kwargs)
+        PrincipalCache.invalidate(Student, self.google_id)
+        return result
+
     def update_last_login(self):
         """Update last login time for student"""
 
@@ -8,11 +8,13 @@ from mongoengine import (
     DateTimeField,
     ReferenceField,
     ListField,
+    IntField,
     EmbeddedDocumentField,
     EmbeddedDocument
 )
 
 from models.channel import Channel
+from services.principal_cache import PrincipalCache
 
 
 class Channels(EmbeddedDocument):
@@ -34,6 +36,7 @@ class Teacher(Document):
     channels = EmbeddedDocumentField(Channels, default=Channels)
     created_at = DateTimeField(default=datetime.now(timezone.utc))
     last_login = DateTimeField(default=datetime.now(timezone.utc))
+    version = IntField(default=0)
 
     meta = {
         'indexes': [
@@ -41,3 +44,11 @@ class Teacher(Document):
             {'fields': ['email'], 'unique': True}
         ]
     }
+
+    def save(self, *args, **kwargs):
+        """Bump the version stamp and drop the cached principal"""
+
+        self.version = (self.version or 0) + 1
+        result = super(Teacher, self).save(*args, **kwargs)
+        PrincipalCache.invalidate(Teacher, self.google_id)
+        return result
@@ -0,0 +1,127 @@
+"""Admission control for chat requests and channel messages"""
+
+import os
+import threading
+from collections import defaultdict
+
+from services.rate_limit import TokenBucket
+from services.ttl_cache import TTLCache
+
+# Chats answered concurrently by one worker process, across /chat and webhooks
+MAX_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT', 32))
+# Chats answered concurrently for one assistant, so one tenant cannot take the whole worker
+MAX_IN_FLIGHT_PER_ASSISTANT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT_PER_ASSISTANT', 8))
+STUDENT_MESSAGES_PER_MINUTE = float(os.getenv('STUDENT_MESSAGES_PER_MINUTE', 10))
+STUDENT_MESSAGE_BURST = int(os.getenv('STUDENT_MESSAGE_BURST', 5))
+# Retry-After suggested when a concurrency budget is full
+BUSY_RETRY_AFTER = float(os.getenv('ADMISSION_BUSY_RETRY_AFTER', 2))
+MAX_STUDENT_BUCKETS = 10000
+REJECTION_REASONS = ('student', 'assistant', 'worker')
+
+
+class _Student:
+    def __init__(self):
+        self.bucket = TokenBucket(STUDENT_MESSAGES_PER_MINUTE / 60, STUDENT_MESSAGE_BURST)
+        self.notified = False
+
+
+class Admission:
+    """Sheds chats that would exceed a budget before any LLM work is done.
+
+    Each student key (`student:<id>`, the same on /chat and every channel) has
+    a token bucket of messages; each worker process and each assistant has a
+    bound on chats in flight. Nothing here blocks: callers get the seconds to
+    wait and answer with a 429 or a channel reply instead of queueing the work.
+    Keys are only created for authenticated or enrolled students, so unknown
+    senders cannot evict real students' buckets.
+    """
+
+    _students = TTLCache(MAX_STUDENT_BUCKETS)
+    _in_flight = 0
+    _in_flight_by_assistant = defaultdict(int)
+    _lock = threading.Lock()
+    _metrics = {'admitted': 0, **{reason: 0 for reason in REJECTION_REASONS}}
+
+    @staticmethod
+    def _student(key):
+        return Admission._students.get_or_set(key, _Student)
+
+    @staticmethod
+    def throttle(key):
+        """Take one message from the student's bucket; returns 0.0 or the seconds until the next one fits"""
+
+        with Admission._lock:
+            student = Admission._student(key)
+        wait = student.bucket.try_acquire(1)
+        with Admission._lock:
+            if wait:
+                Admission._metrics['student'] += 1
+            else:
+                student.notified = False
+        return wait
+
+    @staticmethod
+    def refund(key):
+        """Give back a message taken by `throttle`, for work that was shed for another reason"""
+
+        with Admission._lock:
+            student = Admission._student(key)
+        student.bucket.refund(1)
+
+    @staticmethod
+    def should_notify(key):
+        """True for the first rejection of a streak, so a flooding sender gets one reply, not one per message"""
+
+        with Admission._lock:
+            student = Admission._student(key)
+            notify = not student.notified
+            student.notified = True
+            return notify
+
+    @staticmethod
+    def enter(assistant_id):
+        """Reserve an in-flight slot; returns 0.0 (call `leave` when done) or the seconds to wait"""
+
+        assistant_id = str(assistant_id)
+        with Admission._lock:
+            if Admission._in_flight >= MAX_IN_FLIGHT:
+                Admission._metrics['worker'] += 1
+                return BUSY_RETRY_AFTER
+            if Admission._in_flight_by_assistant[assistant_id] >= MAX_IN_FLIGHT_PER_ASSISTANT:
+                Admission._metrics['assistant'] += 1
+                return BUSY_RETRY_AFTER
+            Admission._in_flight += 1
+            Admission._in_flight_by_assistant[assistant_id] += 1
+            Admission._metrics['admitted'] += 1
+            return 0.0
+
+    @staticmethod
+    def leave(assistant_id):
+        assistant_id = str(assistant_id)
+        with Admission._lock:
+            Admission._in_flight -= 1
+            Admission._in_flight_by_assistant[assistant_id] -= 1
+            if Admission._in_flight_by_assistant[assistant_id] <= 0:
+                del Admission._in_flight_by_assistant[assistant_id]
+
+    @staticmethod
+    def admit(key, assistant_id):
+        """`throttle` then `enter`; a message shed for concurrency does not count against the student"""
+
+        wait = Admission.throttle(key)
+        if wait:
+            return wait
+        wait = Admission.enter(assistant_id)
+        if wait:
+            Admission.refund(key)
+        return wait
+
+    @staticmethod
+    def metrics():
+        with Admission._lock:
+            return dict(
+                Admission._metrics,
+                in_flight=Admission._in_flight,
+                busiest_assistant=max(Admission._in_flight_by_assistant.values(), default=0),
+                students=len(Admission._students)
+            )
@@ -0,0 +1,111 @@
+"""Per-assistant semantic cache of chat answers"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from services.ttl_cache import TTLCache
+
+# Cosine similarity between refined-question embeddings needed to reuse an answer
+SIMILARITY_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', 0.95))
+MAX_ENTRIES_PER_ASSISTANT = int(os.getenv('ANSWER_CACHE_SIZE', 256))
+MAX_ASSISTANTS = int(os.getenv('ANSWER_CACHE_ASSISTANTS', 500))
+
+
+class _Bucket:
+    """Cached answers of one assistant, valid for one `content_version`"""
+
+    def __init__(self, version):
+        self.version = version
+        self.entries = OrderedDict()
+        self.next_id = 0
+        self._matrix = None
+        self._ids = []
+
+    def matrix(self):
+        if self._matrix is None:
+            self._ids = list(self.entries)
+            self._matrix = np.stack([self.entries[entry_id][0] for entry_id in self._ids]) if self._ids else None
+        return self._ids, self._matrix
+
+    def add(self, vector, answer):
+        self.entries[self.next_id] = (vector, answer)
+        self.next_id += 1
+        while len(self.entries) > MAX_ENTRIES_PER_ASSISTANT:
+            self.entries.popitem(last=False)
+        self._matrix = None
+
+
+class AnswerCache:
+    """Reuses answers to questions that are near-duplicates of earlier ones.
+
+    Entries are keyed by the normalized refined-question embedding and grouped
+    per assistant. A bucket is dropped as soon as the assistant's `content_version`
+    changes, so answers never outlive the content they were built from. Buckets
+    and entries are evicted least recently used.
+    """
+
+    _buckets = TTLCache(MAX_ASSISTANTS)
+    _lock = threading.Lock()
+    _metrics = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    @staticmethod
+    def normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def _bucket(assistant_id, version, create):
+        bucket = AnswerCache._buckets.get(assistant_id)
+        if bucket is not None and bucket.version != version:
+            AnswerCache._buckets.pop(assistant_id)
+            AnswerCache._metrics['invalidations'] += 1
+            bucket = None
+        if bucket is None and create:
+            bucket = _Bucket(version)
+            AnswerCache._buckets.set(assistant_id, bucket)
+        return bucket
+
+    @staticmethod
+    def lookup(assistant_id, version, embedding):
+        """Cached answer for the closest earlier question above the threshold, else None"""
+
+        vector = AnswerCache.normalize(embedding)
+        with AnswerCache._lock:
+            bucket = AnswerCache._bucket(str(assistant_id), version, create=False)
+            answer = None
+            if bucket is not None:
+                ids, matrix = bucket.matrix()
+                if matrix is not None:
+                    scores = matrix @ vector
+                    best = int(np.argmax(scores))
+                    if scores[best] >= SIMILARITY_THRESHOLD:
+                        entry_id = ids[best]
+                        bucket.entries.move_to_end(entry_id)
+                        answer = bucket.entries[entry_id][1]
+            AnswerCache._metrics['hits' if answer is not None else 'misses'] += 1
+            return answer
+
+    @staticmethod
+    def store(assistant_id, version, embedding, answer):
+        vector = AnswerCache.normalize(embedding)
+        with AnswerCache._lock:
+            AnswerCache._bucket(str(assistant_id), version, create=True).add(vector, answer)
+
+    @staticmethod
+    def invalidate(assistant_id):
+        with AnswerCache._lock:
+            AnswerCache._buckets.pop(str(assistant_id))
+
+    @staticmethod
+    def metrics():
+        with AnswerCache._lock:
+            metrics = dict(AnswerCache._metrics)
+            metrics['entries'] = sum(len(bucket.entries) for bucket in AnswerCache._buckets.values())
+            metrics['assistants'] = len(AnswerCache._buckets)
+        lookups = metrics['hits'] + metrics['misses']
+        metrics['hit_rate'] = metrics['hits'] / lookups if lookups else 0.0
+        return metrics
@@ -0,0 +1,105 @@
+"""In-memory routing table from channel webhooks to assistants"""
+
+import os
+import threading
+import time
+from collections import namedtuple
+
+from models.channel import Channel
+from utils import Utils
+
+Route = namedtuple('Route', ['channel_id', 'name', 'assistant_id', 'access_token'])
+
+
+class ChannelRouter:
+    """Maps WhatsApp phone number ids / display numbers and Telegram channel ids to
+    their channel, primary assistant and access token.
+
+    The table is loaded once and rebuilt when channels or assistant connections
+    change in this process; other processes rebuild it every CHANNEL_ROUTES_TTL seconds.
+    Those periodic rebuilds run in a background thread, one at a time, while
+    requests keep using the current table.
+    """
+
+    refresh_interval = int(os.getenv('CHANNEL_ROUTES_TTL', 60))
+    _whatsapp_by_phone_number_id = {}
+    _whatsapp_by_number = {}
+    _telegram = {}
+    _loaded_at = None
+    _loading = False
+    _lock = threading.Lock()
+    _load_lock = threading.Lock()
+
+    @staticmethod
+    def load():
+        whatsapp_by_phone_number_id, whatsapp_by_number, telegram = {}, {}, {}
+        channels = Channel.objects(name__in=['whatsapp', 'telegram']).no_dereference().only('id', 'name', 'profile', 'assistants')
+        for channel in channels:
+            if not channel.assistants:
+                continue
+            profile = channel.profile or {}
+            if channel.name == 'whatsapp':
+                route = Route(channel.id, channel.name, channel.assistants[0].id, profile.get('access_token'))
+                if profile.get('phone_number_id'):
+                    whatsapp_by_phone_number_id[str(profile['phone_number_id'])] = route
+                if profile.get('phone_number'):
+                    whatsapp_by_number[Utils.normalize_phone_number(profile['phone_number'])] = route
+            else:
+                telegram[channel.id] = Route(channel.id, channel.name, channel.assistants[0].id, profile.get('access_key'))
+
+        with ChannelRouter._lock:
+            ChannelRouter._whatsapp_by_phone_number_id = whatsapp_by_phone_number_id
+            ChannelRouter._whatsapp_by_number = whatsapp_by_number
+            ChannelRouter._telegram = telegram
+            ChannelRouter._loaded_at = time.monotonic()
+
+    @staticmethod
+    def refresh():
+        ChannelRouter.load()
+
+    @staticmethod
+    def ensure_loaded():
+        loaded_at = ChannelRouter._loaded_at
+        if loaded_at is None:
+            # Nothing to serve yet, the first request loads the table and the others wait for it
+            with ChannelRouter._load_lock:
+                if ChannelRouter._loaded_at is None:
+                    ChannelRouter.load()
+        elif time.monotonic() - loaded_at > ChannelRouter.refresh_interval:
+            ChannelRouter.refresh_in_background()
+
+    @staticmethod
+    def refresh_in_background():
+        with ChannelRouter._lock:
+            if ChannelRouter._loading:
+                return
+            ChannelRouter._loading = True
+        threading.Thread(target=ChannelRouter._background_load, name='channel-routes', daemon=True).start()
+
+    @staticmethod
+    def _background_load():
+        try:
+            with ChannelRouter._load_lock:
+                ChannelRouter.load()
+        except Exception as e:
+            print(f"Error loading channel routes: {e}")
+        finally:
+            with ChannelRouter._lock:
+                ChannelRouter._loading = False
+
+    @staticmethod
+    def whatsapp(phone_number_id, display_phone_number):
+        ChannelRouter.ensure_loaded()
+        route = ChannelRouter._whatsapp_by_phone_number_id.get(str(phone_number_id))
+        if route is None and display_phone_number:
+            route = ChannelRouter._whatsapp_by_number.get(Utils.normalize_phone_number(display_phone_number))
+            if route is not None:
+                # Remember the phone number id so later lookups skip the normalization
+                with ChannelRouter._lock:
+                    ChannelRouter._whatsapp_by_phone_number_id[str(phone_number_id)] = route
+        return route
+
+    @staticmethod
+    def telegram(channel_id):
+        ChannelRouter.ensure_loaded()
+        return ChannelRouter._telegram.get(channel_id)
@@ -1,12 +1,76 @@
 import os
-import requests
+import re
+import time
+import threading
+import jwt
+from services.http_client import HttpClient
+
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+# Used when Google's response carries no max-age
+DEFAULT_KEYS_MAX_AGE = 3600
+# Unknown key ids force a refresh at most this often, so forged tokens can't hammer Google
+MIN_KEYS_REFRESH_INTERVAL = 60
+# Expired keys keep verifying logins this long while Google's endpoint can't be reached;
+# failed fetches are retried at most every MIN_KEYS_REFRESH_INTERVAL seconds
+STALE_KEYS_GRACE = 6 * 3600
+CLOCK_SKEW_SECONDS = 30
 
 class GoogleLogin:
+    _keys = {}
+    _expires_at = 0
+    _fetched_at = 0
+    _retry_at = 0
+    _lock = threading.Lock()
+
+    @staticmethod
+    def refresh_signing_keys():
+        response = HttpClient.get(GOOGLE_CERTS_URL)
+        response.raise_for_status()
+        max_age = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        GoogleLogin._keys = {jwk['kid']: jwt.PyJWK(jwk).key for jwk in response.json()['keys']}
+        GoogleLogin._fetched_at = time.monotonic()
+        GoogleLogin._expires_at = GoogleLogin._fetched_at + (int(max_age.group(1)) if max_age else DEFAULT_KEYS_MAX_AGE)
+
+    @staticmethod
+    def get_signing_key(kid):
+        now = time.monotonic()
+        key = GoogleLogin._keys.get(kid)
+        if key is not None and now < GoogleLogin._expires_at:
+            return key
+
+        with GoogleLogin._lock:
+            # Another thread may have refreshed the keys while we waited
+            key = GoogleLogin._keys.get(kid)
+            expired = now >= GoogleLogin._expires_at
+            due = expired or (key is None and now - GoogleLogin._fetched_at >= MIN_KEYS_REFRESH_INTERVAL)
+            if due and now >= GoogleLogin._retry_at:
+                try:
+                    GoogleLogin.refresh_signing_keys()
+                except Exception as e:
+                    print(f"Error refreshing Google signing keys: {e}")
+                    GoogleLogin._retry_at = now + MIN_KEYS_REFRESH_INTERVAL
+                key = GoogleLogin._keys.get(kid)
+            if now >= GoogleLogin._expires_at + STALE_KEYS_GRACE:
+                return None
+        return key
+
+    @staticmethod
     def verify_google_token(token):
         try:
-            response = requests.get(f'https://oauth2.googleapis.com/tokeninfo?id_token={token}')
-            user_info = response.json()
-            if response.status_code != 200 or user_info['aud'] != os.getenv('GOOGLE_CLIENT_ID'):
+            kid = jwt.get_unverified_header(token).get('kid')
+            key = GoogleLogin.get_signing_key(kid)
+            if key is None:
+                return None
+            user_info = jwt.decode(
+                token,
+                key,
+                algorithms=['RS256'],
+                audience=os.getenv('GOOGLE_CLIENT_ID'),
+                leeway=CLOCK_SKEW_SECONDS,
+                options={'require': ['aud', 'exp', 'iat', 'iss', 'sub']}
+            )
+            if user_info['iss'] not in GOOGLE_ISSUERS:
                 return None
             return user_info
         except Exception as e:
@@ -0,0 +1,97 @@
+"""Shared outbound HTTP client with pooled connections, timeouts and retries"""
+
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeouts applied to every call unless overridden
+DEFAULT_TIMEOUT = (float(os.getenv('HTTP_CONNECT_TIMEOUT', 3.05)), float(os.getenv('HTTP_READ_TIMEOUT', 20)))
+POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 20))
+MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 3))
+RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', 0.5))
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+class HttpClient:
+    """Keeps one keep-alive session per host and records per-host latency.
+
+    Idempotent calls are retried with exponential backoff on connection errors,
+    429 and 5xx (honouring Retry-After). Other calls are only retried when the
+    connection could not be established, so a message is never sent twice.
+    """
+
+    _sessions = {}
+    _metrics = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _retry(idempotent):
+        if idempotent:
+            return Retry(
+                total=MAX_RETRIES,
+                backoff_factor=RETRY_BACKOFF,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=None,
+                respect_retry_after_header=True,
+                raise_on_status=False
+            )
+        return Retry(total=MAX_RETRIES, connect=MAX_RETRIES, read=0, status=0, other=0, backoff_factor=RETRY_BACKOFF)
+
+    @staticmethod
+    def session(host, idempotent):
+        key = (host, idempotent)
+        session = HttpClient._sessions.get(key)
+        if session is None:
+            with HttpClient._lock:
+                session = HttpClient._sessions.get(key)
+                if session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=HttpClient._retry(idempotent))
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    HttpClient._sessions[key] = session
+        return session
+
+    @staticmethod
+    def request(method, url, idempotent=None, timeout=DEFAULT_TIMEOUT, **kwargs):
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        host = urlparse(url).netloc
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = HttpClient.session(host, idempotent).request(method, url, timeout=timeout, **kwargs)
+            failed = response.status_code >= 500
+            return response
+        finally:
+            HttpClient.record(host, time.perf_counter() - started, failed)
+
+    @staticmethod
+    def get(url, **kwargs):
+        return HttpClient.request('GET', url, **kwargs)
+
+    @staticmethod
+    def post(url, **kwargs):
+        return HttpClient.request('POST', url, **kwargs)
+
+    @staticmethod
+    def record(host, seconds, failed):
+        with HttpClient._lock:
+            stats = HttpClient._metrics.setdefault(host, {'count': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            stats['count'] += 1
+            stats['errors'] += int(failed)
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    @staticmethod
+    def metrics():
+        """Per-host request count, error count and latency totals"""
+
+        with HttpClient._lock:
+            return {host: dict(stats) for host, stats in HttpClient._metrics.items()}
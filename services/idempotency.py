@@ -0,0 +1,60 @@
+"""Deduplication of inbound channel messages"""
+
+import os
+import threading
+
+from mongoengine import NotUniqueError
+
+from models.processed_message import ProcessedMessage
+from services.ttl_cache import TTLCache
+
+
+class IdempotencyStore:
+    """Remembers accepted platform message ids in a bounded in-memory LRU backed by
+    a TTL collection, so webhook redeliveries are dropped before any other work.
+    """
+
+    _recent = TTLCache(int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 50000)))
+    _lock = threading.Lock()
+    _metrics = {'accepted': 0, 'duplicates_memory': 0, 'duplicates_persistent': 0}
+
+    @staticmethod
+    def key(channel, message_id):
+        return f'{channel}:{message_id}'
+
+    @staticmethod
+    def claim(channel, message_id):
+        """Return True the first time a message is seen, False for duplicates"""
+
+        key = IdempotencyStore.key(channel, message_id)
+        if not IdempotencyStore._recent.add(key, True):
+            with IdempotencyStore._lock:
+                IdempotencyStore._metrics['duplicates_memory'] += 1
+            return False
+
+        try:
+            ProcessedMessage(id=key).save(force_insert=True)
+        except NotUniqueError:
+            with IdempotencyStore._lock:
+                IdempotencyStore._metrics['duplicates_persistent'] += 1
+            return False
+        except Exception as e:
+            # Fail open, a rare duplicate answer is better than a dropped message
+            print(f"Error recording processed message: {e}")
+
+        with IdempotencyStore._lock:
+            IdempotencyStore._metrics['accepted'] += 1
+        return True
+
+    @staticmethod
+    def release(channel, message_id):
+        """Forget a claimed message so a redelivery is processed again"""
+
+        key = IdempotencyStore.key(channel, message_id)
+        IdempotencyStore._recent.pop(key)
+        ProcessedMessage.objects(id=key).delete()
+
+    @staticmethod
+    def metrics():
+        with IdempotencyStore._lock:
+            return dict(IdempotencyStore._metrics)
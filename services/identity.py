@@ -0,0 +1,91 @@
+"""Resolution of channel identities (WhatsApp number, Telegram username) to students"""
+
+import os
+
+from mongoengine import NotUniqueError
+
+from models.student import Student
+from services.ttl_cache import TTLCache
+from utils import Utils
+
+CHANNELS = ('whatsapp', 'telegram')
+_MISSING = object()
+
+
+class IdentityResolver:
+    """Resolves channel sender ids to student ids through indexed, normalized
+    fields behind a per-process TTL cache. Unknown senders are cached for a
+    shorter time so a newly registered number is picked up quickly.
+    """
+
+    negative_ttl = int(os.getenv('IDENTITY_NEGATIVE_CACHE_TTL', 30))
+    _entries = TTLCache(int(os.getenv('IDENTITY_CACHE_SIZE', 100000)), ttl=int(os.getenv('IDENTITY_CACHE_TTL', 600)))
+
+    @staticmethod
+    def normalize(channel, identifier):
+        if not identifier:
+            return None
+        if channel == 'whatsapp':
+            return Utils.normalize_phone_number(identifier) or None
+        return str(identifier).strip().lstrip('@').lower() or None
+
+    @staticmethod
+    def _lookup(channel, normalized, identifier):
+        if channel == 'whatsapp':
+            student = Student.objects(whatsapp_id=normalized).only('id').first()
+            legacy = {'wa_number__in': list({identifier, normalized, '+' + normalized})}
+            backfill = {'set__whatsapp_id': normalized}
+        else:
+            student = Student.objects(tg_username=normalized).only('id').first()
+            legacy = {'tg_handle__in': list({identifier, normalized, '@' + normalized})}
+            backfill = {'set__tg_username': normalized}
+        if student:
+            return student.id
+
+        # Students saved before identities were normalized only have the raw value
+        student = Student.objects(**legacy).only('id').first()
+        if not student:
+            return None
+        try:
+            Student.objects(id=student.id).update(**backfill)
+        except NotUniqueError:
+            pass
+        return student.id
+
+    @staticmethod
+    def resolve(channel, identifier):
+        """Return the id of the student behind a channel sender, or None"""
+
+        normalized = IdentityResolver.normalize(channel, identifier)
+        if not normalized:
+            return None
+        key = f'{channel}:{normalized}'
+        student_id = IdentityResolver._entries.get(key, _MISSING)
+        if student_id is _MISSING:
+            student_id = IdentityResolver._lookup(channel, normalized, str(identifier))
+            if student_id:
+                IdentityResolver._entries.set(key, student_id)
+            else:
+                IdentityResolver._entries.set(key, None, ttl=IdentityResolver.negative_ttl)
+        return student_id
+
+    @staticmethod
+    def invalidate(channel, identifier):
+        normalized = IdentityResolver.normalize(channel, identifier)
+        if normalized:
+            IdentityResolver._entries.pop(f'{channel}:{normalized}')
+
+    @staticmethod
+    def set_identities(student, wa_number=None, tg_handle=None):
+        """Update a student's channel identities and their normalized lookup fields (caller saves)"""
+
+        if wa_number:
+            IdentityResolver.invalidate('whatsapp', student.wa_number)
+            IdentityResolver.invalidate('whatsapp', wa_number)
+            student.wa_number = wa_number
+            student.whatsapp_id = IdentityResolver.normalize('whatsapp', wa_number)
+        if tg_handle:
+            IdentityResolver.invalidate('telegram', student.tg_handle)
+            IdentityResolver.invalidate('telegram', tg_handle)
+            student.tg_handle = tg_handle
+            student.tg_username = IdentityResolver.normalize('telegram', tg_handle)
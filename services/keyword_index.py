@@ -0,0 +1,140 @@
+"""In-process BM25 keyword index over each assistant's digests"""
+
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+
+from services.ttl_cache import TTLCache
+
+MAX_ASSISTANTS = int(os.getenv('KEYWORD_INDEX_ASSISTANTS', 200))
+K1 = 1.2
+B = 0.75
+# Title, topics and keywords are repeated so that matches on them weigh more than body text
+FIELD_BOOST = 3
+# BM25 score mapped to 0.5 when scaling scores to 0..1 as s / (s + SCORE_SATURATION); one rare
+# term in a digest scores about 4, several rare terms in its title 15 and more
+SCORE_SATURATION = float(os.getenv('KEYWORD_SCORE_SATURATION', 10))
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+STOPWORDS = frozenset(
+    'a an and are as at be by can do does for from how i in is it its me of on or that the this to was what when where which who why with you your'.split()
+)
+
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall((text or '').lower()) if token not in STOPWORDS]
+
+
+def version_key(content_version):
+    """Compare content_version values at Mongo's millisecond, naive UTC precision"""
+
+    if content_version is None:
+        return None
+    return content_version.replace(tzinfo=None, microsecond=content_version.microsecond // 1000 * 1000)
+
+
+class _Bm25:
+    def __init__(self, version):
+        self.version = version
+        self.postings = defaultdict(dict)
+        self.keys = []
+        self.lengths = []
+        self.total_length = 0
+
+    def add(self, key, tokens):
+        doc = len(self.keys)
+        self.keys.append(key)
+        self.lengths.append(len(tokens))
+        self.total_length += len(tokens)
+        for term, count in Counter(tokens).items():
+            self.postings[term][doc] = count
+
+    def add_content(self, assistant_id, o_or_s_label, content):
+        for digest in content.digests:
+            boosted = ' '.join([digest.title or '', ' '.join(digest.topics or []), ' '.join(digest.keywords or [])])
+            tokens = tokenize(digest.content) + tokenize(boosted) * FIELD_BOOST
+            self.add(f"{assistant_id}__{content.id}__{digest.id}__bm25__{o_or_s_label}", tokens)
+
+    def search(self, query_tokens, o_or_s_label, top_k):
+        if not self.keys:
+            return []
+        docs = len(self.keys)
+        average_length = self.total_length / docs or 1
+        scores = defaultdict(float)
+        for term in set(query_tokens):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc, count in postings.items():
+                norm = K1 * (1 - B + B * self.lengths[doc] / average_length)
+                scores[doc] += idf * count * (K1 + 1) / (count + norm)
+        suffix = f'__{o_or_s_label}'
+        ranked = sorted(((score, doc) for doc, score in scores.items() if self.keys[doc].endswith(suffix)), reverse=True)[:top_k]
+        return [(self.keys[doc], score) for score, doc in ranked]
+
+
+class KeywordIndex:
+    """BM25 indexes of digest text, titles, topics and keywords, one per assistant.
+
+    An index is built from the assistant document on first use and is tagged with
+    the assistant's `content_version`; /digest appends new content to a loaded index in
+    place, and any other change (or a change made by another process) shows up as
+    a different `content_version` and triggers a rebuild on the next search.
+    """
+
+    _indexes = TTLCache(MAX_ASSISTANTS)
+    _lock = threading.Lock()
+
+    @staticmethod
+    def build(assistant):
+        index = _Bm25(version_key(assistant.content_version))
+        for content in assistant.own_content:
+            index.add_content(assistant.id, 'own', content)
+        for content in assistant.supporting_content:
+            index.add_content(assistant.id, 'supported', content)
+        return index
+
+    @staticmethod
+    def get(assistant):
+        assistant_id = str(assistant.id)
+        version = version_key(assistant.content_version)
+        with KeywordIndex._lock:
+            index = KeywordIndex._indexes.get(assistant_id)
+            if index is not None and index.version == version:
+                return index
+
+        index = KeywordIndex.build(assistant)
+        KeywordIndex._indexes.set(assistant_id, index)
+        return index
+
+    @staticmethod
+    def add_content(assistant_id, o_or_s_label, content, previous_version, version):
+        """Append newly digested content to a loaded index that was current before the save"""
+
+        assistant_id = str(assistant_id)
+        with KeywordIndex._lock:
+            index = KeywordIndex._indexes.get(assistant_id)
+            if index is None:
+                return
+            if index.version != version_key(previous_version):
+                KeywordIndex._indexes.pop(assistant_id)
+                return
+            index.add_content(assistant_id, o_or_s_label, content)
+            index.version = version_key(version)
+
+    @staticmethod
+    def search(assistant, o_or_s_label, query, top_k=10):
+        """Matches in the `{"id", "score"}` shape of vector matches.
+
+        Scores are scaled to 0..1 with a saturating transform rather than against
+        the top hit, so a match on one weak term stays weak instead of being fused
+        as a perfect match.
+        """
+
+        index = KeywordIndex.get(assistant)
+        tokens = tokenize(query)
+        with KeywordIndex._lock:
+            results = index.search(tokens, o_or_s_label, top_k)
+        return [{'id': key, 'score': score / (score + SCORE_SATURATION)} for key, score in results]
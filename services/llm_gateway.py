@@ -0,0 +1,293 @@
+"""Single entry point for OpenAI completion and embedding calls"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+import openai
+from openai import AsyncOpenAI, OpenAI
+
+from services.rate_limit import TokenBucket
+
+# Request priorities, lower runs first
+CHAT = 0
+INGESTION = 1
+
+DEFAULT_CHAT_MODEL = "gpt-3.5-turbo-1106"
+DEFAULT_EMBEDDING_MODEL = "text-embedding-3-small"
+
+REQUESTS_PER_MINUTE = int(os.getenv('OPENAI_RPM', 3000))
+TOKENS_PER_MINUTE = int(os.getenv('OPENAI_TPM', 1000000))
+MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 5))
+REQUEST_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', 60))
+# Completion tokens reserved against the TPM budget when max_tokens is not given
+DEFAULT_COMPLETION_TOKENS = 500
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+
+class _InflightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class LLMGateway:
+    """Shares one pooled OpenAI client across the process and applies request and
+    token rate limits. Chat requests are admitted before ingestion requests, 429s
+    and transient errors are retried with backoff, and identical in-flight
+    requests are coalesced into one upstream call. The `*_async` variants share
+    the same budgets and metrics for use from the event loop.
+    """
+
+    _client = None
+    _async_client = None
+    _client_lock = threading.Lock()
+    _request_bucket = TokenBucket(REQUESTS_PER_MINUTE / 60, REQUESTS_PER_MINUTE)
+    _token_bucket = TokenBucket(TOKENS_PER_MINUTE / 60, TOKENS_PER_MINUTE)
+    _limit_lock = threading.Lock()
+    _waiting_chat = 0
+    _inflight = {}
+    _inflight_lock = threading.Lock()
+    # Coalesced calls of the serving event loop
+    _inflight_async = {}
+    _metrics = {'requests': 0, 'coalesced': 0, 'retries': 0, 'throttled_seconds': 0.0}
+
+    @staticmethod
+    def client():
+        if LLMGateway._client is None:
+            with LLMGateway._client_lock:
+                if LLMGateway._client is None:
+                    # Retries are handled here so they also go through the rate limiter
+                    LLMGateway._client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0, timeout=REQUEST_TIMEOUT)
+        return LLMGateway._client
+
+    @staticmethod
+    def async_client():
+        if LLMGateway._async_client is None:
+            with LLMGateway._client_lock:
+                if LLMGateway._async_client is None:
+                    LLMGateway._async_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0, timeout=REQUEST_TIMEOUT)
+        return LLMGateway._async_client
+
+    @staticmethod
+    def estimate_tokens(texts):
+        # Rough estimate (~4 characters per token) that is good enough for rate limiting
+        return sum(len(text or '') for text in texts) // 4 + 1
+
+    @staticmethod
+    def try_acquire(tokens, priority):
+        """Take one request and `tokens` tokens if both fit, otherwise return the seconds to wait"""
+
+        if priority != CHAT and LLMGateway._waiting_chat:
+            return 0.05
+        wait = LLMGateway._request_bucket.try_acquire(1)
+        if not wait:
+            wait = LLMGateway._token_bucket.try_acquire(tokens)
+            if wait:
+                LLMGateway._request_bucket.refund(1)
+        return wait
+
+    @staticmethod
+    def waiting_chat(delta):
+        with LLMGateway._limit_lock:
+            LLMGateway._waiting_chat += delta
+
+    @staticmethod
+    def acquire(tokens, priority):
+        """Block until the request fits in both the request and the token budget"""
+
+        started = time.monotonic()
+        if priority == CHAT:
+            LLMGateway.waiting_chat(1)
+        try:
+            while True:
+                wait = LLMGateway.try_acquire(tokens, priority)
+                if not wait:
+                    break
+                time.sleep(min(wait, 0.25))
+        finally:
+            if priority == CHAT:
+                LLMGateway.waiting_chat(-1)
+        LLMGateway.record('throttled_seconds', time.monotonic() - started)
+
+    @staticmethod
+    async def acquire_async(tokens, priority):
+        started = time.monotonic()
+        if priority == CHAT:
+            LLMGateway.waiting_chat(1)
+        try:
+            while True:
+                wait = LLMGateway.try_acquire(tokens, priority)
+                if not wait:
+                    break
+                await asyncio.sleep(min(wait, 0.25))
+        finally:
+            if priority == CHAT:
+                LLMGateway.waiting_chat(-1)
+        LLMGateway.record('throttled_seconds', time.monotonic() - started)
+
+    @staticmethod
+    def retry_delay(error, attempt):
+        response = getattr(error, 'response', None)
+        if response is not None:
+            try:
+                return float(response.headers.get('retry-after'))
+            except (TypeError, ValueError):
+                pass
+        return min(2 ** attempt, 30) * (0.5 + random.random())
+
+    @staticmethod
+    def call_with_retries(fn, tokens, priority):
+        for attempt in range(MAX_RETRIES + 1):
+            LLMGateway.acquire(tokens, priority)
+            LLMGateway.record('requests')
+            try:
+                return fn()
+            except RETRYABLE_ERRORS as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                LLMGateway.record('retries')
+                time.sleep(LLMGateway.retry_delay(e, attempt))
+
+    @staticmethod
+    async def call_with_retries_async(fn, tokens, priority):
+        for attempt in range(MAX_RETRIES + 1):
+            await LLMGateway.acquire_async(tokens, priority)
+            LLMGateway.record('requests')
+            try:
+                return await fn()
+            except RETRYABLE_ERRORS as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                LLMGateway.record('retries')
+                await asyncio.sleep(LLMGateway.retry_delay(e, attempt))
+
+    @staticmethod
+    def coalesce(key, fn):
+        """Run `fn` once for all concurrent callers that share `key`"""
+
+        with LLMGateway._inflight_lock:
+            call = LLMGateway._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = LLMGateway._inflight[key] = _InflightCall()
+
+        if not leader:
+            LLMGateway.record('coalesced')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with LLMGateway._inflight_lock:
+                LLMGateway._inflight.pop(key, None)
+            call.done.set()
+
+    @staticmethod
+    async def coalesce_async(key, fn):
+        """Await `fn()` once for all concurrent coroutines that share `key`.
+
+        The call runs as its own task, so a caller that is cancelled (a client
+        disconnect) does not cancel it for the others; it is only cancelled
+        once no caller is waiting for it.
+        """
+
+        entry = LLMGateway._inflight_async.get(key)
+        if entry is None:
+            entry = LLMGateway._inflight_async[key] = {'task': asyncio.ensure_future(fn()), 'waiters': 0}
+            entry['task'].add_done_callback(lambda _: LLMGateway._forget_async(key, entry))
+        else:
+            LLMGateway.record('coalesced')
+
+        entry['waiters'] += 1
+        try:
+            return await asyncio.shield(entry['task'])
+        finally:
+            entry['waiters'] -= 1
+            if not entry['waiters'] and not entry['task'].done():
+                LLMGateway._forget_async(key, entry)
+                entry['task'].cancel()
+
+    @staticmethod
+    def _forget_async(key, entry):
+        if LLMGateway._inflight_async.get(key) is entry:
+            del LLMGateway._inflight_async[key]
+
+    @staticmethod
+    def request_key(kind, payload):
+        return hashlib.sha256(json.dumps([kind, payload], sort_keys=True, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def completion_params(messages, model, temperature, max_tokens):
+        params = {'model': model, 'messages': messages, 'temperature': temperature}
+        if max_tokens:
+            params['max_tokens'] = max_tokens
+        return params, LLMGateway.estimate_tokens(m['content'] for m in messages) + (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+    @staticmethod
+    def complete(messages, model=DEFAULT_CHAT_MODEL, temperature=0, max_tokens=None, priority=CHAT):
+        """Return the content of a chat completion"""
+
+        params, tokens = LLMGateway.completion_params(messages, model, temperature, max_tokens)
+
+        def run():
+            response = LLMGateway.call_with_retries(lambda: LLMGateway.client().chat.completions.create(**params), tokens, priority)
+            return response.choices[0].message.content
+
+        return LLMGateway.coalesce(LLMGateway.request_key('complete', params), run)
+
+    @staticmethod
+    def embed(texts, model=DEFAULT_EMBEDDING_MODEL, priority=CHAT):
+        """Return one embedding per input text"""
+
+        params = {'model': model, 'input': list(texts)}
+        tokens = LLMGateway.estimate_tokens(params['input'])
+
+        def run():
+            response = LLMGateway.call_with_retries(lambda: LLMGateway.client().embeddings.create(**params), tokens, priority)
+            return [item.embedding for item in response.data]
+
+        return LLMGateway.coalesce(LLMGateway.request_key('embed', params), run)
+
+    @staticmethod
+    async def complete_async(messages, model=DEFAULT_CHAT_MODEL, temperature=0, max_tokens=None, priority=CHAT):
+        params, tokens = LLMGateway.completion_params(messages, model, temperature, max_tokens)
+
+        async def run():
+            response = await LLMGateway.call_with_retries_async(lambda: LLMGateway.async_client().chat.completions.create(**params), tokens, priority)
+            return response.choices[0].message.content
+
+        return await LLMGateway.coalesce_async(LLMGateway.request_key('complete', params), run)
+
+    @staticmethod
+    async def embed_async(texts, model=DEFAULT_EMBEDDING_MODEL, priority=CHAT):
+        params = {'model': model, 'input': list(texts)}
+        tokens = LLMGateway.estimate_tokens(params['input'])
+
+        async def run():
+            response = await LLMGateway.call_with_retries_async(lambda: LLMGateway.async_client().embeddings.create(**params), tokens, priority)
+            return [item.embedding for item in response.data]
+
+        return await LLMGateway.coalesce_async(LLMGateway.request_key('embed', params), run)
+
+    @staticmethod
+    def record(name, value=1):
+        with LLMGateway._limit_lock:
+            LLMGateway._metrics[name] += value
+
+    @staticmethod
+    def metrics():
+        with LLMGateway._limit_lock:
+            return dict(LLMGateway._metrics, waiting_chat=LLMGateway._waiting_chat)
@@ -0,0 +1,37 @@
+"""Cached assistant membership checks"""
+
+import os
+
+from models.assistant import Assistant
+from services.ttl_cache import TTLCache
+
+
+class Membership:
+    """Per-process cache of assistant rosters as sets of student ids.
+
+    A roster is loaded with one projected lookup by assistant id, without
+    dereferencing any student, and is invalidated locally when enrollments
+    change; other processes reload it after MEMBERSHIP_CACHE_TTL seconds.
+    """
+
+    _rosters = TTLCache(int(os.getenv('MEMBERSHIP_CACHE_SIZE', 1000)), ttl=int(os.getenv('MEMBERSHIP_CACHE_TTL', 60)))
+
+    @staticmethod
+    def roster(assistant_id):
+        assistant_id = str(assistant_id)
+        roster = Membership._rosters.get(assistant_id)
+        if roster is not None:
+            return roster
+
+        assistant = Assistant.objects(id=assistant_id).only('allowed_students').as_pymongo().first()
+        roster = frozenset(str(student_id) for student_id in (assistant or {}).get('allowed_students') or [])
+        Membership._rosters.set(assistant_id, roster)
+        return roster
+
+    @staticmethod
+    def is_allowed(assistant_id, student_id):
+        return str(student_id) in Membership.roster(assistant_id)
+
+    @staticmethod
+    def invalidate(assistant_id):
+        Membership._rosters.pop(str(assistant_id))
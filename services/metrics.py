@@ -0,0 +1,168 @@
+"""Timing spans and counters exported in the Prometheus text format"""
+
+import contextvars
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Histogram bucket upper bounds in seconds, sized for LLM-bound pipelines
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PREFIX = 'baman'
+
+# Labels inherited by every span recorded in the current request or job
+_context_labels = contextvars.ContextVar('metric_labels', default={})
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+class Metrics:
+    """Process-wide histograms and counters.
+
+    Spans pick up `route` and `assistant` labels from the current context, set per
+    request by the app and per job by the webhook workers. Components that already
+    keep their own counters are exported through registered collectors.
+    """
+
+    _histograms = {}
+    _counters = {}
+    _collectors = []
+    _lock = threading.Lock()
+
+    @staticmethod
+    def current_labels():
+        return dict(_context_labels.get())
+
+    @staticmethod
+    def reset_labels(**labels):
+        """Start a new request with only the given labels"""
+
+        _context_labels.set({k: v for k, v in labels.items() if v is not None})
+
+    @staticmethod
+    def set_labels(**labels):
+        """Add labels to the rest of the current request or job"""
+
+        _context_labels.set({**_context_labels.get(), **{k: v for k, v in labels.items() if v is not None}})
+
+    @staticmethod
+    @contextmanager
+    def labels(**labels):
+        """Apply labels inside the block only (fresh context for jobs run on worker threads)"""
+
+        token = _context_labels.set({k: v for k, v in labels.items() if v is not None})
+        try:
+            yield
+        finally:
+            _context_labels.reset(token)
+
+    @staticmethod
+    def observe(name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with Metrics._lock:
+            histogram = Metrics._histograms.get(key)
+            if histogram is None:
+                histogram = Metrics._histograms[key] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    @staticmethod
+    def increment(name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with Metrics._lock:
+            Metrics._counters[key] = Metrics._counters.get(key, 0) + value
+
+    @staticmethod
+    @contextmanager
+    def span(stage, **labels):
+        """Time a pipeline stage into the stage duration histogram"""
+
+        labels = {'route': '', 'assistant': '', **_context_labels.get(), **labels, 'stage': stage}
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            Metrics.observe('stage_duration_seconds', time.perf_counter() - started, status=status, **labels)
+
+    @staticmethod
+    def timed(stage):
+        """Decorator form of `span`, for plain and coroutine functions"""
+
+        def decorator(fn):
+            if inspect.iscoroutinefunction(fn):
+                @wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    with Metrics.span(stage):
+                        return await fn(*args, **kwargs)
+                return async_wrapper
+
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with Metrics.span(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def register_collector(fn):
+        """Register a callable returning (name, type, help, labels dict, value) samples at scrape time"""
+
+        Metrics._collectors.append(fn)
+
+    @staticmethod
+    def render():
+        """All metrics in the Prometheus text exposition format"""
+
+        with Metrics._lock:
+            histograms = sorted((key, dict(h, buckets=list(h['buckets']))) for key, h in Metrics._histograms.items())
+            counters = sorted(Metrics._counters.items())
+
+        lines = []
+        declared = set()
+
+        def declare(name, kind, help_text):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), histogram in histograms:
+            metric = f'{PREFIX}_{name}'
+            declare(metric, 'histogram', name.replace('_', ' '))
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                lines.append(f'{metric}_bucket{_format_labels(labels + (("le", bound),))} {count}')
+            lines.append(f'{metric}_bucket{_format_labels(labels + (("le", "+Inf"),))} {histogram["count"]}')
+            lines.append(f'{metric}_sum{_format_labels(labels)} {histogram["sum"]}')
+            lines.append(f'{metric}_count{_format_labels(labels)} {histogram["count"]}')
+
+        for (name, labels), value in counters:
+            metric = f'{PREFIX}_{name}'
+            declare(metric, 'counter', name.replace('_', ' '))
+            lines.append(f'{metric}{_format_labels(labels)} {value}')
+
+        for collector in Metrics._collectors:
+            try:
+                samples = list(collector())
+            except Exception as e:
+                print(f"Error collecting metrics: {e}")
+                continue
+            for name, kind, help_text, labels, value in samples:
+                metric = f'{PREFIX}_{name}'
+                declare(metric, kind, help_text)
+                lines.append(f'{metric}{_format_labels(tuple(sorted(labels.items())))} {value}')
+
+        return '\n'.join(lines) + '\n'
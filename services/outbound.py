@@ -0,0 +1,261 @@
+"""Rate-limited, ordered delivery of outbound channel messages"""
+
+import heapq
+import itertools
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+
+import requests
+
+from services.metrics import Metrics
+from services.rate_limit import TokenBucket
+from services.ttl_cache import TTLCache
+from utils import Utils
+
+# Per-bot throughput, per-chat throughput and maximum message length of each platform
+PLATFORM_LIMITS = {
+    'telegram': {
+        'rate': float(os.getenv('TELEGRAM_MESSAGES_PER_SECOND', 30)),
+        'chat_rate': float(os.getenv('TELEGRAM_CHAT_MESSAGES_PER_SECOND', 1)),
+        'max_length': 4096
+    },
+    'whatsapp': {
+        'rate': float(os.getenv('WHATSAPP_MESSAGES_PER_SECOND', 80)),
+        'chat_rate': float(os.getenv('WHATSAPP_CHAT_MESSAGES_PER_SECOND', 5)),
+        'max_length': 4096
+    }
+}
+MAX_SEND_ATTEMPTS = 5
+# WhatsApp Cloud API error codes for throughput and spam rate limits
+WHATSAPP_RATE_LIMIT_CODES = (4, 80007, 130429, 131048, 131056)
+MAX_CHAT_BUCKETS = 10000
+# Send failures worth retrying: the request never reached the platform, so it cannot be a duplicate
+RETRYABLE_SEND_ERRORS = (requests.ConnectionError,)
+
+
+class OutboundScheduler:
+    """Queues replies per chat and delivers them from worker threads.
+
+    Messages to one chat are sent strictly in order, one at a time; each bot and
+    each chat is throttled by a token bucket; long messages are split at the
+    platform limit; rate-limited sends are retried after `retry_after`, and
+    sends that fail to connect after a backoff. Workers never sleep on a chat:
+    a chat that has to wait is set aside until it is due and the worker moves
+    on to the next ready one.
+    """
+
+    workers = int(os.getenv('OUTBOUND_WORKERS', 4))
+    _ready = queue.Queue()
+    # (due time, sequence, chat key) of chats waiting for a bucket or a retry
+    _delayed = []
+    _sequence = itertools.count()
+    _chats = {}
+    _bot_buckets = {}
+    _chat_buckets = TTLCache(MAX_CHAT_BUCKETS)
+    _threads = []
+    _lock = threading.Lock()
+    _metrics = {'sent': 0, 'failed': 0, 'retries': 0, 'send_seconds': 0.0, 'max_send_seconds': 0.0}
+
+    @staticmethod
+    def split_message(text, limit):
+        """Split text at paragraph, line or word boundaries into parts of at most `limit` characters"""
+
+        parts = []
+        text = text or ''
+        while len(text) > limit:
+            cut = -1
+            for separator in ('\n\n', '\n', ' '):
+                cut = text.rfind(separator, 0, limit)
+                if cut > limit // 2:
+                    break
+            if cut <= 0:
+                cut = limit
+            parts.append(text[:cut].rstrip())
+            text = text[cut:].lstrip()
+        if text:
+            parts.append(text)
+        return parts
+
+    @staticmethod
+    def retry_after(platform, response):
+        """Seconds to wait before retrying a rate-limited send, None if the send was not rate limited"""
+
+        if not isinstance(response, dict):
+            return None
+        if platform == 'telegram':
+            if response.get('error_code') == 429:
+                return float((response.get('parameters') or {}).get('retry_after', 1))
+        elif (response.get('error') or {}).get('code') in WHATSAPP_RATE_LIMIT_CODES:
+            return 1.0
+        return None
+
+    @staticmethod
+    def _token_bucket(rate):
+        return TokenBucket(rate, max(rate, 1))
+
+    @staticmethod
+    def _bucket(buckets, key, rate):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = OutboundScheduler._token_bucket(rate)
+        return bucket
+
+    @staticmethod
+    def enqueue(platform, bot_key, chat_id, text, send):
+        """Schedule `send(part)` for each part of `text`, in order, for one chat"""
+
+        chat_key = (platform, bot_key, str(chat_id))
+        labels = Metrics.current_labels()
+        parts = OutboundScheduler.split_message(text, PLATFORM_LIMITS[platform]['max_length'])
+        with OutboundScheduler._lock:
+            pending = OutboundScheduler._chats.get(chat_key)
+            idle = pending is None
+            if idle:
+                pending = OutboundScheduler._chats[chat_key] = deque()
+            pending.extend((part, send, time.monotonic(), labels, 0) for part in parts)
+        if idle:
+            OutboundScheduler._start()
+            OutboundScheduler._ready.put(chat_key)
+
+    @staticmethod
+    def telegram(access_key, chat_id, text):
+        OutboundScheduler.enqueue('telegram', access_key, chat_id, text, lambda part: Utils.send_tg_message(access_key, chat_id, part))
+
+    @staticmethod
+    def whatsapp(sender_id, phone_number, text, sender_access_token):
+        OutboundScheduler.enqueue('whatsapp', sender_id, phone_number, text, lambda part: Utils.send_wa_message(sender_id, phone_number, part, sender_access_token))
+
+    @staticmethod
+    def _start():
+        if OutboundScheduler._threads:
+            return
+        with OutboundScheduler._lock:
+            if OutboundScheduler._threads:
+                return
+            for i in range(OutboundScheduler.workers):
+                thread = threading.Thread(target=OutboundScheduler._run, name=f'outbound-{i}', daemon=True)
+                thread.start()
+                OutboundScheduler._threads.append(thread)
+
+    @staticmethod
+    def _next_ready():
+        """Block until a chat is ready, moving set-aside chats that are due to the ready queue"""
+
+        while True:
+            with OutboundScheduler._lock:
+                now = time.monotonic()
+                while OutboundScheduler._delayed and OutboundScheduler._delayed[0][0] <= now:
+                    OutboundScheduler._ready.put(heapq.heappop(OutboundScheduler._delayed)[2])
+                timeout = OutboundScheduler._delayed[0][0] - now if OutboundScheduler._delayed else None
+            try:
+                return OutboundScheduler._ready.get(timeout=timeout)
+            except queue.Empty:
+                continue
+
+    @staticmethod
+    def _run():
+        while True:
+            chat_key = OutboundScheduler._next_ready()
+            delay = 0.0
+            try:
+                delay = OutboundScheduler._deliver_next(chat_key)
+            except Exception:
+                print("Error sending outbound message:")
+                traceback.print_exc()
+            finally:
+                with OutboundScheduler._lock:
+                    pending = OutboundScheduler._chats.get(chat_key)
+                    if not pending:
+                        OutboundScheduler._chats.pop(chat_key, None)
+                    elif delay:
+                        heapq.heappush(OutboundScheduler._delayed, (time.monotonic() + delay, next(OutboundScheduler._sequence), chat_key))
+                    else:
+                        OutboundScheduler._ready.put(chat_key)
+
+    @staticmethod
+    def rejected(response):
+        """True for a platform error response (a bad token, a user who blocked the bot), which is not retried"""
+
+        return isinstance(response, dict) and (response.get('ok') is False or 'error' in response)
+
+    @staticmethod
+    def _deliver_next(chat_key):
+        """Try to send the next part of a chat; returns the seconds before the chat should be tried again"""
+
+        platform, bot_key, _ = chat_key
+        limits = PLATFORM_LIMITS[platform]
+        with OutboundScheduler._lock:
+            pending = OutboundScheduler._chats.get(chat_key)
+            if not pending:
+                return 0.0
+            part, send, enqueued_at, labels, attempts = pending[0]
+            bot_bucket = OutboundScheduler._bucket(OutboundScheduler._bot_buckets, (platform, bot_key), limits['rate'])
+            chat_bucket = OutboundScheduler._chat_buckets.get_or_set(chat_key, lambda: OutboundScheduler._token_bucket(limits['chat_rate']))
+
+        wait = chat_bucket.try_acquire()
+        if wait:
+            return wait
+        wait = bot_bucket.try_acquire()
+        if wait:
+            chat_bucket.refund()
+            return wait
+
+        try:
+            with Metrics.labels(**labels), Metrics.span('outbound.send', platform=platform):
+                response = send(part)
+            wait = OutboundScheduler.retry_after(platform, response)
+        except RETRYABLE_SEND_ERRORS as e:
+            print(f"Error sending outbound message, will retry: {e}")
+            wait = min(2 ** attempts, 30)
+        except Exception:
+            OutboundScheduler._finish(chat_key, enqueued_at, failed=True)
+            raise
+
+        if wait is None:
+            failed = OutboundScheduler.rejected(response)
+            if failed:
+                print(f"Outbound message rejected by {platform}: {response}")
+            OutboundScheduler._finish(chat_key, enqueued_at, failed=failed)
+            return 0.0
+        if attempts + 1 >= MAX_SEND_ATTEMPTS:
+            OutboundScheduler._finish(chat_key, enqueued_at, failed=True)
+            return 0.0
+        with OutboundScheduler._lock:
+            pending[0] = (part, send, enqueued_at, labels, attempts + 1)
+        OutboundScheduler._record_retry()
+        return wait
+
+    @staticmethod
+    def _finish(chat_key, enqueued_at, failed):
+        """Drop the part at the head of a chat once it is sent or given up on"""
+
+        with OutboundScheduler._lock:
+            OutboundScheduler._chats[chat_key].popleft()
+        OutboundScheduler._record(time.monotonic() - enqueued_at, failed=failed)
+
+    @staticmethod
+    def _record(seconds, failed):
+        with OutboundScheduler._lock:
+            metrics = OutboundScheduler._metrics
+            metrics['failed' if failed else 'sent'] += 1
+            metrics['send_seconds'] += seconds
+            metrics['max_send_seconds'] = max(metrics['max_send_seconds'], seconds)
+
+    @staticmethod
+    def _record_retry():
+        with OutboundScheduler._lock:
+            OutboundScheduler._metrics['retries'] += 1
+
+    @staticmethod
+    def queue_depth():
+        with OutboundScheduler._lock:
+            return sum(len(pending) for pending in OutboundScheduler._chats.values())
+
+    @staticmethod
+    def metrics():
+        with OutboundScheduler._lock:
+            return dict(OutboundScheduler._metrics, queue_depth=sum(len(pending) for pending in OutboundScheduler._chats.values()), active_chats=len(OutboundScheduler._chats))
@@ -0,0 +1,90 @@
+"""Per-process cache of authenticated principals"""
+
+import os
+
+from services.ttl_cache import TTLCache
+
+
+class Principal:
+    """Lightweight view of an authenticated teacher or student.
+
+    Only the identity fields are cached; the full document is loaded on first
+    access to `document`, so handlers that never need it cost no database round trip.
+    """
+
+    def __init__(self, model, id, google_id, email, name, version):
+        self.model = model
+        self.id = id
+        self.google_id = google_id
+        self.email = email
+        self.name = name
+        self.version = version
+        self._document = None
+
+    @property
+    def ref(self):
+        """Unsaved stand-in document, usable in queries and ReferenceFields"""
+
+        return self.model(id=self.id)
+
+    @property
+    def document(self):
+        """Full document, loaded once per request"""
+
+        if self._document is None:
+            self._document = self.model.objects(id=self.id).first()
+            if self._document and (self._document.version or 0) != self.version:
+                PrincipalCache.put(self.model, self._document.google_id, PrincipalCache.entry_from_document(self._document))
+        return self._document
+
+
+class PrincipalCache:
+    """TTL cache of principals keyed by role and token subject.
+
+    Entries carry the document version; saving a Teacher or Student bumps the
+    version and invalidates the entry in this process, other processes pick the
+    change up once the TTL expires or a newer version is loaded.
+    """
+
+    _entries = TTLCache(int(os.getenv('PRINCIPAL_CACHE_SIZE', 10000)), ttl=int(os.getenv('PRINCIPAL_CACHE_TTL', 300)))
+
+    @staticmethod
+    def key(model, subject):
+        role = model if isinstance(model, str) else model.__name__.lower()
+        return f'{role}:{subject}'
+
+    @staticmethod
+    def entry_from_document(document):
+        return {
+            'id': document.id,
+            'google_id': document.google_id,
+            'email': document.email,
+            'name': document.name,
+            'version': document.version or 0
+        }
+
+    @classmethod
+    def get(cls, model, subject):
+        return cls._entries.get(cls.key(model, subject))
+
+    @classmethod
+    def put(cls, model, subject, entry):
+        # Never replace a newer version with an older one loaded concurrently
+        cls._entries.set(cls.key(model, subject), entry, replace=lambda current: current['version'] <= entry['version'])
+
+    @classmethod
+    def invalidate(cls, model, subject):
+        cls._entries.pop(cls.key(model, subject))
+
+    @classmethod
+    def resolve(cls, model, subject):
+        """Return the Principal for a token subject, querying only the identity fields on a miss"""
+
+        entry = cls.get(model, subject)
+        if entry is None:
+            user = model.objects(google_id=subject).only('id', 'google_id', 'email', 'name', 'version').first()
+            if not user:
+                return None
+            entry = cls.entry_from_document(user)
+            cls.put(model, subject, entry)
+        return Principal(model, **entry)
@@ -0,0 +1,214 @@
+"""Opt-in CPU and allocation profiling of individual requests and jobs"""
+
+import cProfile
+import contextvars
+import hashlib
+import hmac
+import inspect
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from functools import wraps
+from uuid import uuid4
+
+from flask import g, has_request_context, request
+
+from services.metrics import Metrics
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ID_HEADER = 'X-Profile-Id'
+PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp/baman-profiles')
+# Fraction of calls profiled without a header, 0 disables sampling
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+# Profiles kept on disk, older ones are deleted
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', 100))
+ALLOCATION_TOP_LINES = 50
+
+_active = contextvars.ContextVar('profile_active', default=False)
+# X-Profile header of a request served outside Flask (the ASGI /chat)
+_header = contextvars.ContextVar('profile_header', default=None)
+_profile_id = contextvars.ContextVar('profile_id', default=None)
+
+
+class Profiler:
+    """Captures a cProfile and a tracemalloc snapshot around a call when asked to.
+
+    A call is profiled when the current request carries a valid `X-Profile`
+    header (`<expires>.<hmac>` signed with SECRET_KEY, see `sign`) or when it is
+    picked by PROFILE_SAMPLE_RATE. Only one profile runs per process at a time,
+    since tracemalloc is process-wide; calls that find one running are not profiled.
+    Coroutine functions are profiled across their awaits, so on a busy event loop
+    the CPU profile also contains the requests interleaved with the profiled one.
+    """
+
+    _lock = threading.Lock()
+
+    @staticmethod
+    def signature(expires):
+        secret = (os.getenv('SECRET_KEY') or '').encode()
+        return hmac.new(secret, f'profile:{expires}'.encode(), hashlib.sha256).hexdigest()
+
+    @staticmethod
+    def sign(ttl=3600):
+        """Header value that enables profiling for the next `ttl` seconds"""
+
+        expires = int(time.time()) + ttl
+        return f'{expires}.{Profiler.signature(expires)}'
+
+    @staticmethod
+    def verify(token):
+        try:
+            expires, signature = token.split('.', 1)
+            expires = int(expires)
+        except ValueError:
+            return False
+        return expires >= time.time() and hmac.compare_digest(Profiler.signature(expires), signature)
+
+    @staticmethod
+    def requested():
+        if _active.get():
+            return False
+        token = request.headers.get(PROFILE_HEADER) if has_request_context() else _header.get()
+        if token and os.getenv('SECRET_KEY') and Profiler.verify(token):
+            return True
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    @staticmethod
+    def profile(name):
+        """Decorator that profiles the wrapped call when requested"""
+
+        def decorator(fn):
+            if inspect.iscoroutinefunction(fn):
+                @wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    if not Profiler.requested() or not Profiler._lock.acquire(blocking=False):
+                        return await fn(*args, **kwargs)
+                    try:
+                        return await Profiler.run_async(name, fn, args, kwargs)
+                    finally:
+                        Profiler._lock.release()
+                return async_wrapper
+
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not Profiler.requested() or not Profiler._lock.acquire(blocking=False):
+                    return fn(*args, **kwargs)
+                try:
+                    return Profiler.run(name, fn, args, kwargs)
+                finally:
+                    Profiler._lock.release()
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def use_header(token):
+        """Take the X-Profile header of a request that Flask does not serve"""
+
+        _header.set(token)
+
+    @staticmethod
+    def profile_id():
+        """Id of the profile captured in the current context, if any"""
+
+        return _profile_id.get()
+
+    @staticmethod
+    def start(name):
+        profile_id = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}-{name}-{uuid4().hex[:8]}"
+        if has_request_context():
+            g.profile_id = profile_id
+        _profile_id.set(profile_id)
+
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        return profile_id, started_tracing
+
+    @staticmethod
+    def finish(profile_id, name, started_tracing, profiler, seconds, failed):
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if started_tracing:
+            tracemalloc.stop()
+        try:
+            Profiler.write(profile_id, name, profiler, snapshot, {
+                'id': profile_id,
+                'name': name,
+                'labels': Metrics.current_labels(),
+                'seconds': seconds,
+                'peak_traced_bytes': peak,
+                'failed': failed
+            })
+        except OSError as e:
+            print(f"Error writing profile {profile_id}: {e}")
+
+    @staticmethod
+    def run(name, fn, args, kwargs):
+        profile_id, started_tracing = Profiler.start(name)
+        profiler = cProfile.Profile()
+        token = _active.set(True)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = profiler.runcall(fn, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            _active.reset(token)
+            Profiler.finish(profile_id, name, started_tracing, profiler, time.perf_counter() - started, failed)
+
+    @staticmethod
+    async def run_async(name, fn, args, kwargs):
+        profile_id, started_tracing = Profiler.start(name)
+        profiler = cProfile.Profile()
+        token = _active.set(True)
+        started = time.perf_counter()
+        failed = True
+        profiler.enable()
+        try:
+            result = await fn(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            profiler.disable()
+            _active.reset(token)
+            Profiler.finish(profile_id, name, started_tracing, profiler, time.perf_counter() - started, failed)
+
+    @staticmethod
+    def write(profile_id, name, profiler, snapshot, meta):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, profile_id)
+        profiler.dump_stats(f'{base}.prof')
+        with open(f'{base}.alloc.txt', 'w') as f:
+            for stat in snapshot.statistics('lineno')[:ALLOCATION_TOP_LINES]:
+                f.write(f'{stat}\n')
+        with open(f'{base}.json', 'w') as f:
+            json.dump(meta, f, indent=2)
+        Profiler.rotate()
+
+    @staticmethod
+    def rotate():
+        """Delete the oldest profiles beyond PROFILE_MAX_FILES"""
+
+        metas = sorted(
+            (entry for entry in os.scandir(PROFILE_DIR) if entry.name.endswith('.json')),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in metas[:max(0, len(metas) - PROFILE_MAX_FILES)]:
+            base = entry.path[:-len('.json')]
+            for suffix in ('.json', '.prof', '.alloc.txt'):
+                try:
+                    os.remove(base + suffix)
+                except FileNotFoundError:
+                    pass
+
+
+if __name__ == '__main__':
+    # python -m services.profiling [ttl_seconds] prints an X-Profile header value
+    print(Profiler.sign(int(sys.argv[1]) if len(sys.argv) > 1 else 3600))
@@ -0,0 +1,138 @@
+"""Token-budgeted rendering of retrieved context and chat history for prompts"""
+
+import os
+from functools import lru_cache
+
+import tiktoken
+
+DEFAULT_ENCODING = 'cl100k_base'
+CONTEXT_TOKEN_BUDGET = int(os.getenv('PROMPT_CONTEXT_TOKEN_BUDGET', 3000))
+HISTORY_TOKEN_BUDGET = int(os.getenv('PROMPT_HISTORY_TOKEN_BUDGET', 500))
+# Share of the context budget offered to the teacher's own content first, the rest
+# (plus whatever own content leaves unused) goes to supporting content
+OWN_CONTEXT_SHARE = float(os.getenv('PROMPT_OWN_CONTEXT_SHARE', 0.7))
+# Ranked matches per content type considered for the prompt
+MAX_CONTEXT_ITEMS = int(os.getenv('PROMPT_MAX_CONTEXT_ITEMS', 8))
+HISTORY_MESSAGES = 2
+SPEAKERS = {'user': 'Student', 'assistant': 'Assistant'}
+
+
+@lru_cache(maxsize=None)
+def encoding(name=DEFAULT_ENCODING):
+    return tiktoken.get_encoding(name)
+
+
+def count_tokens(text, encoding_name=DEFAULT_ENCODING):
+    return len(encoding(encoding_name).encode(text or '', disallowed_special=()))
+
+
+def truncate(text, max_tokens):
+    tokens = encoding().encode(text or '', disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text or ''
+    return encoding().decode(tokens[:max(max_tokens, 0)]).rstrip() + '...'
+
+
+def _join(*parts):
+    return '\n'.join(part.strip() for part in parts if part and part.strip())
+
+
+class PromptBuilder:
+    """Renders context and history as plain text within token budgets.
+
+    Each context candidate has representations from richest to most compact.
+    Candidates are first admitted in rank order at their most compact form, then
+    upgraded in rank order while the budget allows, so lower-ranked context is
+    the first to be shortened or left out.
+    """
+
+    @staticmethod
+    def own_representations(content, digest):
+        title = digest.title or content.title
+        return title, [
+            _join(digest.content, content.long_summary),
+            _join(digest.long_summary, content.short_summary),
+            _join(digest.short_summary, content.title)
+        ]
+
+    @staticmethod
+    def supported_representations(content, digest):
+        title = digest.title or content.title
+        return title, [
+            _join(digest.long_summary, content.short_summary),
+            _join(digest.short_summary, content.title, ', '.join(content.topics or []))
+        ]
+
+    @staticmethod
+    def fill(candidates, budget):
+        """Pick one representation per candidate within `budget` tokens; returns (entries, tokens used)"""
+
+        options = []
+        for title, representations in candidates:
+            entries = []
+            for text in representations:
+                if text:
+                    entry = _join(f'[{len(options) + 1}] {title or "Untitled"}', text)
+                    entries.append((entry, count_tokens(entry)))
+            if entries:
+                options.append(entries)
+
+        chosen = []
+        used = 0
+        for entries in options:
+            cost = entries[-1][1]
+            if used + cost > budget:
+                if not chosen and budget > 0:
+                    # Never drop the top match entirely, shorten it instead
+                    chosen.append(truncate(entries[-1][0], budget))
+                    used = budget
+                break
+            chosen.append(len(entries) - 1)
+            used += cost
+
+        for i, level in enumerate(chosen):
+            if isinstance(level, str):
+                break
+            entries = options[i]
+            for richer in range(level):
+                extra = entries[richer][1] - entries[level][1]
+                if used + extra <= budget:
+                    chosen[i] = richer
+                    used += extra
+                    break
+
+        return [level if isinstance(level, str) else options[i][level][0] for i, level in enumerate(chosen)], used
+
+    @staticmethod
+    def build_context(own, supported, budget=CONTEXT_TOKEN_BUDGET):
+        """Render ranked (content, digest) pairs of own and supporting content"""
+
+        own_entries, used = PromptBuilder.fill([PromptBuilder.own_representations(c, d) for c, d in own], int(budget * OWN_CONTEXT_SHARE))
+        supported_entries, _ = PromptBuilder.fill([PromptBuilder.supported_representations(c, d) for c, d in supported], budget - used)
+
+        sections = []
+        if own_entries:
+            sections.append("Teacher's material:\n" + '\n\n'.join(own_entries))
+        if supported_entries:
+            sections.append('Supporting material:\n' + '\n\n'.join(supported_entries))
+        return '\n\n'.join(sections) or 'None'
+
+    @staticmethod
+    def render_history(messages, budget=HISTORY_TOKEN_BUDGET):
+        """Render conversation Messages as 'Speaker: text' lines, keeping the newest within budget"""
+
+        lines = []
+        remaining = budget
+        for message in reversed(messages):
+            text = getattr(message.content, 'message', None)
+            if not text:
+                continue
+            line = f"{SPEAKERS.get(message.sender, message.sender)}: {text.strip()}"
+            tokens = count_tokens(line)
+            if tokens > remaining:
+                if remaining > 0:
+                    lines.append(truncate(line, remaining))
+                break
+            lines.append(line)
+            remaining -= tokens
+        return '\n'.join(reversed(lines)) or 'None'
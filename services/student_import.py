@@ -0,0 +1,190 @@
+"""Bulk student upsert and enrollment for CRM imports"""
+
+from datetime import datetime, timezone
+from uuid import uuid4
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from models.assistant import Assistant
+from models.student import Student
+from services.identity import IdentityResolver
+from services.membership import Membership
+from services.principal_cache import PrincipalCache
+
+BATCH_SIZE = 1000
+# Normalized Student fields used to match rows to existing students, in order of precedence
+IDENTITY_FIELDS = ('email', 'whatsapp_id', 'tg_username')
+
+
+def _text(value):
+    # JSON imports may send numbers, e.g. a wa_number without quotes
+    if isinstance(value, (dict, list)):
+        raise TypeError(f'expected text, got {type(value).__name__}')
+    return '' if value is None else str(value).strip()
+
+
+class StudentImporter:
+    """Upserts students and enrolls them into assistants in batches of bulk writes.
+
+    Each row is a dict with `name` and at least one of `email`, `wa_number`,
+    `tg_handle`, plus optional `assistant_ids` (list or ';' separated string).
+    """
+
+    @staticmethod
+    def normalize_row(row):
+        assistant_ids = row.get('assistant_ids') or []
+        if not isinstance(assistant_ids, list):
+            assistant_ids = _text(assistant_ids).split(';')
+        student = {
+            'name': _text(row.get('name')),
+            'email': _text(row.get('email')).lower() or None,
+            'wa_number': _text(row.get('wa_number')) or None,
+            'tg_handle': _text(row.get('tg_handle')) or None,
+        }
+        student['whatsapp_id'] = IdentityResolver.normalize('whatsapp', student['wa_number'])
+        student['tg_username'] = IdentityResolver.normalize('telegram', student['tg_handle'])
+        return student, [aid for aid in map(_text, assistant_ids) if aid]
+
+    @staticmethod
+    def identities(student):
+        """Every (field, value) identity of a row, most significant first"""
+
+        return [(field, student[field]) for field in IDENTITY_FIELDS if student.get(field)]
+
+    @staticmethod
+    def identity(student):
+        identities = StudentImporter.identities(student)
+        return identities[0] if identities else None
+
+    @staticmethod
+    def run(rows, teacher_id):
+        """Import an iterable of rows and return a per-row report"""
+
+        allowed_assistants = {str(aid) for aid in Assistant.objects(teacher=teacher_id).scalar('id')}
+        report = {'summary': {'rows': 0, 'created': 0, 'updated': 0, 'errors': 0, 'enrollments': 0}, 'results': []}
+
+        batch = []
+        for row in rows:
+            report['summary']['rows'] += 1
+            batch.append((report['summary']['rows'], row))
+            if len(batch) >= BATCH_SIZE:
+                StudentImporter.import_batch(batch, allowed_assistants, report)
+                batch = []
+        if batch:
+            StudentImporter.import_batch(batch, allowed_assistants, report)
+
+        report['results'].sort(key=lambda result: result['row'])
+        return report
+
+    @staticmethod
+    def import_batch(batch, allowed_assistants, report):
+        now = datetime.now(timezone.utc)
+        results = {}
+        pending = {}
+
+        for index, row in batch:
+            if not isinstance(row, dict):
+                results[index] = {'row': index, 'status': 'error', 'error': 'Row must be an object'}
+                continue
+            try:
+                student, assistant_ids = StudentImporter.normalize_row(row)
+            except (TypeError, ValueError) as e:
+                results[index] = {'row': index, 'status': 'error', 'error': f'Invalid row: {e}'}
+                continue
+            identity = StudentImporter.identity(student)
+            unknown = [aid for aid in assistant_ids if aid not in allowed_assistants]
+            if not student['name'] or not identity:
+                results[index] = {'row': index, 'status': 'error', 'error': 'name and one of email, wa_number or tg_handle are required'}
+            elif unknown:
+                results[index] = {'row': index, 'status': 'error', 'error': f"Unknown assistants: {', '.join(unknown)}"}
+            elif identity in pending:
+                # Same student twice in one batch, merge into the first row
+                first = pending[identity]
+                first['student'].update({k: v for k, v in student.items() if v})
+                first['assistant_ids'].update(assistant_ids)
+                results[index] = {'row': index, 'status': 'merged', 'merged_into': first['row']}
+            else:
+                pending[identity] = {'row': index, 'identity': identity, 'student': student, 'assistant_ids': set(assistant_ids)}
+
+        # One query to find which students already exist, on every identity a row provides, so a
+        # row with a new email and the number of an existing student updates that student
+        collection = Student._get_collection()
+        for entry in pending.values():
+            entry['identities'] = StudentImporter.identities(entry['student'])
+        identities = {identity for entry in pending.values() for identity in entry['identities']}
+        lookup = [{field: {'$in': [key for (f, key) in identities if f == field]}} for field in IDENTITY_FIELDS]
+        existing = {}
+        for doc in collection.find({'$or': lookup}, {'_id': 1, 'google_id': 1, 'email': 1, 'whatsapp_id': 1, 'tg_username': 1}) if pending else []:
+            for field in IDENTITY_FIELDS:
+                if doc.get(field) and (field, doc[field]) in identities:
+                    existing.setdefault((field, doc[field]), doc)
+
+        operations, entries = [], []
+        for identity, entry in pending.items():
+            matches = {doc['_id']: doc for doc in (existing.get(identity) for identity in entry['identities']) if doc}
+            if len(matches) > 1:
+                results[entry['row']] = {'row': entry['row'], 'status': 'error', 'error': 'Identities belong to different students'}
+                continue
+            student = entry['student']
+            fields = {k: v for k, v in student.items() if v}
+            update = {
+                '$set': fields,
+                '$inc': {'version': 1},
+                '$addToSet': {'allowed_assistants': {'$each': sorted(entry['assistant_ids'])}}
+            }
+            doc = next(iter(matches.values()), None)
+            if doc:
+                entry['student_id'] = doc['_id']
+                entry['status'] = 'updated'
+                entry['google_id'] = doc.get('google_id')
+                operations.append(UpdateOne({'_id': doc['_id']}, update))
+            else:
+                entry['student_id'] = str(uuid4())
+                entry['status'] = 'created'
+                update['$setOnInsert'] = {'_id': entry['student_id'], 'created_at': now, 'last_login': now}
+                operations.append(UpdateOne({identity[0]: identity[1]}, update, upsert=True))
+            entries.append(entry)
+
+        failed = {}
+        if operations:
+            try:
+                collection.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get('writeErrors', []):
+                    failed[error['index']] = error.get('errmsg', 'Write failed')
+
+        # A concurrent insert may have won an upsert, pick up the id that was actually stored
+        created = [entry for position, entry in enumerate(entries) if entry['status'] == 'created' and position not in failed]
+        if created:
+            stored = collection.find({'$or': [{entry['identity'][0]: entry['identity'][1]} for entry in created]}, {'_id': 1, 'email': 1, 'whatsapp_id': 1, 'tg_username': 1})
+            stored_ids = {(field, doc[field]): doc['_id'] for doc in stored for field in IDENTITY_FIELDS if doc.get(field)}
+            for entry in created:
+                entry['student_id'] = stored_ids.get(entry['identity'], entry['student_id'])
+
+        summary = report['summary']
+        enrollments = {}
+        for position, entry in enumerate(entries):
+            if position in failed:
+                results[entry['row']] = {'row': entry['row'], 'status': 'error', 'error': failed[position]}
+                continue
+            for assistant_id in entry['assistant_ids']:
+                enrollments.setdefault(assistant_id, []).append(entry['student_id'])
+            summary[entry['status']] += 1
+            summary['enrollments'] += len(entry['assistant_ids'])
+            results[entry['row']] = {'row': entry['row'], 'status': entry['status'], 'student_id': entry['student_id']}
+            IdentityResolver.invalidate('whatsapp', entry['student'].get('wa_number'))
+            IdentityResolver.invalidate('telegram', entry['student'].get('tg_handle'))
+            if entry.get('google_id'):
+                PrincipalCache.invalidate(Student, entry['google_id'])
+
+        if enrollments:
+            Assistant._get_collection().bulk_write([
+                UpdateOne({'_id': assistant_id}, {'$addToSet': {'allowed_students': {'$each': student_ids}}, '$set': {'updated_at': now}})
+                for assistant_id, student_ids in enrollments.items()
+            ], ordered=False)
+            for assistant_id in enrollments:
+                Membership.invalidate(assistant_id)
+
+        summary['errors'] += sum(1 for result in results.values() if result['status'] == 'error')
+        report['results'].extend(results.values())
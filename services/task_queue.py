@@ -0,0 +1,102 @@
+"""Bounded in-process background work queue"""
+
+import contextvars
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+
+from services.metrics import Metrics
+
+
+class TaskQueue:
+    """Bounded queue drained by a pool of daemon worker threads.
+
+    Workers are started on first submit, so they are created inside the serving
+    process even when the app is imported before a fork. Tasks run in a copy of
+    the submitter's context, so they keep its metric labels. Tasks submitted
+    with the same key run one at a time in submission order: the worker that
+    runs a key's task also runs the tasks queued behind it.
+    """
+
+    def __init__(self, name, workers, max_size):
+        self.name = name
+        self.workers = workers
+        self.max_size = max_size
+        self._queue = queue.Queue(maxsize=max_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        # Tasks waiting behind the queued or running task of the same key
+        self._pending = {}
+        self._pending_count = 0
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'{self.name}-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            key, task = self._queue.get()
+            try:
+                while task:
+                    self._execute(*task)
+                    task = self._next(key)
+            finally:
+                self._queue.task_done()
+
+    def _execute(self, context, submitted_at, fn, args, kwargs):
+        started = time.monotonic()
+        Metrics.observe('task_wait_seconds', started - submitted_at, queue=self.name)
+        try:
+            context.run(fn, *args, **kwargs)
+        except Exception:
+            print(f"Error in {self.name} task:")
+            traceback.print_exc()
+        finally:
+            Metrics.observe('task_duration_seconds', time.monotonic() - started, queue=self.name)
+
+    def _next(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            pending = self._pending[key]
+            if not pending:
+                del self._pending[key]
+                return None
+            self._pending_count -= 1
+            return pending.popleft()
+
+    def submit(self, fn, *args, **kwargs):
+        """Enqueue a call; returns False when the queue is full"""
+
+        return self.submit_keyed(None, fn, *args, **kwargs)
+
+    def submit_keyed(self, key, fn, *args, **kwargs):
+        """Enqueue a call that runs after the earlier calls submitted with `key`; returns False when the queue is full"""
+
+        if not self._threads:
+            self._start()
+        task = (contextvars.copy_context(), time.monotonic(), fn, args, kwargs)
+        with self._lock:
+            if key is not None and key in self._pending:
+                if self._queue.qsize() + self._pending_count >= self.max_size:
+                    return False
+                self._pending[key].append(task)
+                self._pending_count += 1
+                return True
+            try:
+                self._queue.put_nowait((key, task))
+            except queue.Full:
+                return False
+            if key is not None:
+                self._pending[key] = deque()
+            return True
+
+    def depth(self):
+        return self._queue.qsize() + self._pending_count
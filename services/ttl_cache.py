@@ -0,0 +1,88 @@
+"""Bounded, thread-safe LRU cache with optional expiry, shared by the in-process caches"""
+
+import threading
+import time
+from collections import OrderedDict
+
+_DEFAULT_TTL = object()
+
+
+class TTLCache:
+    """Maps keys to values, keeping at most `max_size` entries.
+
+    Entries expire `ttl` seconds after they are set (never when `ttl` is None,
+    which makes it a plain LRU). Reads and writes mark an entry as recently
+    used; the least recently used entries are evicted first.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _set(self, key, value, ttl):
+        ttl = self.ttl if ttl is _DEFAULT_TTL else ttl
+        self._entries[key] = (time.monotonic() + ttl if ttl is not None else None, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._live(key)
+            return entry[1] if entry else default
+
+    def set(self, key, value, ttl=_DEFAULT_TTL, replace=None):
+        """Store `value`; with `replace`, a live entry is only overwritten when `replace(current)` is true"""
+
+        with self._lock:
+            if replace is not None:
+                entry = self._live(key)
+                if entry and not replace(entry[1]):
+                    return
+            self._set(key, value, ttl)
+
+    def add(self, key, value, ttl=_DEFAULT_TTL):
+        """Store `value` unless the key is present; returns True when it was stored"""
+
+        with self._lock:
+            if self._live(key):
+                return False
+            self._set(key, value, ttl)
+            return True
+
+    def get_or_set(self, key, factory, ttl=_DEFAULT_TTL):
+        """Value of a live entry, else store and return `factory()` (called under the cache lock)"""
+
+        with self._lock:
+            entry = self._live(key)
+            if entry:
+                return entry[1]
+            value = factory()
+            self._set(key, value, ttl)
+            return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[1] if entry else default
+
+    def values(self):
+        """Snapshot of the values, expired entries included until they are next read"""
+
+        with self._lock:
+            return [value for _, value in self._entries.values()]
+
+    def __len__(self):
+        return len(self._entries)
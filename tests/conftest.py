@@ -0,0 +1,67 @@
+"""Point the app at local stand-ins before any module under test is imported.
+
+Vectors go to the in-memory index of the benchmarks and data to mongomock, so
+the suite runs without OpenAI, Pinecone or MongoDB.
+"""
+
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+import jwt
+import mongoengine
+import mongomock
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks import fake_pinecone
+
+os.environ.update({
+    'OPENAI_API_KEY': 'test',
+    'PINECONE_API_KEY': 'test',
+    'SECRET_KEY': 'test-secret-key-of-at-least-32-bytes',
+    'APP_URL': 'http://127.0.0.1'
+})
+sys.modules['pinecone'] = fake_pinecone
+_connect = mongoengine.connect
+mongoengine.connect = lambda *a, **kw: _connect('baman-test', host='mongodb://localhost', mongo_client_class=mongomock.MongoClient)
+mongoengine.connect('baman-test')
+
+# pymongo 4.9+ passes `sort` to bulk updates, which mongomock does not accept yet
+_add_update = mongomock.collection.BulkOperationBuilder.add_update
+mongomock.collection.BulkOperationBuilder.add_update = lambda self, *args, sort=None, **kwargs: _add_update(self, *args, **kwargs)
+_add_replace = mongomock.collection.BulkOperationBuilder.add_replace
+mongomock.collection.BulkOperationBuilder.add_replace = lambda self, *args, sort=None, **kwargs: _add_replace(self, *args, **kwargs)
+
+
+@pytest.fixture
+def db():
+    """Empty collections for a test that writes documents"""
+
+    from models.assistant import Assistant
+    from models.conversation import Conversation
+    from models.student import Student
+    from models.teacher import Teacher
+
+    for model in (Assistant, Conversation, Student, Teacher):
+        model.drop_collection()
+    yield
+    for model in (Assistant, Conversation, Student, Teacher):
+        model.drop_collection()
+
+
+@pytest.fixture
+def auth_headers():
+    """Bearer headers for a saved Teacher or Student"""
+
+    def headers(user):
+        token = jwt.encode({
+            'sub': user.google_id,
+            'email': user.email,
+            'exp': datetime.now(timezone.utc) + timedelta(hours=1)
+        }, os.environ['SECRET_KEY'], algorithm='HS256')
+        return {'Authorization': f'Bearer {token}'}
+
+    return headers
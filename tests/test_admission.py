@@ -0,0 +1,89 @@
+from collections import defaultdict
+
+import pytest
+
+from services import admission
+from services.admission import Admission
+from services.ttl_cache import TTLCache
+
+
+@pytest.fixture(autouse=True)
+def fresh_budgets(monkeypatch):
+    monkeypatch.setattr(admission, 'STUDENT_MESSAGE_BURST', 2)
+    monkeypatch.setattr(admission, 'STUDENT_MESSAGES_PER_MINUTE', 1)
+    monkeypatch.setattr(admission, 'MAX_IN_FLIGHT', 3)
+    monkeypatch.setattr(admission, 'MAX_IN_FLIGHT_PER_ASSISTANT', 2)
+    monkeypatch.setattr(Admission, '_students', TTLCache(admission.MAX_STUDENT_BUCKETS))
+    monkeypatch.setattr(Admission, '_in_flight', 0)
+    monkeypatch.setattr(Admission, '_in_flight_by_assistant', defaultdict(int))
+    monkeypatch.setattr(Admission, '_metrics', {'admitted': 0, **{reason: 0 for reason in admission.REJECTION_REASONS}})
+
+
+def test_throttle_allows_a_burst_then_returns_the_wait():
+    assert Admission.throttle('student:1') == 0.0
+    assert Admission.throttle('student:1') == 0.0
+
+    wait = Admission.throttle('student:1')
+
+    assert 0 < wait <= 60
+    assert Admission.throttle('student:2') == 0.0
+    assert Admission.metrics()['student'] == 1
+
+
+def test_refund_gives_a_message_back():
+    Admission.throttle('student:1')
+    Admission.throttle('student:1')
+
+    Admission.refund('student:1')
+
+    assert Admission.throttle('student:1') == 0.0
+
+
+def test_should_notify_once_per_streak_of_rejections():
+    for _ in range(2):
+        Admission.throttle('student:1')
+
+    assert Admission.throttle('student:1') and Admission.should_notify('student:1')
+    assert Admission.throttle('student:1') and not Admission.should_notify('student:1')
+
+    Admission.refund('student:1')
+    assert Admission.throttle('student:1') == 0.0
+    assert Admission.should_notify('student:1')
+
+
+def test_enter_bounds_chats_per_assistant_and_per_worker():
+    assert Admission.enter('a1') == 0.0
+    assert Admission.enter('a1') == 0.0
+    assert Admission.enter('a1') == admission.BUSY_RETRY_AFTER
+    assert Admission.enter('a2') == 0.0
+    assert Admission.enter('a3') == admission.BUSY_RETRY_AFTER
+
+    metrics = Admission.metrics()
+    assert (metrics['admitted'], metrics['assistant'], metrics['worker']) == (3, 1, 1)
+    assert (metrics['in_flight'], metrics['busiest_assistant']) == (3, 2)
+
+
+def test_leave_releases_the_slot():
+    Admission.enter('a1')
+    Admission.enter('a1')
+
+    Admission.leave('a1')
+
+    assert Admission.enter('a1') == 0.0
+    Admission.leave('a1')
+    Admission.leave('a1')
+    assert Admission.metrics()['in_flight'] == 0
+    assert 'a1' not in Admission._in_flight_by_assistant
+
+
+def test_admit_refunds_the_student_when_the_worker_is_busy():
+    Admission.enter('a1')
+    Admission.enter('a1')
+
+    assert Admission.admit('student:1', 'a1') == admission.BUSY_RETRY_AFTER
+    assert Admission.admit('student:1', 'a1') == admission.BUSY_RETRY_AFTER
+
+    # Neither busy rejection used up the student's burst
+    Admission.leave('a1')
+    assert Admission.admit('student:1', 'a1') == 0.0
+    assert Admission.throttle('student:1') == 0.0
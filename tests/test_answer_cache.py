@@ -0,0 +1,71 @@
+import pytest
+
+from services import answer_cache
+from services.answer_cache import AnswerCache
+from services.ttl_cache import TTLCache
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(AnswerCache, '_buckets', TTLCache(answer_cache.MAX_ASSISTANTS))
+    monkeypatch.setattr(AnswerCache, '_metrics', {'hits': 0, 'misses': 0, 'invalidations': 0})
+
+
+def test_lookup_returns_answers_above_the_similarity_threshold(monkeypatch):
+    monkeypatch.setattr(answer_cache, 'SIMILARITY_THRESHOLD', 0.95)
+    AnswerCache.store('a1', 1, [1.0, 0.0], 'photosynthesis answer')
+
+    assert AnswerCache.lookup('a1', 1, [2.0, 0.1]) == 'photosynthesis answer'
+    assert AnswerCache.lookup('a1', 1, [1.0, 1.0]) is None
+    assert AnswerCache.lookup('a2', 1, [1.0, 0.0]) is None
+    metrics = AnswerCache.metrics()
+    assert (metrics['hits'], metrics['misses'], metrics['hit_rate']) == (1, 2, 1 / 3)
+
+
+def test_lookup_picks_the_closest_question():
+    AnswerCache.store('a1', 1, [1.0, 0.0, 0.0], 'first')
+    AnswerCache.store('a1', 1, [1.0, 0.2, 0.0], 'second')
+
+    assert AnswerCache.lookup('a1', 1, [1.0, 0.19, 0.0]) == 'second'
+
+
+def test_a_new_content_version_drops_the_bucket():
+    AnswerCache.store('a1', 1, [1.0, 0.0], 'stale')
+
+    assert AnswerCache.lookup('a1', 2, [1.0, 0.0]) is None
+    assert AnswerCache.lookup('a1', 1, [1.0, 0.0]) is None
+    assert AnswerCache.metrics()['invalidations'] == 1
+
+
+def test_entries_are_evicted_least_recently_used(monkeypatch):
+    monkeypatch.setattr(answer_cache, 'MAX_ENTRIES_PER_ASSISTANT', 2)
+    AnswerCache.store('a1', 1, [1.0, 0.0, 0.0], 'x')
+    AnswerCache.store('a1', 1, [0.0, 1.0, 0.0], 'y')
+    assert AnswerCache.lookup('a1', 1, [1.0, 0.0, 0.0]) == 'x'
+
+    AnswerCache.store('a1', 1, [0.0, 0.0, 1.0], 'z')
+
+    assert AnswerCache.lookup('a1', 1, [0.0, 1.0, 0.0]) is None
+    assert AnswerCache.lookup('a1', 1, [1.0, 0.0, 0.0]) == 'x'
+    assert AnswerCache.metrics()['entries'] == 2
+
+
+def test_assistants_are_evicted_least_recently_used(monkeypatch):
+    monkeypatch.setattr(AnswerCache, '_buckets', TTLCache(2))
+    for assistant_id in ('a1', 'a2'):
+        AnswerCache.store(assistant_id, 1, [1.0, 0.0], assistant_id)
+    AnswerCache.lookup('a1', 1, [1.0, 0.0])
+
+    AnswerCache.store('a3', 1, [1.0, 0.0], 'a3')
+
+    assert AnswerCache.lookup('a2', 1, [1.0, 0.0]) is None
+    assert AnswerCache.lookup('a1', 1, [1.0, 0.0]) == 'a1'
+    assert AnswerCache.metrics()['assistants'] == 2
+
+
+def test_invalidate_forgets_an_assistant():
+    AnswerCache.store('a1', 1, [1.0, 0.0], 'answer')
+
+    AnswerCache.invalidate('a1')
+
+    assert AnswerCache.lookup('a1', 1, [1.0, 0.0]) is None
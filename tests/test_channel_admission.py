@@ -0,0 +1,50 @@
+import pytest
+
+import app as app_module
+from models.conversation import Conversation
+from services.admission import Admission
+from services.channel_router import Route
+from services.identity import IdentityResolver
+from services.membership import Membership
+
+
+@pytest.fixture
+def flooding(monkeypatch):
+    """An enrolled sender whose message budget is used up"""
+
+    replies = []
+    monkeypatch.setattr(IdentityResolver, 'resolve', lambda channel, identifier: 'student-1')
+    monkeypatch.setattr(Membership, 'is_allowed', lambda assistant_id, student_id: True)
+    monkeypatch.setattr(Admission, 'throttle', lambda key: 5.0)
+    monkeypatch.setattr(Admission, 'should_notify', lambda key: True)
+    monkeypatch.setattr(app_module.OutboundScheduler, 'whatsapp', lambda *args: replies.append(args[2]))
+    monkeypatch.setattr(app_module.OutboundScheduler, 'telegram', lambda *args: replies.append(args[2]))
+
+    def no_loads(*args):
+        raise AssertionError('a shed message must not load documents')
+
+    monkeypatch.setattr(app_module, 'load_channel_chat', no_loads)
+    return replies
+
+
+def test_shed_whatsapp_messages_load_nothing(db, flooding):
+    app_module.handle_wa_message({
+        'route': Route('channel-1', 'WhatsApp', 'assistant-1', 'token'),
+        'phone_number_id': 'pn1',
+        'phone_number': '919876543210',
+        'message': 'What is osmosis?'
+    })
+
+    assert flooding == [app_module.RATE_LIMITED_REPLY]
+    assert Conversation.objects.count() == 0
+
+
+def test_shed_telegram_questions_load_nothing(db, flooding):
+    app_module.handle_tg_message(Route('channel-1', 'Telegram', 'assistant-1', 'key'), {
+        'from': {'username': 'asha'},
+        'chat': {'id': 42},
+        'text': 'What is osmosis?'
+    })
+
+    assert flooding == [app_module.RATE_LIMITED_REPLY]
+    assert Conversation.objects.count() == 0
@@ -0,0 +1,67 @@
+import pytest
+
+import app as app_module
+from models.assistant import Assistant
+from models.student import Student
+from models.teacher import Teacher
+from services.membership import Membership
+
+
+@pytest.fixture
+def client():
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def enrollment(db, auth_headers):
+    teacher = Teacher(name='Teacher', google_id='g-teacher', email='teacher@example.com').save()
+    student = Student(name='Asha', google_id='g-asha', email='asha@example.com').save()
+    assistant = Assistant(teacher=teacher, subject='Biology', class_name='9').save()
+    return auth_headers(teacher), student, assistant
+
+
+def post(client, path, headers, student, assistant):
+    return client.post(path, headers=headers, json={'student_id': student.id, 'assistant_id': assistant.id})
+
+
+def stored(student, assistant):
+    allowed_students = Assistant.objects(id=assistant.id).as_pymongo().first().get('allowed_students') or []
+    allowed_assistants = Student.objects(id=student.id).as_pymongo().first().get('allowed_assistants') or []
+    return allowed_students, allowed_assistants
+
+
+def test_add_enrolls_on_both_sides_once(client, enrollment):
+    headers, student, assistant = enrollment
+
+    assert post(client, '/add_student_to_assistant', headers, student, assistant).status_code == 200
+    assert stored(student, assistant) == ([student.id], [assistant.id])
+    assert Membership.is_allowed(assistant.id, student.id)
+
+    response = post(client, '/add_student_to_assistant', headers, student, assistant)
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'Student already in assistant'}
+
+
+def test_add_decides_from_the_database_not_a_stale_roster(client, enrollment):
+    headers, student, assistant = enrollment
+    post(client, '/add_student_to_assistant', headers, student, assistant)
+    assert Membership.is_allowed(assistant.id, student.id)
+
+    # Removed through another process: this process's roster still lists the student
+    Assistant.objects(id=assistant.id).update_one(pull__allowed_students=student)
+    Student.objects(id=student.id).update_one(pull__allowed_assistants=assistant)
+
+    assert post(client, '/add_student_to_assistant', headers, student, assistant).status_code == 200
+    assert stored(student, assistant) == ([student.id], [assistant.id])
+
+
+def test_remove_clears_both_sides_and_the_roster_cache(client, enrollment):
+    headers, student, assistant = enrollment
+    post(client, '/add_student_to_assistant', headers, student, assistant)
+    assert Membership.is_allowed(assistant.id, student.id)
+
+    response = post(client, '/remove_student_from_assistant', headers, student, assistant)
+
+    assert response.status_code == 200
+    assert stored(student, assistant) == ([], [])
+    assert not Membership.is_allowed(assistant.id, student.id)
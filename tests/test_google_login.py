@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+
+import pytest
+
+from services import google_login
+from services.google_login import GoogleLogin
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(google_login, 'time', SimpleNamespace(monotonic=clock))
+    monkeypatch.setattr(GoogleLogin, '_keys', {'k1': 'key-1'})
+    monkeypatch.setattr(GoogleLogin, '_fetched_at', clock.now)
+    monkeypatch.setattr(GoogleLogin, '_expires_at', clock.now + 3600)
+    monkeypatch.setattr(GoogleLogin, '_retry_at', 0)
+    return clock
+
+
+@pytest.fixture
+def outage(monkeypatch):
+    attempts = []
+
+    def refresh():
+        attempts.append(google_login.time.monotonic())
+        raise ConnectionError('certs endpoint unreachable')
+
+    monkeypatch.setattr(GoogleLogin, 'refresh_signing_keys', refresh)
+    return attempts
+
+
+def test_expired_keys_are_served_while_refreshes_fail(clock, outage):
+    clock.now += 3600
+
+    assert GoogleLogin.get_signing_key('k1') == 'key-1'
+    assert GoogleLogin.get_signing_key('k1') == 'key-1'
+    assert len(outage) == 1
+
+    clock.now += google_login.MIN_KEYS_REFRESH_INTERVAL
+    assert GoogleLogin.get_signing_key('k1') == 'key-1'
+    assert len(outage) == 2
+
+
+def test_expired_keys_stop_verifying_after_the_grace_period(clock, outage):
+    clock.now += 3600 + google_login.STALE_KEYS_GRACE
+
+    assert GoogleLogin.get_signing_key('k1') is None
+
+
+def test_a_successful_refresh_replaces_the_keys(clock, monkeypatch):
+    def refresh():
+        GoogleLogin._keys = {'k2': 'key-2'}
+        GoogleLogin._fetched_at = clock.now
+        GoogleLogin._expires_at = clock.now + 3600
+
+    monkeypatch.setattr(GoogleLogin, 'refresh_signing_keys', refresh)
+    clock.now += 3600
+
+    assert GoogleLogin.get_signing_key('k2') == 'key-2'
+    assert GoogleLogin.get_signing_key('k1') is None
@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from models.assistant import Assistant, Content, DigestedContent
+from services import keyword_index
+from services.keyword_index import KeywordIndex, tokenize
+from services.ttl_cache import TTLCache
+
+VERSION = datetime(2024, 5, 1, 12, 0, 0, 123456, tzinfo=timezone.utc)
+
+
+@pytest.fixture(autouse=True)
+def empty_indexes(monkeypatch):
+    monkeypatch.setattr(KeywordIndex, '_indexes', TTLCache(keyword_index.MAX_ASSISTANTS))
+
+
+def content(content_id, *digests):
+    return Content(id=content_id, file_type='text', content='', digests=[
+        DigestedContent(id=digest_id, content=text, title=title) for digest_id, title, text in digests
+    ])
+
+
+def assistant(own=(), supported=(), version=VERSION):
+    return Assistant(id='a1', own_content=list(own), supporting_content=list(supported), content_version=version)
+
+
+def test_tokenize_lowercases_and_drops_stopwords():
+    assert tokenize('What is the Role of Chlorophyll?') == ['role', 'chlorophyll']
+
+
+def test_search_ranks_by_bm25_and_scales_scores_to_one():
+    tutor = assistant(own=[
+        content('c1', ('d1', 'Photosynthesis', 'Chlorophyll absorbs sunlight in the leaf')),
+        content('c2', ('d2', 'Algebra', 'A linear equation has one variable')),
+        content('c3', ('d3', 'Leaves', 'The leaf has stomata')),
+    ])
+
+    matches = KeywordIndex.search(tutor, 'own', 'chlorophyll in the leaf')
+
+    assert [match['id'] for match in matches] == ['a1__c1__d1__bm25__own', 'a1__c3__d3__bm25__own']
+    assert all(0 < match['score'] < 1 for match in matches)
+    assert matches[0]['score'] > matches[1]['score']
+
+
+def test_title_matches_weigh_more_than_body_matches():
+    tutor = assistant(own=[
+        content('c1', ('d1', 'Overview', 'Notes that mention photosynthesis once')),
+        content('c2', ('d2', 'Photosynthesis', 'Notes about plants')),
+    ])
+
+    matches = KeywordIndex.search(tutor, 'own', 'photosynthesis')
+
+    assert matches[0]['id'] == 'a1__c2__d2__bm25__own'
+
+
+def test_search_is_limited_to_own_or_supporting_content():
+    tutor = assistant(
+        own=[content('c1', ('d1', 'Cells', 'Mitochondria make energy'))],
+        supported=[content('c2', ('d2', 'Cells', 'Mitochondria in detail'))]
+    )
+
+    assert [match['id'] for match in KeywordIndex.search(tutor, 'supported', 'mitochondria')] == ['a1__c2__d2__bm25__supported']
+    assert KeywordIndex.search(tutor, 'own', 'unknown words') == []
+
+
+def test_scores_saturate_instead_of_normalizing_to_the_top_hit():
+    tutor = assistant(own=[
+        content('c1', ('d1', 'Overview', 'A passing mention of osmosis')),
+        content('c2', ('d2', 'Algebra', 'Equations')),
+        content('c3', ('d3', 'Geography', 'Rivers')),
+    ])
+
+    # A lone weak match is not promoted to a perfect score
+    assert KeywordIndex.search(tutor, 'own', 'osmosis')[0]['score'] < 0.5
+
+
+def test_add_content_appends_to_a_current_index():
+    tutor = assistant(own=[content('c1', ('d1', 'Cells', 'Mitochondria make energy'))])
+    index = KeywordIndex.get(tutor)
+    new_version = VERSION + timedelta(seconds=1)
+
+    KeywordIndex.add_content('a1', 'own', content('c2', ('d2', 'Genetics', 'Alleles and genes')), VERSION, new_version)
+    tutor.content_version = new_version
+
+    assert KeywordIndex.get(tutor) is index
+    assert [match['id'] for match in KeywordIndex.search(tutor, 'own', 'alleles')] == ['a1__c2__d2__bm25__own']
+
+
+def test_add_content_drops_an_index_that_missed_a_change():
+    tutor = assistant(own=[content('c1', ('d1', 'Cells', 'Mitochondria make energy'))])
+    KeywordIndex.get(tutor)
+
+    KeywordIndex.add_content('a1', 'own', content('c2', ('d2', 'Genetics', 'Alleles')), VERSION - timedelta(seconds=1), VERSION + timedelta(seconds=1))
+
+    assert len(KeywordIndex._indexes) == 0
+
+
+def test_a_new_content_version_rebuilds_the_index():
+    tutor = assistant(own=[content('c1', ('d1', 'Cells', 'Mitochondria make energy'))])
+    index = KeywordIndex.get(tutor)
+
+    tutor.own_content = [content('c2', ('d2', 'Genetics', 'Alleles and genes'))]
+    tutor.content_version = VERSION + timedelta(seconds=1)
+
+    assert KeywordIndex.get(tutor) is not index
+    assert KeywordIndex.search(tutor, 'own', 'mitochondria') == []
+
+
+def test_versions_compare_at_mongo_precision():
+    index = KeywordIndex.get(assistant())
+
+    # Reloaded from Mongo: naive UTC, milliseconds only
+    assert KeywordIndex.get(assistant(version=datetime(2024, 5, 1, 12, 0, 0, 123000))) is index
@@ -0,0 +1,24 @@
+import app as app_module
+from models.student import Student
+from models.teacher import Teacher
+from services.metrics import Metrics
+from utils import Utils
+
+
+def no_extraction(*args):
+    raise AssertionError('nothing is extracted for an unknown assistant')
+
+
+def test_unknown_assistant_ids_do_not_become_label_values(db, auth_headers, monkeypatch):
+    client = app_module.app.test_client()
+    teacher = Teacher(name='Teacher', google_id='g-teacher', email='teacher@example.com').save()
+    student = Student(name='Asha', google_id='g-asha', email='asha@example.com').save()
+    monkeypatch.setattr(Utils, 'extract_text', no_extraction)
+
+    chat = client.post('/chat', headers=auth_headers(student), json={'assistant_id': 'random-chat-id', 'message': 'hi'})
+    digest = client.post('/digest', headers=auth_headers(teacher), json={'assistant_id': 'random-digest-id', 'fileUrl': 'https://example.com/a.txt'})
+
+    assert (chat.status_code, digest.status_code) == (400, 400)
+    rendered = Metrics.render()
+    assert 'random-chat-id' not in rendered
+    assert 'random-digest-id' not in rendered
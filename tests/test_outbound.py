@@ -0,0 +1,73 @@
+from collections import deque
+
+from services import outbound
+from services.outbound import OutboundScheduler
+from services.ttl_cache import TTLCache
+
+
+def test_short_messages_are_not_split():
+    assert OutboundScheduler.split_message('hello', 10) == ['hello']
+    assert OutboundScheduler.split_message('', 10) == []
+    assert OutboundScheduler.split_message(None, 10) == []
+
+
+def test_split_prefers_paragraph_then_line_then_word_boundaries():
+    assert OutboundScheduler.split_message('first part\n\nsecond part', 15) == ['first part', 'second part']
+    assert OutboundScheduler.split_message('first line\nsecond line', 15) == ['first line', 'second line']
+    assert OutboundScheduler.split_message('alpha beta gamma delta', 12) == ['alpha beta', 'gamma delta']
+
+
+def test_split_ignores_boundaries_too_early_in_the_part():
+    # A paragraph break in the first half would make a tiny part; the last space is used instead
+    assert OutboundScheduler.split_message('ab\n\ncdefgh ijklmn', 12) == ['ab\n\ncdefgh', 'ijklmn']
+
+
+def test_split_cuts_words_longer_than_the_limit():
+    parts = OutboundScheduler.split_message('x' * 25, 10)
+
+    assert parts == ['x' * 10, 'x' * 10, 'x' * 5]
+
+
+def test_every_part_fits_the_limit():
+    text = ' '.join(f'word{i}' for i in range(500))
+
+    parts = OutboundScheduler.split_message(text, 64)
+
+    assert all(len(part) <= 64 for part in parts)
+    assert ' '.join(parts) == text
+
+
+def test_retry_after_reads_platform_rate_limit_responses():
+    assert OutboundScheduler.retry_after('telegram', {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 7}}) == 7.0
+    assert OutboundScheduler.retry_after('telegram', {'ok': True}) is None
+    assert OutboundScheduler.retry_after('whatsapp', {'error': {'code': 130429}}) == 1.0
+    assert OutboundScheduler.retry_after('whatsapp', {'error': {'code': 100}}) is None
+    assert OutboundScheduler.retry_after('whatsapp', None) is None
+
+
+def test_platform_errors_are_rejections():
+    assert OutboundScheduler.rejected({'ok': False, 'error_code': 401, 'description': 'Unauthorized'})
+    assert OutboundScheduler.rejected({'error': {'code': 131026, 'message': 'Message undeliverable'}})
+    assert not OutboundScheduler.rejected({'ok': True, 'result': {}})
+    assert not OutboundScheduler.rejected({'messages': [{'id': 'wamid.1'}]})
+    assert not OutboundScheduler.rejected(None)
+
+
+def test_rejected_sends_are_counted_as_failed(monkeypatch):
+    metrics = {'sent': 0, 'failed': 0, 'retries': 0, 'send_seconds': 0.0, 'max_send_seconds': 0.0}
+    monkeypatch.setattr(OutboundScheduler, '_metrics', metrics)
+    monkeypatch.setattr(OutboundScheduler, '_chats', {})
+    monkeypatch.setattr(OutboundScheduler, '_bot_buckets', {})
+    monkeypatch.setattr(OutboundScheduler, '_chat_buckets', TTLCache(outbound.MAX_CHAT_BUCKETS))
+    monkeypatch.setitem(outbound.PLATFORM_LIMITS['telegram'], 'chat_rate', 100)
+    chat_key = ('telegram', 'token', 42)
+    OutboundScheduler._chats[chat_key] = deque([
+        ('blocked', lambda part: {'ok': False, 'error_code': 403, 'description': 'bot was blocked by the user'}, 0.0, {}, 0),
+        ('delivered', lambda part: {'ok': True, 'result': {}}, 0.0, {}, 0),
+    ])
+
+    assert OutboundScheduler._deliver_next(chat_key) == 0.0
+    assert OutboundScheduler._deliver_next(chat_key) == 0.0
+
+    assert (metrics['failed'], metrics['sent'], metrics['retries']) == (1, 1, 0)
+    assert not OutboundScheduler._chats[chat_key]
@@ -0,0 +1,92 @@
+from types import SimpleNamespace
+
+import pytest
+
+from services import prompt_builder
+from services.prompt_builder import PromptBuilder, count_tokens
+
+
+class WordEncoding:
+    """One token per whitespace-separated word, so budgets are easy to reason about"""
+
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+    def decode(self, tokens):
+        return ' '.join(tokens)
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(prompt_builder, 'encoding', lambda name=None: WordEncoding())
+
+
+def message(sender, text):
+    return SimpleNamespace(sender=sender, content=SimpleNamespace(message=text))
+
+
+def test_fill_upgrades_top_ranked_candidates_first():
+    candidates = [
+        ('First', ['rich ' * 10, 'short']),
+        ('Second', ['rich ' * 10, 'short']),
+    ]
+    # Both compact forms cost 3 tokens; only one upgrade (+9) fits
+    entries, used = PromptBuilder.fill(candidates, 16)
+
+    assert entries[0].startswith('[1] First') and 'rich' in entries[0]
+    assert entries[1] == '[2] Second\nshort'
+    assert used == 15
+
+
+def test_fill_drops_lower_ranked_candidates_over_budget():
+    candidates = [('First', ['one two']), ('Second', ['three four'])]
+
+    entries, used = PromptBuilder.fill(candidates, 5)
+
+    assert entries == ['[1] First\none two']
+    assert used == 4
+
+
+def test_fill_truncates_the_top_candidate_instead_of_dropping_it():
+    entries, used = PromptBuilder.fill([('Only', ['a b c d e f g h'])], 4)
+
+    assert entries == ['[1] Only a b...']
+    assert used == 4
+
+
+def test_fill_skips_empty_representations():
+    entries, _ = PromptBuilder.fill([('Empty', ['', None]), ('Full', ['text'])], 10)
+
+    assert entries == ['[1] Full\ntext']
+
+
+def test_build_context_gives_supporting_content_what_own_content_leaves():
+    own = [(SimpleNamespace(title='Own', long_summary='', short_summary='', topics=[]),
+            SimpleNamespace(title=None, content='own text', long_summary='', short_summary='own'))]
+    supported = [(SimpleNamespace(title='Support', short_summary='summary words here', topics=['topic']),
+                  SimpleNamespace(title=None, long_summary='long supporting summary', short_summary='brief'))]
+
+    context = PromptBuilder.build_context(own, supported, budget=20)
+
+    assert context.startswith("Teacher's material:\n[1] Own\nown text")
+    assert 'Supporting material:\n[1] Support\nlong supporting summary' in context
+    assert PromptBuilder.build_context([], []) == 'None'
+
+
+def test_render_history_keeps_the_newest_messages_within_budget():
+    messages = [
+        message('user', 'first question here'),
+        message('assistant', 'first answer'),
+        message('user', 'second question'),
+    ]
+
+    assert PromptBuilder.render_history(messages, budget=100) == (
+        'Student: first question here\nAssistant: first answer\nStudent: second question'
+    )
+    assert PromptBuilder.render_history(messages, budget=6) == 'Assistant: first answer\nStudent: second question'
+    assert PromptBuilder.render_history(messages, budget=4) == 'Assistant:...\nStudent: second question'
+    assert PromptBuilder.render_history([], budget=10) == 'None'
+
+
+def test_count_tokens_handles_missing_text():
+    assert count_tokens(None) == 0
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from utils import Utils
+
+
+def match(content_id, digest_id, label, score, values=None):
+    result = {'id': f'a1__{content_id}__{digest_id}__{label}__own', 'score': score}
+    if values is not None:
+        result['values'] = values
+    return result
+
+
+def settings(**overrides):
+    return Utils.ranking_settings(overrides)
+
+
+def test_scores_are_fused_by_label_weight():
+    matches = {
+        'title': [match('c1', 'd1', 'title', 0.5)],
+        'content': [match('c1', 'd1', 'text', 0.5), match('c2', 'd2', 'text', 0.9)],
+    }
+
+    ranked = Utils.rank_pinecone_matches(matches, {'weights': {'title': 3, 'content': 1}, 'mmr_lambda': 1})
+
+    assert [item['content_id_digest_id'] for item in ranked] == ['c1__d1', 'c2__d2']
+    assert [item['weighted_score'] for item in ranked] == pytest.approx([2.0, 0.9])
+
+
+def test_a_zero_weight_ignores_a_label():
+    matches = {
+        'title': [match('c1', 'd1', 'title', 0.9)],
+        'bm25': [match('c2', 'd2', 'bm25', 0.5)],
+    }
+
+    ranked = Utils.rank_pinecone_matches(matches, {'weights': {'title': 0, 'bm25': 1}, 'mmr_lambda': 1})
+
+    assert [item['content_id_digest_id'] for item in ranked] == ['c2__d2', 'c1__d1']
+    assert ranked[1]['weighted_score'] == 0.0
+
+
+def test_no_matches_rank_nothing():
+    assert Utils.rank_pinecone_matches({'title': [], 'content': []}) == []
+
+
+def test_top_n_limits_the_ranking():
+    matches = {'content': [match(f'c{i}', 'd', 'text', 1 - i / 10) for i in range(5)]}
+
+    ranked = Utils.rank_pinecone_matches(matches, {'top_n': 3, 'mmr_lambda': 1})
+
+    assert [item['content_id_digest_id'] for item in ranked] == ['c0__d', 'c1__d', 'c2__d']
+
+
+def test_select_diverse_caps_digests_per_content():
+    keys = ['c1__d1', 'c1__d2', 'c1__d3', 'c2__d1']
+    fused = np.array([1.0, 0.9, 0.8, 0.1], dtype=np.float32)
+
+    selected = Utils.select_diverse(keys, fused, {}, settings(max_per_content=2, top_n=4, mmr_lambda=1))
+
+    assert selected == [0, 1, 3]
+
+
+def test_select_diverse_prefers_novel_candidates_over_near_duplicates():
+    keys = ['c1__d1', 'c2__d1', 'c3__d1']
+    fused = np.array([1.0, 0.95, 0.8], dtype=np.float32)
+    vectors = {0: [1.0, 0.0], 1: [1.0, 0.01], 2: [0.0, 1.0]}
+
+    assert Utils.select_diverse(keys, fused, vectors, settings(top_n=3, mmr_lambda=1)) == [0, 1, 2]
+    assert Utils.select_diverse(keys, fused, vectors, settings(top_n=3, mmr_lambda=0.5)) == [0, 2, 1]
+
+
+def test_select_diverse_without_vectors_follows_relevance():
+    keys = ['c1__d1', 'c2__d1', 'c3__d1']
+    fused = np.array([0.2, 0.9, 0.5], dtype=np.float32)
+
+    assert Utils.select_diverse(keys, fused, {}, settings(top_n=3, mmr_lambda=0.5)) == [1, 2, 0]
+
+
+def test_content_vectors_feed_mmr_through_rank_pinecone_matches():
+    matches = {
+        'content': [
+            match('c1', 'd1', 'text', 0.9, [1.0, 0.0]),
+            match('c2', 'd1', 'text', 0.88, [1.0, 0.0]),
+            match('c3', 'd1', 'text', 0.7, [0.0, 1.0]),
+        ]
+    }
+
+    ranked = Utils.rank_pinecone_matches(matches, {'top_n': 2, 'mmr_lambda': 0.5})
+
+    assert [item['content_id_digest_id'] for item in ranked] == ['c1__d1', 'c3__d1']
+
+
+def test_select_diverse_keeps_the_order_of_negative_scores():
+    keys = ['c1__d1', 'c2__d1', 'c3__d1']
+    fused = np.array([-0.1, -0.5, -0.9], dtype=np.float32)
+    vectors = {0: [1.0, 0.0], 1: [0.0, 1.0], 2: [0.7, 0.7]}
+
+    assert Utils.select_diverse(keys, fused, vectors, settings(top_n=1, mmr_lambda=0.7)) == [0]
+    assert Utils.select_diverse(keys, fused, {}, settings(top_n=3, mmr_lambda=0.5)) == [0, 1, 2]
+
+
+def test_select_diverse_with_equal_scores_falls_back_to_novelty():
+    keys = ['c1__d1', 'c2__d1', 'c3__d1']
+    fused = np.array([0.5, 0.5, 0.5], dtype=np.float32)
+    vectors = {0: [1.0, 0.0], 1: [1.0, 0.0], 2: [0.0, 1.0]}
+
+    assert Utils.select_diverse(keys, fused, vectors, settings(top_n=2, mmr_lambda=0.5)) == [0, 2]
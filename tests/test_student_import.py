@@ -0,0 +1,113 @@
+import io
+
+import app as app_module
+from models.assistant import Assistant
+from models.student import Student
+from models.teacher import Teacher
+from services.student_import import StudentImporter
+
+
+def setup_assistants():
+    teacher = Teacher(name='Teacher', google_id='g-teacher', email='teacher@example.com').save()
+    other = Teacher(name='Other', google_id='g-other', email='other@example.com').save()
+    mine = Assistant(id='a1', teacher=teacher, subject='Biology', class_name='9').save()
+    theirs = Assistant(id='a2', teacher=other, subject='Physics', class_name='9').save()
+    return teacher, mine, theirs
+
+
+def test_rows_are_reported_in_order_with_their_outcome(db):
+    teacher, mine, _ = setup_assistants()
+    Student(name='Existing', google_id='g-existing', email='existing@example.com').save()
+
+    report = StudentImporter.run([
+        {'name': 'New', 'email': 'New@Example.com', 'assistant_ids': 'a1'},
+        {'name': 'Existing again', 'email': 'existing@example.com', 'assistant_ids': ['a1']},
+        {'name': 'No identity'},
+        {'name': 'Wrong tenant', 'email': 'x@example.com', 'assistant_ids': 'a2'},
+        'not an object',
+        {'name': 'New', 'email': 'new@example.com', 'wa_number': '+91 98765 43210'},
+    ], teacher.id)
+
+    assert [(result['row'], result['status']) for result in report['results']] == [
+        (1, 'created'), (2, 'updated'), (3, 'error'), (4, 'error'), (5, 'error'), (6, 'merged')
+    ]
+    assert report['results'][2]['error'] == 'name and one of email, wa_number or tg_handle are required'
+    assert report['results'][3]['error'] == 'Unknown assistants: a2'
+    assert report['results'][4]['error'] == 'Row must be an object'
+    assert report['results'][5]['merged_into'] == 1
+    assert report['summary'] == {'rows': 6, 'created': 1, 'updated': 1, 'errors': 3, 'enrollments': 2}
+
+
+def test_imported_students_are_stored_and_enrolled(db):
+    teacher, _, _ = setup_assistants()
+
+    report = StudentImporter.run([
+        {'name': 'Asha', 'email': 'asha@example.com', 'assistant_ids': 'a1'},
+        {'name': 'Asha', 'email': 'asha@example.com', 'wa_number': '+91 98765 43210', 'tg_handle': '@Asha_K'},
+    ], teacher.id)
+
+    student = Student.objects(email='asha@example.com').get()
+    assert str(student.id) == report['results'][0]['student_id']
+    assert (student.whatsapp_id, student.tg_username) == ('919876543210', 'asha_k')
+    assert [str(s.id) for s in Assistant.objects(id='a1').get().allowed_students] == [str(student.id)]
+
+
+def test_rows_are_matched_on_normalized_identities(db):
+    teacher, _, _ = setup_assistants()
+    StudentImporter.run([{'name': 'Ravi', 'wa_number': '+91 98765 43210'}], teacher.id)
+
+    report = StudentImporter.run([{'name': 'Ravi K', 'wa_number': '919876543210', 'assistant_ids': 'a1'}], teacher.id)
+
+    assert report['results'][0]['status'] == 'updated'
+    assert Student.objects(whatsapp_id='919876543210').count() == 1
+
+
+def test_non_text_values_are_coerced_or_rejected_per_row(db):
+    teacher, _, _ = setup_assistants()
+
+    report = StudentImporter.run([
+        {'name': 'Ravi', 'wa_number': 919876543210, 'assistant_ids': ['a1']},
+        {'name': 'Bad', 'email': {'address': 'bad@example.com'}},
+        {'name': 'Next', 'tg_handle': '@next'},
+    ], teacher.id)
+
+    assert [result['status'] for result in report['results']] == ['created', 'error', 'created']
+    assert report['results'][1]['error'] == 'Invalid row: expected text, got dict'
+    assert Student.objects(whatsapp_id='919876543210').count() == 1
+
+
+def test_csv_uploads_with_a_byte_order_mark_are_read(db, auth_headers):
+    teacher, _, _ = setup_assistants()
+    csv_file = io.BytesIO('name,email,assistant_ids\nAsha,asha@example.com,a1\n'.encode('utf-8-sig'))
+
+    response = app_module.app.test_client().post(
+        '/bulk_import_students',
+        headers=auth_headers(teacher),
+        data={'file': (csv_file, 'students.csv')},
+        content_type='multipart/form-data'
+    )
+
+    assert response.status_code == 200
+    assert response.get_json()['summary']['created'] == 1
+
+
+def test_rows_are_matched_on_any_of_their_identities(db):
+    teacher, _, _ = setup_assistants()
+    existing = Student(name='Ravi', google_id='g-ravi', whatsapp_id='919876543210', wa_number='+91 98765 43210').save()
+
+    report = StudentImporter.run([{'name': 'Ravi', 'email': 'ravi@example.com', 'wa_number': '919876543210', 'assistant_ids': 'a1'}], teacher.id)
+
+    assert report['results'] == [{'row': 1, 'status': 'updated', 'student_id': existing.id}]
+    assert Student.objects(id=existing.id).get().email == 'ravi@example.com'
+    assert Student.objects.count() == 1
+
+
+def test_rows_whose_identities_belong_to_different_students_are_rejected(db):
+    teacher, _, _ = setup_assistants()
+    Student(name='Asha', google_id='g-asha', email='asha@example.com').save()
+    Student(name='Ravi', google_id='g-ravi', whatsapp_id='919876543210').save()
+
+    report = StudentImporter.run([{'name': 'Asha', 'email': 'asha@example.com', 'wa_number': '919876543210'}], teacher.id)
+
+    assert report['results'] == [{'row': 1, 'status': 'error', 'error': 'Identities belong to different students'}]
+    assert Student.objects(email='asha@example.com').get().whatsapp_id is None
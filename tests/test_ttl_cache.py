@@ -0,0 +1,57 @@
+import time
+
+from services.ttl_cache import TTLCache
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = TTLCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+
+    cache.set('c', 3)
+
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+    assert len(cache) == 2
+
+
+def test_entries_expire_after_their_ttl():
+    cache = TTLCache(10, ttl=0.01)
+    cache.set('short', 1)
+    cache.set('long', 2, ttl=60)
+    cache.set('forever', 3, ttl=None)
+
+    time.sleep(0.02)
+
+    assert (cache.get('short', 'expired'), cache.get('long'), cache.get('forever')) == ('expired', 2, 3)
+
+
+def test_cached_none_is_told_apart_from_a_miss():
+    cache = TTLCache(10)
+    missing = object()
+    cache.set('unknown', None)
+
+    assert cache.get('unknown', missing) is None
+    assert cache.get('other', missing) is missing
+
+
+def test_set_only_replaces_when_the_predicate_allows():
+    cache = TTLCache(10)
+    cache.set('k', {'version': 2})
+
+    cache.set('k', {'version': 1}, replace=lambda current: current['version'] <= 1)
+    assert cache.get('k') == {'version': 2}
+    cache.set('k', {'version': 3}, replace=lambda current: current['version'] <= 3)
+    assert cache.get('k') == {'version': 3}
+
+
+def test_add_and_get_or_set_keep_live_entries():
+    cache = TTLCache(10)
+
+    assert cache.add('k', 1)
+    assert not cache.add('k', 2)
+    assert cache.get_or_set('k', lambda: 3) == 1
+    assert cache.get_or_set('new', lambda: 4) == 4
+    assert cache.pop('k') == 1
+    assert cache.pop('k', 'gone') == 'gone'
+    assert cache.values() == [4]
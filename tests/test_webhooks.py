@@ -0,0 +1,89 @@
+import threading
+import time
+
+from app import extract_wa_messages
+from services.task_queue import TaskQueue
+
+
+def wa_payload(*values):
+    return {'object': 'whatsapp_business_account', 'entry': [{'changes': [{'value': value} for value in values]}]}
+
+
+def wa_value(phone_number_id, contacts, messages):
+    return {
+        'metadata': {'phone_number_id': phone_number_id, 'display_phone_number': '15550001111'},
+        'contacts': [{'wa_id': wa_id, 'profile': {'name': name}} for wa_id, name in contacts],
+        'messages': messages
+    }
+
+
+def text_message(message_id, sender, body):
+    return {'id': message_id, 'from': sender, 'type': 'text', 'text': {'body': body}}
+
+
+def test_extract_wa_messages_flattens_batched_payloads():
+    payload = wa_payload(
+        wa_value('pn1', [('911', 'Asha'), ('922', 'Ravi')], [text_message('m1', '911', 'hi'), text_message('m2', '922', 'hello')]),
+        wa_value('pn2', [], [text_message('m3', '933', 'hey')])
+    )
+
+    messages = extract_wa_messages(payload)
+
+    assert [(m['message_id'], m['phone_number_id'], m['phone_number'], m['user_name'], m['message']) for m in messages] == [
+        ('m1', 'pn1', '911', 'Asha', 'hi'),
+        ('m2', 'pn1', '922', 'Ravi', 'hello'),
+        ('m3', 'pn2', '933', None, 'hey'),
+    ]
+    assert messages[0]['display_phone_number'] == '15550001111'
+
+
+def test_extract_wa_messages_skips_statuses_and_non_text_messages():
+    payload = wa_payload(
+        {'metadata': {'phone_number_id': 'pn1'}, 'statuses': [{'id': 'm1', 'status': 'delivered'}]},
+        wa_value('pn1', [], [{'id': 'm2', 'from': '911', 'type': 'image', 'image': {'id': 'media'}}]),
+        wa_value(None, [], [text_message('m3', '911', 'no phone number id')]),
+    )
+
+    assert extract_wa_messages(payload) == []
+    assert extract_wa_messages({}) == []
+
+
+def test_keyed_tasks_run_one_at_a_time_in_order():
+    tasks = TaskQueue('test', workers=4, max_size=100)
+    done = threading.Event()
+    running, order, overlaps = set(), [], []
+    lock = threading.Lock()
+
+    def handle(key, i):
+        with lock:
+            if key in running:
+                overlaps.append(key)
+            running.add(key)
+        time.sleep(0.001)
+        with lock:
+            running.discard(key)
+            order.append((key, i))
+            if len(order) == 40:
+                done.set()
+
+    for i in range(20):
+        for key in ('chat-1', 'chat-2'):
+            assert tasks.submit_keyed(key, handle, key, i)
+
+    assert done.wait(5)
+    assert overlaps == []
+    for key in ('chat-1', 'chat-2'):
+        assert [i for k, i in order if k == key] == list(range(20))
+
+
+def test_tasks_waiting_behind_a_key_count_against_the_bound():
+    tasks = TaskQueue('test', workers=1, max_size=2)
+    release = threading.Event()
+
+    assert tasks.submit_keyed('chat', release.wait)
+    time.sleep(0.05)
+    assert tasks.submit_keyed('chat', lambda: None)
+    assert tasks.submit_keyed('chat', lambda: None)
+    assert not tasks.submit_keyed('chat', lambda: None)
+    assert tasks.depth() == 2
+    release.set()
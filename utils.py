@@ -1,4 +1,3 @@
-import requests
 import pytesseract
 from PIL import Image
 from pdf2image import convert_from_bytes
@@ -6,21 +5,23 @@ import docx2txt
 import whisper
 from youtube_transcript_api import YouTubeTranscriptApi
 import vimeo_dl
+import asyncio
 import io
 import os
 from urllib.parse import urlparse
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.chains import LLMChain
 from langchain.prompts import PromptTemplate
-from langchain_community.chat_models import ChatOpenAI
 from langchain_community.docstore.document import Document
-import tiktoken
-from openai import OpenAI
 from typing import List, Dict
 import openai
 from pinecone import Pinecone, ServerlessSpec
-from models.assistant import Content
-from collections import defaultdict
+from models.assistant import Content, DigestedContent
+from services.http_client import HttpClient
+from services.llm_gateway import LLMGateway, CHAT, INGESTION
+from services.metrics import Metrics
+from services.prompt_builder import count_tokens, MAX_CONTEXT_ITEMS
+from collections import Counter
+import numpy as np
 import json
 pc = Pinecone(
     api_key=os.getenv('PINECONE_API_KEY')
@@ -38,6 +39,27 @@ if 'bamanai' not in pc.list_indexes().names():
     )
 index = pc.Index('bamanai')
 
+# Source files can be large, so downloads get a longer read timeout than API calls
+DOWNLOAD_CONNECT_TIMEOUT = 5
+DOWNLOAD_READ_TIMEOUT = 120
+# Inputs per embedding request when indexing generated questions
+EMBEDDING_BATCH_SIZE = 100
+FAQ_TOP_K = 5
+# Per-digest vector labels besides the generated questions; topics and keywords are no longer written
+VECTOR_LABELS = ['text', 'title', 'topics', 'keywords']
+# Ids per Pinecone delete request
+DELETE_BATCH_SIZE = 1000
+# Default retrieval ranking, overridable per assistant through Assistant.ranking
+DEFAULT_RANKING = {
+    'weights': {'title': 3, 'content': 2, 'bm25': 2, 'topics': 1, 'keywords': 1},
+    'top_n': MAX_CONTEXT_ITEMS,
+    'mmr_lambda': 0.7,
+    'max_per_content': 2
+}
+MAX_RANKED_MATCHES = 20
+# Label whose returned vectors (the digest text) measure redundancy between candidates
+MMR_LABEL = 'content'
+
 class Utils:
     @staticmethod
     def get_file_type(url):
@@ -61,9 +83,10 @@ class Utils:
             raise ValueError('Unsupported file type')
 
     @staticmethod
+    @Metrics.timed('extract')
     def extract_text(file_url, file_type):
         try:
-            response = requests.get(file_url)
+            response = HttpClient.get(file_url, timeout=(DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT))
             response.raise_for_status()
             content = response.content
             
@@ -121,16 +144,21 @@ class Utils:
     def extract_text_from_vimeo(url):
         v = vimeo_dl.new(url)
         subtitle_url = v.subtitles()[0].url
-        response = requests.get(subtitle_url)
+        response = HttpClient.get(subtitle_url)
         return response.text
 
+    @staticmethod
+    def normalize_phone_number(phone_number: str) -> str:
+        """Digits-only international format, as used in WhatsApp wa_ids"""
+        digits = ''.join(ch for ch in str(phone_number) if ch.isdigit())
+        return digits[2:] if digits.startswith('00') else digits
+
     @staticmethod
     def num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> int:
-        encoding = tiktoken.get_encoding(encoding_name)
-        num_tokens = len(encoding.encode(string))
-        return num_tokens
+        return count_tokens(string, encoding_name)
 
     @staticmethod
+    @Metrics.timed('chunking')
     def create_chunks(text: str, chunk_size: int = 1500, chunk_overlap: int = 50) -> List[str]:
         text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=chunk_size,
@@ -140,8 +168,8 @@ class Utils:
         return text_splitter.split_text(text)
 
     @staticmethod
+    @Metrics.timed('llm.summary')
     def get_summary(text: str, max_tokens: int) -> str:
-        llm = ChatOpenAI(temperature=0, model_name="gpt-3.5-turbo-1106")
         prompt_template = PromptTemplate(
             input_variables=["text", "max_tokens"],
             template="""
@@ -150,11 +178,13 @@ class Utils:
             Text: {text}
             """
         )
-        chain = LLMChain(llm=llm, prompt=prompt_template)
-        summary = chain.run({"text": text, "max_tokens": max_tokens})
-        return summary
+        return LLMGateway.complete(
+            [{"role": "user", "content": prompt_template.format(text=text, max_tokens=max_tokens)}],
+            priority=INGESTION
+        )
 
     @staticmethod
+    @Metrics.timed('llm.metadata')
     def get_metadata(text: str) -> Dict[str, List[str]]:
         prompt = PromptTemplate(
             input_variables=["text"],
@@ -170,16 +200,14 @@ class Utils:
             Text: {text}
             """
         )
-        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo-1106",
-            messages=[
+        response = LLMGateway.complete(
+            [
                 {"role": "system", "content": "You are a helpful assistant that extracts metadata from text."},
                 {"role": "user", "content": prompt.format(text=text)}
             ],
-            temperature=0
+            priority=INGESTION
         )
-        return Utils.extract_json_data(response.choices[0].message.content)
+        return Utils.extract_json_data(response)
 
     @staticmethod
     def extract_json_data(response):
@@ -197,39 +225,75 @@ class Utils:
       return response
     
     @staticmethod
-    def get_embeddings(text: str) -> List[float]:
-        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        response = client.embeddings.create(
-            input=[text],
-            model="text-embedding-3-small"
-        )
-        return response.data[0].embedding
+    @Metrics.timed('embedding')
+    def get_embeddings(text: str, priority: int = CHAT) -> List[float]:
+        return LLMGateway.embed([text], priority=priority)[0]
+
+    @staticmethod
+    @Metrics.timed('embedding')
+    async def get_embeddings_async(texts: List[str], priority: int = CHAT) -> List[List[float]]:
+        """Embed several texts with one request"""
+        return await LLMGateway.embed_async(texts, priority=priority)
 
     @staticmethod
     def upload_to_pinecone(assistant_id: str, content_id: str, digest_id: str, label_type: str, text: str, o_or_s_label: str):
-        embeddings = Utils.get_embeddings(text)
-        print('###### UPLOADING TO PINECONE ######')
+        embeddings = Utils.get_embeddings(text, priority=INGESTION)
         pinecone_id = f"{assistant_id}__{content_id}__{digest_id}__{label_type}__{o_or_s_label}"
         metadata = {
             "assistant_id": assistant_id,
             "label_type": label_type,
             "o_or_s_label": o_or_s_label
         }
-        index.upsert(vectors=[{
-            "id": pinecone_id,
-            "values": embeddings,
-            "metadata": metadata
-        }])
+        with Metrics.span('vector.upsert'):
+            index.upsert(vectors=[{
+                "id": pinecone_id,
+                "values": embeddings,
+                "metadata": metadata
+            }])
+
+    @staticmethod
+    def upload_question_embeddings(assistant_id: str, content_id: str, digests: List[DigestedContent], o_or_s_label: str):
+        """Embed and index the generated questions of all digests of a content, in batches"""
+        questions = [
+            (digest.id, i, question)
+            for digest in digests
+            for i, question in enumerate(digest.questions or [])
+            if question and question.strip()
+        ]
+        for start in range(0, len(questions), EMBEDDING_BATCH_SIZE):
+            batch = questions[start:start + EMBEDDING_BATCH_SIZE]
+            embeddings = LLMGateway.embed([question for _, _, question in batch], priority=INGESTION)
+            vectors = [{
+                "id": f"{assistant_id}__{content_id}__{digest_id}__question-{i}__{o_or_s_label}",
+                "values": embedding,
+                "metadata": {
+                    "assistant_id": assistant_id,
+                    "label_type": "question",
+                    "o_or_s_label": o_or_s_label
+                }
+            } for (digest_id, i, _), embedding in zip(batch, embeddings)]
+            with Metrics.span('vector.upsert'):
+                index.upsert(vectors=vectors)
+
+    @staticmethod
+    def delete_content_vectors(assistant_id: str, content: Content, o_or_s_label: str):
+        """Delete every vector indexed for a content: text, title, generated questions and legacy topics/keywords"""
+        ids = [
+            f"{assistant_id}__{content.id}__{digest.id}__{label_type}__{o_or_s_label}"
+            for digest in content.digests
+            for label_type in VECTOR_LABELS + [f"question-{i}" for i in range(len(digest.questions or []))]
+        ]
+        for start in range(0, len(ids), DELETE_BATCH_SIZE):
+            with Metrics.span('vector.delete'):
+                index.delete(ids=ids[start:start + DELETE_BATCH_SIZE])
 
     @staticmethod
     def process_and_upload_embeddings(assistant_id: str, content_id: str, digest_id: str, content: Content, o_or_s_label: str):
         Utils.upload_to_pinecone(assistant_id, content_id, digest_id, "text", content.content, o_or_s_label)
         Utils.upload_to_pinecone(assistant_id, content_id, digest_id, "title", content.title, o_or_s_label)
-        Utils.upload_to_pinecone(assistant_id, content_id, digest_id, "topics", ", ".join(content.topics), o_or_s_label)
-        Utils.upload_to_pinecone(assistant_id, content_id, digest_id, "keywords", ", ".join(content.keywords), o_or_s_label)
 
     @staticmethod
-    def extract_chat_metadata(text: str) -> Dict[str, str]:
+    def chat_metadata_messages(text: str) -> List[Dict[str, str]]:
         prompt = PromptTemplate(
             input_variables=["text"],
             template="""
@@ -244,64 +308,106 @@ class Utils:
             Text: {text}
             """
         )
-        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo-1106",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that extracts metadata from text."},
-                {"role": "user", "content": prompt.format(text=text)}
-            ],
-            temperature=0
-        )
-        return Utils.extract_json_data(response.choices[0].message.content)
+        return [
+            {"role": "system", "content": "You are a helpful assistant that extracts metadata from text."},
+            {"role": "user", "content": prompt.format(text=text)}
+        ]
 
     @staticmethod
-    def generate_chat_response(user_message: str, conversation_summary: str, last_two_messages: List[Dict[str, str]], own_context: List[Dict[str, str]], supported_context: List[Dict[str, str]]) -> str:
-        context = {
-            'own': own_context,
-            'supported': supported_context
-        }
+    @Metrics.timed('llm.chat_metadata')
+    def extract_chat_metadata(text: str) -> Dict[str, str]:
+        return Utils.extract_json_data(LLMGateway.complete(Utils.chat_metadata_messages(text), priority=CHAT))
+
+    @staticmethod
+    @Metrics.timed('llm.chat_metadata')
+    async def extract_chat_metadata_async(text: str) -> Dict[str, str]:
+        return Utils.extract_json_data(await LLMGateway.complete_async(Utils.chat_metadata_messages(text), priority=CHAT))
+
+    @staticmethod
+    def chat_response_messages(user_message: str, conversation_summary: str, history: str, context: str) -> List[Dict[str, str]]:
+        # history and context are plain text rendered within token budgets by PromptBuilder
         prompt = PromptTemplate(
-            input_variables=["user_message", "conversation_summary", "last_two_messages", "context"],
+            input_variables=["user_message", "conversation_summary", "history", "context"],
             template="""
-            Given the following conversation summary, the last two messages, and the context from relevant content, generate a response to the user's message. Adapt the tone and language of the response fully according to the language, persona, and tonality of the original texts in own_content.
-            The response should be consistent with the conversation summary and the last two messages. Do not reference the context in your response (though you can ask the user to read the context if they want more information, but never use the word 'context'). Write a accurate response as if you are directly talking to the user. Also the user is a student, so your answers should be such that it is easy for them to understand and also motiviating for them to study more.
+            Given the following conversation summary, the recent messages, and the context from relevant content, generate a response to the user's message. Adapt the tone and language of the response fully according to the language, persona, and tonality of the original texts in the teacher's material.
+            The response should be consistent with the conversation summary and the recent messages. Do not reference the context in your response (though you can ask the user to read the context if they want more information, but never use the word 'context'). Write a accurate response as if you are directly talking to the user. Also the user is a student, so your answers should be such that it is easy for them to understand and also motiviating for them to study more.
 
             Conversation Summary: {conversation_summary}
-            Last Two Messages: {last_two_messages}
+            Recent Messages:
+            {history}
             User Message: {user_message}
             Context: {context}
 
             Response:
             """
         )
-        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo-1106",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that generates responses based on conversation context."},
-                {"role": "user", "content": prompt.format(user_message=user_message, conversation_summary=conversation_summary, last_two_messages=last_two_messages, context=context)}
-            ],
-            temperature=0
-        )
-        return response.choices[0].message.content
+        return [
+            {"role": "system", "content": "You are a helpful assistant that generates responses based on conversation context."},
+            {"role": "user", "content": prompt.format(user_message=user_message, conversation_summary=conversation_summary or "", history=history, context=context)}
+        ]
+
+    @staticmethod
+    @Metrics.timed('llm.response')
+    def generate_chat_response(user_message: str, conversation_summary: str, history: str, context: str) -> str:
+        return LLMGateway.complete(Utils.chat_response_messages(user_message, conversation_summary, history, context), priority=CHAT)
+
+    @staticmethod
+    @Metrics.timed('llm.response')
+    async def generate_chat_response_async(user_message: str, conversation_summary: str, history: str, context: str) -> str:
+        return await LLMGateway.complete_async(Utils.chat_response_messages(user_message, conversation_summary, history, context), priority=CHAT)
 
     @staticmethod
-    def query_pinecone(assistant_id: str, embedding: List[float], o_or_s_label: str, metadata_label: str) -> List[Dict[str, float]]:
+    @Metrics.timed('vector.query')
+    def query_pinecone(assistant_id: str, embedding: List[float], o_or_s_label: str, metadata_label: str, include_values: bool = False) -> List[Dict[str, float]]:
         query_response = index.query(
             vector=embedding,
             top_k=10,
-            include_metadata=True,
+            include_values=include_values,
             filter={
                 "assistant_id": assistant_id,
                 "o_or_s_label": o_or_s_label,
                 "label_type": metadata_label
             }
         )
+        if include_values:
+            return [{"id": match["id"], "score": match["score"], "values": match["values"]} for match in query_response["matches"]]
         return [{"id": match["id"], "score": match["score"]} for match in query_response["matches"]]
 
     @staticmethod
-    def update_conversation_summary(previous_summary: str, user_message: str, assistant_response: str) -> str:
+    @Metrics.timed('vector.query')
+    def query_faq(assistant_id: str, embedding: List[float], top_k: int = FAQ_TOP_K) -> Dict[str, List[Dict[str, float]]]:
+        """Match a question against the indexed digest questions of both content types with one query.
+        Returns ranked matches per content type ('own', 'supported'), one per digest."""
+        query_response = index.query(
+            vector=embedding,
+            top_k=top_k,
+            filter={
+                "assistant_id": assistant_id,
+                "label_type": "question"
+            }
+        )
+        ranked = {'own': [], 'supported': []}
+        seen = set()
+        for match in query_response["matches"]:
+            _, content_id, digest_id, _, o_or_s_label = match["id"].split('__')
+            unique_id = f"{content_id}__{digest_id}"
+            if unique_id in seen or o_or_s_label not in ranked:
+                continue
+            seen.add(unique_id)
+            ranked[o_or_s_label].append({'content_id_digest_id': unique_id, 'weighted_score': match["score"]})
+        return ranked
+
+    @staticmethod
+    async def query_pinecone_async(assistant_id: str, embedding: List[float], o_or_s_label: str, metadata_label: str, include_values: bool = False) -> List[Dict[str, float]]:
+        # The Pinecone client is synchronous, its queries run on the default executor
+        return await asyncio.to_thread(Utils.query_pinecone, assistant_id, embedding, o_or_s_label, metadata_label, include_values)
+
+    @staticmethod
+    async def query_faq_async(assistant_id: str, embedding: List[float], top_k: int = FAQ_TOP_K) -> Dict[str, List[Dict[str, float]]]:
+        return await asyncio.to_thread(Utils.query_faq, assistant_id, embedding, top_k)
+
+    @staticmethod
+    def conversation_summary_messages(previous_summary: str, user_message: str, assistant_response: str) -> List[Dict[str, str]]:
         prompt = PromptTemplate(
             input_variables=["previous_summary", "user_message", "assistant_response"],
             template="""
@@ -314,50 +420,113 @@ class Utils:
             Updated Summary:
             """
         )
-        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo-1106",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that updates conversation summaries."},
-                {"role": "user", "content": prompt.format(previous_summary=previous_summary, user_message=user_message, assistant_response=assistant_response)}
-            ],
-            temperature=0
-        )
-        return response.choices[0].message.content
+        return [
+            {"role": "system", "content": "You are a helpful assistant that updates conversation summaries."},
+            {"role": "user", "content": prompt.format(previous_summary=previous_summary, user_message=user_message, assistant_response=assistant_response)}
+        ]
 
     @staticmethod
-    def rank_pinecone_matches(matches: Dict[str, List[Dict[str, float]]]) -> List[Dict[str, float]]:
-        weights = {
-            'title': 3,
-            'content': 2,
-            'topics': 1,
-            'keywords': 1
-        }
+    @Metrics.timed('llm.conversation_summary')
+    def update_conversation_summary(previous_summary: str, user_message: str, assistant_response: str) -> str:
+        return LLMGateway.complete(Utils.conversation_summary_messages(previous_summary, user_message, assistant_response), priority=CHAT)
 
-        combined_scores = defaultdict(float)
-
-        for label, label_matches in matches.items():
-            weight = weights.get(label, 1)
-            for match in label_matches:
-                match_id = match['id']
-                match_score = match['score']
-                # Extract content_id and digest_id from the match_id
-                match_parts = match_id.split('__')
-                content_id = match_parts[1]
-                digest_id = match_parts[2]
-                unique_id = f"{content_id}__{digest_id}"
-                # Calculate weighted score
-                weighted_score = weight * match_score
-                combined_scores[unique_id] += weighted_score
+    @staticmethod
+    @Metrics.timed('llm.conversation_summary')
+    async def update_conversation_summary_async(previous_summary: str, user_message: str, assistant_response: str) -> str:
+        return await LLMGateway.complete_async(Utils.conversation_summary_messages(previous_summary, user_message, assistant_response), priority=CHAT)
 
-        # Sort the unique combinations by their weighted scores in decreasing order
-        sorted_matches = sorted(combined_scores.items(), key=lambda item: item[1], reverse=True)
+    @staticmethod
+    def ranking_settings(overrides: Dict = None) -> Dict:
+        overrides = overrides or {}
+        settings = dict(DEFAULT_RANKING, **{k: v for k, v in overrides.items() if k in DEFAULT_RANKING and k != 'weights'})
+        settings['weights'] = dict(DEFAULT_RANKING['weights'], **(overrides.get('weights') or {}))
+        return settings
 
-        # Convert to the desired output format
-        ranked_matches = [{'content_id_digest_id': k, 'weighted_score': v} for k, v in sorted_matches]
+    @staticmethod
+    def validate_ranking(ranking) -> str:
+        """Error message for invalid per-assistant ranking settings, None when valid"""
+        if not isinstance(ranking, dict):
+            return 'ranking must be an object'
+        unknown = sorted(set(ranking) - set(DEFAULT_RANKING))
+        if unknown:
+            return f"Unknown ranking settings: {', '.join(unknown)}"
+        weights = ranking.get('weights') or {}
+        if not isinstance(weights, dict) or any(label not in DEFAULT_RANKING['weights'] or not isinstance(weight, (int, float)) or weight < 0 for label, weight in weights.items()):
+            return f"weights must map {', '.join(DEFAULT_RANKING['weights'])} to non-negative numbers"
+        if 'top_n' in ranking and not (isinstance(ranking['top_n'], int) and 1 <= ranking['top_n'] <= MAX_RANKED_MATCHES):
+            return f'top_n must be an integer between 1 and {MAX_RANKED_MATCHES}'
+        if 'mmr_lambda' in ranking and not (isinstance(ranking['mmr_lambda'], (int, float)) and 0 <= ranking['mmr_lambda'] <= 1):
+            return 'mmr_lambda must be a number between 0 and 1'
+        if 'max_per_content' in ranking and not (isinstance(ranking['max_per_content'], int) and ranking['max_per_content'] >= 1):
+            return 'max_per_content must be a positive integer'
+        return None
+
+    @staticmethod
+    @Metrics.timed('ranking')
+    def rank_pinecone_matches(matches: Dict[str, List[Dict[str, float]]], settings: Dict = None) -> List[Dict[str, float]]:
+        """Fuse per-label scores by weight and pick the top_n digests with maximal marginal relevance"""
+        settings = Utils.ranking_settings(settings)
+        labels = list(matches)
+        keys, positions, vectors = [], {}, {}
+        rows, columns, scores = [], [], []
+        for row, label in enumerate(labels):
+            for match in matches[label]:
+                # Match ids are <assistant>__<content>__<digest>__<label>__<own|supported>
+                _, content_id, digest_id, _ = match['id'].split('__', 3)
+                unique_id = f"{content_id}__{digest_id}"
+                column = positions.get(unique_id)
+                if column is None:
+                    column = positions[unique_id] = len(keys)
+                    keys.append(unique_id)
+                rows.append(row)
+                columns.append(column)
+                scores.append(match['score'])
+                if label == MMR_LABEL and match.get('values') is not None:
+                    vectors[column] = match['values']
+        if not keys:
+            return []
+
+        label_scores = np.zeros((len(labels), len(keys)), dtype=np.float32)
+        np.add.at(label_scores, (rows, columns), scores)
+        weights = np.array([settings['weights'].get(label, 1) for label in labels], dtype=np.float32)
+        fused = weights @ label_scores
+
+        selected = Utils.select_diverse(keys, fused, vectors, settings)
+        return [{'content_id_digest_id': keys[i], 'weighted_score': float(fused[i])} for i in selected]
+
+    @staticmethod
+    def select_diverse(keys: List[str], fused: np.ndarray, vectors: Dict[int, List[float]], settings: Dict) -> List[int]:
+        """Greedy MMR over the fused scores, also capping digests taken from one content"""
+        count = len(keys)
+        # Min-max scaled, so the order holds when weights or similarities make every score negative
+        low, high = float(fused.min()), float(fused.max())
+        relevance = (fused - low) / (high - low) if high > low else np.ones(count, dtype=np.float32)
+        embeddings = None
+        if vectors:
+            embeddings = np.zeros((count, len(next(iter(vectors.values())))), dtype=np.float32)
+            embeddings[list(vectors)] = np.array(list(vectors.values()), dtype=np.float32)
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings /= np.where(norms > 0, norms, 1)
+
+        content_ids = [key.split('__', 1)[0] for key in keys]
+        per_content = Counter()
+        redundancy = np.zeros(count, dtype=np.float32)
+        available = np.ones(count, dtype=bool)
+        mmr_lambda = settings['mmr_lambda']
+        selected = []
+        while len(selected) < settings['top_n'] and available.any():
+            mmr = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+            mmr[~available] = -np.inf
+            best = int(np.argmax(mmr))
+            available[best] = False
+            if per_content[content_ids[best]] >= settings['max_per_content']:
+                continue
+            per_content[content_ids[best]] += 1
+            selected.append(best)
+            if embeddings is not None and best in vectors:
+                redundancy = np.maximum(redundancy, embeddings @ embeddings[best])
+        return selected
 
-        return ranked_matches
-    
     @staticmethod
     def send_wa_message(sender_id: str, phone_number: str, message: str, sender_access_token: str, type: str = "text", media_url: str = None, caption: str = None):
         url = f"https://graph.facebook.com/v20.0/{sender_id}/messages"
@@ -372,7 +541,7 @@ class Utils:
             f"{type}": {"body": message, "preview_url": False} if type == "text" else {"link": media_url, "caption": caption or "Hello"}
         }
         print(data)
-        response = requests.post(url, headers=headers, data=json.dumps(data))
+        response = HttpClient.post(url, headers=headers, data=json.dumps(data))
         print(response.json())
         return response.json()
     
@@ -382,7 +551,7 @@ class Utils:
         params = {
             "url": f"{os.getenv('APP_URL')}/telegram-webhook/{channel_id}"
         }
-        response = requests.post(url, data=params)
+        response = HttpClient.post(url, data=params, idempotent=True)
         print(response.json())
         return response.json()
     
@@ -393,6 +562,6 @@ class Utils:
             "chat_id": chat_id,
             "text": message
         }
-        response = requests.post(url, data=params)
+        response = HttpClient.post(url, data=params)
         print(response.json())
         return response.json()
\ No newline at end of file